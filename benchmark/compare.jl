@@ -0,0 +1,59 @@
+# Compares two result files written by benchmark/runbenchmarks.jl.
+#
+#   julia --project=. benchmark/compare.jl BASELINE.json CURRENT.json [--threshold 0.1]
+#
+# Prints the change in throughput and allocations of every benchmark found in both files, and exits with status 1
+# if any benchmark's throughput dropped by more than the threshold (a fraction, 10% by default).
+using JSON
+
+const DEFAULT_THRESHOLD = 0.1
+
+result_key(result) = "$(result["name"]) $(join(["$(k)=$(v)" for (k, v) in sort!(collect(result["parameters"]))], " "))"
+
+function index_results(report)
+  return Dict(result_key(result) => result for result in report["results"])
+end
+
+percent_change(old, new) = old == 0 ? 0.0 : round(100 * (new - old) / old, digits=1)
+
+function compare_benchmarks(baseline_file_name, current_file_name; threshold=DEFAULT_THRESHOLD)
+  baseline = JSON.parsefile(baseline_file_name)
+  current = JSON.parsefile(current_file_name)
+  println("Baseline: $(baseline["commit"]) ($(baseline["date"]), Julia $(baseline["julia_version"]), $(baseline["threads"]) threads)")
+  println("Current:  $(current["commit"]) ($(current["date"]), Julia $(current["julia_version"]), $(current["threads"]) threads)")
+  baseline_results = index_results(baseline)
+  current_results = index_results(current)
+  regressions = Vector{String}()
+  for key in sort!(collect(keys(current_results)))
+    if !haskey(baseline_results, key)
+      println(rpad(key, 70), "  new")
+      continue
+    end
+    old, new = baseline_results[key], current_results[key]
+    speed_change = percent_change(old["items_per_second"], new["items_per_second"])
+    allocation_change = percent_change(old["bytes_allocated"], new["bytes_allocated"])
+    regressed = new["items_per_second"] < old["items_per_second"] * (1 - threshold)
+    if regressed
+      push!(regressions, key)
+    end
+    println(rpad(key, 70), lpad("$(speed_change)% $(new["unit"])/s", 20), lpad("$(allocation_change)% bytes", 18), regressed ? "  REGRESSION" : "")
+  end
+  for key in sort!(collect(keys(baseline_results)))
+    if !haskey(current_results, key)
+      println(rpad(key, 70), "  missing")
+    end
+  end
+  return regressions
+end
+
+if PROGRAM_FILE == @__FILE__
+  threshold = DEFAULT_THRESHOLD
+  if length(ARGS) == 4 && ARGS[3] == "--threshold"
+    threshold = parse(Float64, ARGS[4])
+  elseif length(ARGS) != 2
+    println(stderr, "Usage: julia benchmark/compare.jl BASELINE.json CURRENT.json [--threshold 0.1]")
+    exit(2)
+  end
+  regressions = compare_benchmarks(ARGS[1], ARGS[2]; threshold=threshold)
+  exit(isempty(regressions) ? 0 : 1)
+end
@@ -0,0 +1,271 @@
+# Benchmarks for the extraction and resolution hot paths.
+#
+#   julia --project=. benchmark/runbenchmarks.jl [--quick] [--large] [--filter NAME] [--samples N] [--output FILE]
+#
+# Every benchmark runs once to compile, then --samples times on the same synthetic data (fixed seed), and reports
+# items per second of the fastest run, bytes allocated per run and the process' peak resident memory so far.
+# Results are written as JSON (benchmark/results.json by default) for benchmark/compare.jl.
+# --quick uses fewer and smaller cases, --large adds the 10^6 tag resolution cases, --filter keeps benchmarks whose name contains NAME.
+using BioSequences
+using Dates
+using JSON
+using PORPID
+using Random
+
+const SEED = 1234
+const NUCLEOTIDES = "ACGT"
+
+struct BenchmarkOptions
+  quick::Bool
+  large::Bool
+  filter::String
+  samples::Int
+  output::String
+end
+
+function parse_options(args)
+  quick, large, filter, samples, output = false, false, "", 3, joinpath(@__DIR__, "results.json")
+  i = 1
+  while i <= length(args)
+    if args[i] == "--quick"
+      quick = true
+    elseif args[i] == "--large"
+      large = true
+    elseif args[i] == "--filter"
+      i += 1
+      filter = args[i]
+    elseif args[i] == "--samples"
+      i += 1
+      samples = parse(Int, args[i])
+    elseif args[i] == "--output"
+      i += 1
+      output = args[i]
+    else
+      error("Unknown option $(args[i])")
+    end
+    i += 1
+  end
+  return BenchmarkOptions(quick, large, filter, samples, output)
+end
+
+random_nucleotides(rng, n) = String([rand(rng, NUCLEOTIDES) for i in 1:n])
+
+# A template with a barcode of barcode_length, star_count stars spread through it, and known sequence everywhere else
+function synthetic_template(rng, template_length, star_count; barcode_length=8)
+  known_length = template_length - barcode_length - star_count
+  pieces = [random_nucleotides(rng, div(known_length, 2)), repeat("n", barcode_length),
+            random_nucleotides(rng, known_length - div(known_length, 2))]
+  reference = join(pieces)
+  for star in 1:star_count
+    position = rand(rng, 1:length(reference) + 1)
+    reference = "$(reference[1:position-1])*$(reference[position:end])"
+  end
+  return reference
+end
+
+# A read made from a template: random barcode, a few random bases per star, then substitution errors at error_rate,
+# padded with random bases (or cut) to read_length
+function synthetic_read(rng, reference, read_length; error_rate=0.01, star_bases=5)
+  bases = Vector{Char}()
+  for c in reference
+    if c == '*'
+      append!(bases, collect(random_nucleotides(rng, rand(rng, 0:star_bases))))
+    elseif islowercase(c)
+      push!(bases, rand(rng, NUCLEOTIDES))
+    else
+      push!(bases, rand(rng) < error_rate ? rand(rng, NUCLEOTIDES) : c)
+    end
+  end
+  while length(bases) < read_length
+    push!(bases, rand(rng, NUCLEOTIDES))
+  end
+  return String(bases[1:read_length])
+end
+
+function write_synthetic_fastq(file_name, reads)
+  open(file_name, "w") do io
+    for (i, read) in enumerate(reads)
+      println(io, "@read_$(i)")
+      println(io, read)
+      println(io, "+")
+      println(io, repeat("?", length(read)))
+    end
+  end
+end
+
+# Tags as they come out of extraction: real tags, each seen count times, with some reads carrying one error
+function synthetic_tag_counts(rng, tag_count; tag_length=12, real_fraction=0.1)
+  counts = Dict{String, Int32}()
+  reals = [random_nucleotides(rng, tag_length) for i in 1:max(1, round(Int, tag_count * real_fraction))]
+  for real in reals
+    counts[real] = rand(rng, 10:100)
+  end
+  while length(counts) < tag_count
+    real = rand(rng, reals)
+    position = rand(rng, 1:tag_length)
+    error_kind = rand(rng, 1:3)
+    if error_kind == 1
+      tag = "$(real[1:position-1])$(real[position+1:end])"
+    elseif error_kind == 2
+      tag = "$(real[1:position-1])$(rand(rng, NUCLEOTIDES))$(real[position:end])"
+    else
+      tag = "$(real[1:position-1])$(rand(rng, NUCLEOTIDES))$(real[position+1:end])"
+    end
+    counts[tag] = get(counts, tag, 0) + 1
+  end
+  return counts
+end
+
+peak_memory() = isdefined(Sys, :maxrss) ? Int(Sys.maxrss()) : -1
+
+# Runs f once to compile and then samples times. f returns the number of items it processed.
+function measure(f, name, parameters, unit, samples)
+  items = f()
+  times = Vector{Float64}()
+  bytes = 0
+  gc_time = 0.0
+  for sample in 1:samples
+    GC.gc()
+    # @timed is a tuple before Julia 1.5 and a NamedTuple after, both start (value, time, bytes, gctime)
+    timed = @timed f()
+    items = timed[1]
+    push!(times, timed[2])
+    bytes = timed[3]
+    gc_time = max(gc_time, timed[4])
+  end
+  sorted_times = sort(times)
+  result = Dict("name" => name, "parameters" => parameters, "unit" => unit, "items" => items, "samples" => samples,
+                "min_time" => sorted_times[1], "median_time" => sorted_times[div(length(sorted_times) + 1, 2)],
+                "items_per_second" => items / sorted_times[1], "bytes_allocated" => bytes,
+                "bytes_per_item" => bytes / max(1, items), "gc_time" => gc_time, "max_rss" => peak_memory())
+  println(stderr, rpad("$(name) $(join(["$(k)=$(v)" for (k, v) in sort!(collect(parameters))], " "))", 70),
+          lpad("$(round(items / sorted_times[1], digits=1)) $(unit)/s", 22), lpad("$(round(bytes / max(1, items), digits=1)) B/$(unit)", 18))
+  return result
+end
+
+function benchmark_extract_tag(options, results)
+  rng = MersenneTwister(SEED)
+  read_lengths = options.quick ? [60, 200] : [60, 200, 800]
+  template_lengths = options.quick ? [40] : [40, 80]
+  star_counts = options.quick ? [1] : [0, 1, 3]
+  read_count = options.quick ? 100 : 500
+  for read_length in read_lengths, template_length in template_lengths, star_count in star_counts
+    reference = synthetic_template(rng, template_length, star_count)
+    states = Template("benchmark", reference).compiled
+    reads = [DNASequence(synthetic_read(rng, reference, read_length)) for i in 1:read_count]
+    quality = fill(Int8(30), read_length)
+    buffer = AlignmentBuffer()
+    parameters = Dict("read_length" => read_length, "template_length" => template_length, "stars" => star_count)
+    push!(results, measure("extract_tag", parameters, "reads", options.samples) do
+      for read in reads
+        extract_tag(read, quality, states, buffer)
+      end
+      return length(reads)
+    end)
+  end
+end
+
+function benchmark_choose_best_template(options, results)
+  rng = MersenneTwister(SEED)
+  template_counts = options.quick ? [1, 8] : [1, 4, 16, 64]
+  read_count = options.quick ? 50 : 200
+  read_length = 100
+  for template_count in template_counts
+    references = [synthetic_template(rng, 50, 1) for i in 1:template_count]
+    templates = [Template("template_$(i)", reference) for (i, reference) in enumerate(references)]
+    reads = [DNASequence(synthetic_read(rng, rand(rng, references), read_length)) for i in 1:read_count]
+    quality = fill(Int8(30), read_length)
+    buffer = AlignmentBuffer()
+    push!(results, measure("choose_best_template", Dict("templates" => template_count), "reads", options.samples) do
+      for read in reads
+        PORPID.choose_best_template(read, quality, templates; buffer=buffer)
+      end
+      return length(reads)
+    end)
+  end
+end
+
+function benchmark_extract_tags_from_file(options, results)
+  rng = MersenneTwister(SEED)
+  read_count = options.quick ? 1000 : 10000
+  references = [synthetic_template(rng, 50, 1) for i in 1:4]
+  directory = mktempdir()
+  file_name = joinpath(directory, "benchmark.fastq")
+  write_synthetic_fastq(file_name, [synthetic_read(rng, rand(rng, references), 300) for i in 1:read_count])
+  config = Configuration()
+  config.files = [file_name]
+  config.filetype = fastq
+  config.start_inclusive = 1
+  config.end_inclusive = 80
+  config.max_allowed_errors = 3
+  config.try_reverse_complement = true
+  for (i, reference) in enumerate(references)
+    push!(config.templates, Template("template_$(i)", reference))
+  end
+  for threads in unique([1, Threads.nthreads()])
+    push!(results, measure("extract_tags_from_file", Dict("reads" => read_count, "threads" => threads), "reads", options.samples) do
+      processed = 0
+      extract_tags_from_file(file_name, config, (args...) -> processed += 1; threads=threads)
+      return processed
+    end)
+  end
+  rm(directory, recursive=true)
+end
+
+function benchmark_resolution(options, results)
+  tag_counts = options.quick ? [10^3] : [10^3, 10^4, 10^5]
+  if options.large
+    push!(tag_counts, 10^6)
+  end
+  for tag_count in tag_counts
+    rng = MersenneTwister(SEED)
+    counts = synthetic_tag_counts(rng, tag_count)
+    tag_to_index, index_to_tag = tag_index_mapping(keys(counts))
+    indexed_counts = index_counts(counts, tag_to_index)
+    parameters = Dict("tags" => tag_count)
+    push!(results, measure("prob_observed_tags_given_reals", parameters, "tags", options.samples) do
+      length(prob_observed_tags_given_reals(tag_to_index, PORPID.PacBioErrorModel()))
+    end)
+    probabilities_array = prob_observed_tags_given_reals(tag_to_index, PORPID.PacBioErrorModel())
+    push!(results, measure("LDA", parameters, "tags", options.samples) do
+      length(LDA(probabilities_array, indexed_counts))
+    end)
+    likelihoods = LikelihoodMatrix(probabilities_array)
+    push!(results, measure("sparse_LDA", parameters, "tags", options.samples) do
+      length(sparse_LDA(likelihoods, indexed_counts).most_likely_real_for_each_obs)
+    end)
+  end
+end
+
+function git_commit()
+  try
+    return strip(read(`git -C $(@__DIR__) rev-parse HEAD`, String))
+  catch
+    return ""
+  end
+end
+
+const BENCHMARKS = [("extract_tag", benchmark_extract_tag),
+                    ("choose_best_template", benchmark_choose_best_template),
+                    ("extract_tags_from_file", benchmark_extract_tags_from_file),
+                    ("resolution", benchmark_resolution)]
+
+function run_benchmarks(options::BenchmarkOptions)
+  results = Vector{Dict{String, Any}}()
+  for (name, benchmark) in BENCHMARKS
+    if isempty(options.filter) || occursin(options.filter, name)
+      benchmark(options, results)
+    end
+  end
+  report = Dict("commit" => git_commit(), "date" => string(now()), "julia_version" => string(VERSION),
+                "threads" => Threads.nthreads(), "quick" => options.quick, "results" => results)
+  open(options.output, "w") do io
+    JSON.print(io, report, 2)
+  end
+  println(stderr, "Results written to $(options.output)")
+  return report
+end
+
+if PROGRAM_FILE == @__FILE__
+  run_benchmarks(parse_options(ARGS))
+end
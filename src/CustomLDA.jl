@@ -1,4 +1,4 @@
-#export LDA
+#export LDA, LikelihoodMatrix, LDAResult, sparse_LDA, components_LDA
 
 const DEFAULT_CONCENTRATION = 0.5
 const EPSILON = 0.00000000000000001
@@ -66,3 +66,338 @@ end
 function norm(v)
 return v ./ sum(v)
 end
+
+const DEFAULT_MAX_ITERATIONS = 1000
+const MINIMUM_EXTRAPOLATED_PRIOR = 1e-300
+
+# probabilities_array in compressed sparse row form:
+# row obs holds (columns[k], values[k]) for k in row_starts[obs]:row_starts[obs+1]-1
+struct LikelihoodMatrix
+  row_starts::Vector{Int}
+  columns::Vector{Int32}
+  values::Vector{Float64}
+end
+
+function LikelihoodMatrix(probabilities_array::AbstractVector)
+  row_starts = Vector{Int}(undef, length(probabilities_array) + 1)
+  row_starts[1] = 1
+  for obs in 1:length(probabilities_array)
+    row_starts[obs+1] = row_starts[obs] + length(probabilities_array[obs])
+  end
+  columns = Vector{Int32}(undef, row_starts[end] - 1)
+  values = Vector{Float64}(undef, row_starts[end] - 1)
+  k = 1
+  for row in probabilities_array
+    for (real_index, prob) in row
+      columns[k] = real_index
+      values[k] = prob
+      k += 1
+    end
+  end
+  return LikelihoodMatrix(row_starts, columns, values)
+end
+
+Base.length(likelihoods::LikelihoodMatrix) = length(likelihoods.row_starts) - 1
+
+# Same entries grouped by real tag instead of by observed tag, so that each thread
+# can gather the posterior of its own real tags without clashing with other threads
+function transpose_likelihoods(likelihoods::LikelihoodMatrix)
+  tag_count = length(likelihoods)
+  row_starts = zeros(Int, tag_count + 1)
+  for real_index in likelihoods.columns
+    row_starts[real_index+1] += 1
+  end
+  row_starts[1] = 1
+  for real_index in 1:tag_count
+    row_starts[real_index+1] += row_starts[real_index]
+  end
+  next_slot = row_starts[1:tag_count]
+  columns = Vector{Int32}(undef, length(likelihoods.columns))
+  values = Vector{Float64}(undef, length(likelihoods.values))
+  for obs in 1:tag_count
+    for k in likelihoods.row_starts[obs]:likelihoods.row_starts[obs+1]-1
+      real_index = likelihoods.columns[k]
+      columns[next_slot[real_index]] = obs
+      values[next_slot[real_index]] = likelihoods.values[k]
+      next_slot[real_index] += 1
+    end
+  end
+  return LikelihoodMatrix(row_starts, columns, values)
+end
+
+struct LDAResult
+  most_likely_real_for_each_obs::Vector{Tuple{Int32, Float64}}
+  prior::Vector{Float64}
+  iterations::Int
+  elapsed::Float64
+  final_change::Float64
+  converged::Bool
+end
+
+function Base.show(io::IO, result::LDAResult)
+  print(io, "LDAResult($(length(result.prior)) tags, ", result.converged ? "converged" : "did not converge",
+            " after $(result.iterations) iterations in $(round(result.elapsed, digits=3))s, final change $(result.final_change))")
+end
+
+@inline function observation_weight(prior, likelihoods::LikelihoodMatrix, counts, obs)
+  total = 0.0
+  for k in likelihoods.row_starts[obs]:likelihoods.row_starts[obs+1]-1
+    total += prior[likelihoods.columns[k]] * likelihoods.values[k]
+  end
+  return counts[obs] / total
+end
+
+@inline function unnormalised_prior(prior, weights, by_real::LikelihoodMatrix, real_index, concentration)
+  posterior = 0.0
+  for k in by_real.row_starts[real_index]:by_real.row_starts[real_index+1]-1
+    posterior += by_real.values[k] * weights[by_real.columns[k]]
+  end
+  return prior[real_index] * posterior + concentration
+end
+
+# One EM update of prior into new_prior. Leaves counts[obs] / sum(prior .* likelihoods[obs]) in weights.
+# With threaded=false it stays on the calling thread, for when the caller is already running one problem per thread.
+function em_step!(new_prior, weights, prior, likelihoods::LikelihoodMatrix, by_real::LikelihoodMatrix, counts, concentration, threaded=true)
+  tag_count = length(prior)
+  if threaded
+    Threads.@threads for obs in 1:tag_count
+      weights[obs] = observation_weight(prior, likelihoods, counts, obs)
+    end
+    Threads.@threads for real_index in 1:tag_count
+      new_prior[real_index] = unnormalised_prior(prior, weights, by_real, real_index, concentration)
+    end
+  else
+    for obs in 1:tag_count
+      weights[obs] = observation_weight(prior, likelihoods, counts, obs)
+    end
+    for real_index in 1:tag_count
+      new_prior[real_index] = unnormalised_prior(prior, weights, by_real, real_index, concentration)
+    end
+  end
+  norm_total = sum(new_prior)
+  for real_index in 1:tag_count
+    new_prior[real_index] /= norm_total
+  end
+  return new_prior
+end
+
+# Log posterior of the prior that produced weights, which is what each EM step increases
+function log_posterior(weights, prior, counts, concentration)
+  total = 0.0
+  for obs in 1:length(prior)
+    if counts[obs] > 0
+      total += counts[obs] * log(counts[obs] / weights[obs])
+    end
+    total += concentration * log(prior[obs])
+  end
+  return total
+end
+
+function max_change(a, b)
+  change = 0.0
+  for i in 1:length(a)
+    change = max(change, abs(a[i] - b[i]))
+  end
+  return change
+end
+
+# Same model as LDA, on a LikelihoodMatrix, with the E-step spread over threads.
+# With accelerate=true, EM is extrapolated with SQUAREM (Varadhan & Roland, 2008): two EM steps
+# are combined into one longer step, which is only kept if it doesn't lower the log posterior.
+# Convergence is checked on the change made by a plain EM step, with the same threshold as LDA.
+function sparse_LDA(likelihoods::LikelihoodMatrix, counts=ones(Int32, length(likelihoods)); concentration=DEFAULT_CONCENTRATION,
+                    accelerate=true, max_iterations=DEFAULT_MAX_ITERATIONS, tolerance=EPSILON / length(likelihoods), initial_prior=nothing,
+                    threaded=true)
+  start_time = time()
+  tag_count = length(likelihoods)
+  by_real = transpose_likelihoods(likelihoods)
+  prior = initial_prior === nothing ? fill(1.0 / tag_count, tag_count) : initial_prior ./ sum(initial_prior)
+  step1 = similar(prior)
+  step2 = similar(prior)
+  extrapolated = similar(prior)
+  weights = Vector{Float64}(undef, tag_count)
+  iterations = 0
+  change = Inf
+  converged = false
+  while iterations < max_iterations
+    em_step!(step1, weights, prior, likelihoods, by_real, counts, concentration, threaded)
+    iterations += 1
+    if !accelerate || iterations + 2 > max_iterations
+      change = max_change(step1, prior)
+      prior, step1 = step1, prior
+      if change < tolerance
+        converged = true
+        break
+      end
+      continue
+    end
+    prior_log_posterior = log_posterior(weights, prior, counts, concentration)
+    em_step!(step2, weights, step1, likelihoods, by_real, counts, concentration, threaded)
+    iterations += 1
+    change = max_change(step2, step1)
+    if change < tolerance
+      prior, step2 = step2, prior
+      converged = true
+      break
+    end
+    r_squared = 0.0
+    v_squared = 0.0
+    for i in 1:tag_count
+      r = step1[i] - prior[i]
+      v = step2[i] - 2 * step1[i] + prior[i]
+      r_squared += r * r
+      v_squared += v * v
+    end
+    alpha = v_squared > 0 ? min(-1.0, -sqrt(r_squared / v_squared)) : -1.0
+    for i in 1:tag_count
+      r = step1[i] - prior[i]
+      v = step2[i] - 2 * step1[i] + prior[i]
+      extrapolated[i] = max(MINIMUM_EXTRAPOLATED_PRIOR, prior[i] - 2 * alpha * r + alpha * alpha * v)
+    end
+    extrapolated_total = sum(extrapolated)
+    for i in 1:tag_count
+      extrapolated[i] /= extrapolated_total
+    end
+    # Stabilising EM step from the extrapolated point, which also gives its log posterior
+    em_step!(step1, weights, extrapolated, likelihoods, by_real, counts, concentration, threaded)
+    iterations += 1
+    if log_posterior(weights, extrapolated, counts, concentration) >= prior_log_posterior
+      prior, step1 = step1, prior
+    else
+      prior, step2 = step2, prior
+    end
+  end
+  most_likely_real_for_each_obs = Array{Tuple{Int32, Float64}}(undef, tag_count)
+  for obs in 1:tag_count
+    best_prob = 0.0
+    best_index = -1
+    temp_norm_total = 0.0
+    for k in likelihoods.row_starts[obs]:likelihoods.row_starts[obs+1]-1
+      posterior = prior[likelihoods.columns[k]] * likelihoods.values[k]
+      temp_norm_total += posterior
+      if posterior > best_prob
+        best_prob = posterior
+        best_index = likelihoods.columns[k]
+      end
+    end
+    most_likely_real_for_each_obs[obs] = (best_index, best_prob / temp_norm_total)
+  end
+  return LDAResult(most_likely_real_for_each_obs, prior, iterations, time() - start_time, change, converged)
+end
+
+# Components with at least this many tags get every thread for their EM steps, smaller ones get a thread each
+const PARALLEL_COMPONENT_SIZE = 10_000
+
+function find_root!(parent, tag)
+  while parent[tag] != tag
+    parent[tag] = parent[parent[tag]]
+    tag = parent[tag]
+  end
+  return tag
+end
+
+function union_roots!(parent, sizes, a, b)
+  a = find_root!(parent, a)
+  b = find_root!(parent, b)
+  a == b && return
+  if sizes[a] < sizes[b]
+    a, b = b, a
+  end
+  parent[b] = a
+  sizes[a] += sizes[b]
+end
+
+# Connected components of the graph that links every observed tag to the real tags in its row of likelihoods,
+# as the (increasing) tag indices of each component, ordered by their first tag
+function likelihood_components(likelihoods::LikelihoodMatrix)
+  tag_count = length(likelihoods)
+  parent = collect(Int32(1):Int32(tag_count))
+  sizes = ones(Int32, tag_count)
+  for obs in 1:tag_count
+    for k in likelihoods.row_starts[obs]:likelihoods.row_starts[obs+1]-1
+      union_roots!(parent, sizes, Int32(obs), likelihoods.columns[k])
+    end
+  end
+  components = Vector{Vector{Int32}}()
+  component_of_root = zeros(Int, tag_count)
+  for tag in Int32(1):Int32(tag_count)
+    root = find_root!(parent, tag)
+    if component_of_root[root] == 0
+      push!(components, Vector{Int32}())
+      component_of_root[root] = length(components)
+    end
+    push!(components[component_of_root[root]], tag)
+  end
+  return components
+end
+
+# The rows of one component, with tags renumbered to their position in it (local_index)
+function component_likelihoods(likelihoods::LikelihoodMatrix, component, local_index)
+  rows = Vector{Vector{Tuple{Int32, Float64}}}(undef, length(component))
+  for (i, obs) in enumerate(component)
+    row = likelihoods.row_starts[obs]:likelihoods.row_starts[obs+1]-1
+    rows[i] = [(local_index[likelihoods.columns[k]], likelihoods.values[k]) for k in row]
+  end
+  return LikelihoodMatrix(rows)
+end
+
+# Same model as sparse_LDA, solved separately on each connected component of the likelihood graph.
+# No observed tag has a likelihood for a real tag in another component, so the EM fixed point of a component on its own is
+# the global one divided by the component's share of the prior, (its counts + concentration * its tags) / (all counts + concentration * all tags).
+# A tag only linked to itself is its own most likely real tag, with probability 1 and its share as its prior, so it needs no EM.
+# tolerance is for the global prior, so each component is checked against tolerance divided by its share.
+# The result is reported as one LDAResult, with the most iterations and largest final change of any component.
+function components_LDA(likelihoods::LikelihoodMatrix, counts=ones(Int32, length(likelihoods)); concentration=DEFAULT_CONCENTRATION,
+                        accelerate=true, max_iterations=DEFAULT_MAX_ITERATIONS, tolerance=EPSILON / length(likelihoods), initial_prior=nothing)
+  start_time = time()
+  tag_count = length(likelihoods)
+  components = likelihood_components(likelihoods)
+  local_index = Vector{Int32}(undef, tag_count)
+  for component in components
+    for (i, tag) in enumerate(component)
+      local_index[tag] = i
+    end
+  end
+  total_weight = sum(counts) + concentration * tag_count
+  shares = [(sum(counts[component]) + concentration * length(component)) / total_weight for component in components]
+  most_likely_real_for_each_obs = Array{Tuple{Int32, Float64}}(undef, tag_count)
+  prior = Vector{Float64}(undef, tag_count)
+  results = Vector{Union{Nothing, LDAResult}}(nothing, length(components))
+  solve_component(c, threaded) = begin
+    component = components[c]
+    result = sparse_LDA(component_likelihoods(likelihoods, component, local_index), counts[component]; concentration=concentration,
+                        accelerate=accelerate, max_iterations=max_iterations, tolerance=tolerance / shares[c],
+                        initial_prior=initial_prior === nothing ? nothing : initial_prior[component], threaded=threaded)
+    for (i, tag) in enumerate(component)
+      real_index, prob = result.most_likely_real_for_each_obs[i]
+      most_likely_real_for_each_obs[tag] = (real_index > 0 ? component[real_index] : real_index, prob)
+      prior[tag] = result.prior[i] * shares[c]
+    end
+    results[c] = result
+  end
+  small_components = Vector{Int}()
+  for (c, component) in enumerate(components)
+    if length(component) == 1
+      tag = component[1]
+      most_likely_real_for_each_obs[tag] = (tag, 1.0)
+      prior[tag] = shares[c]
+    elseif length(component) >= PARALLEL_COMPONENT_SIZE
+      solve_component(c, true)
+    else
+      push!(small_components, c)
+    end
+  end
+  Threads.@threads for k in 1:length(small_components)
+    solve_component(small_components[k], false)
+  end
+  iterations = 0
+  final_change = 0.0
+  converged = true
+  for (c, result) in enumerate(results)
+    result === nothing && continue
+    iterations = max(iterations, result.iterations)
+    final_change = max(final_change, result.final_change * shares[c])
+    converged = converged && result.converged
+  end
+  return LDAResult(most_likely_real_for_each_obs, prior, iterations, time() - start_time, final_change, converged)
+end
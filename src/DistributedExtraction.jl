@@ -0,0 +1,173 @@
+#export ExtractionShard, plan_shards, extract_shard, merge_shard_outputs, extract_tags_distributed
+using Distributed
+using PORPID
+
+const DEFAULT_SHARD_BYTES = 256 * 1024 * 1024
+const SHARD_FOLDER = "shards"
+
+# Part of one input file: either all of it (byte_range=nothing, always the case for compressed files)
+# or a byte range that starts and ends at record boundaries
+struct ExtractionShard
+  index::Int
+  file_name::String
+  byte_range::Union{Nothing, UnitRange{Int}}
+end
+
+# Every file of the configuration as one shard, or as several if it is uncompressed and bigger than max_shard_bytes.
+# Shards are numbered in file order, then byte order, which is the order their outputs are merged in.
+function plan_shards(config::Configuration; max_shard_bytes=DEFAULT_SHARD_BYTES)
+  shards = Vector{ExtractionShard}()
+  for file_name in config.files
+    if filesize(file_name) <= max_shard_bytes || is_compressed(file_name)
+      push!(shards, ExtractionShard(length(shards) + 1, file_name, nothing))
+    else
+      for byte_range in record_aligned_ranges(file_name, config.filetype, max_shard_bytes)
+        push!(shards, ExtractionShard(length(shards) + 1, file_name, byte_range))
+      end
+    end
+  end
+  return shards
+end
+
+shard_output_folder(output_folder, shard::ExtractionShard) = joinpath(output_folder, SHARD_FOLDER, "shard_$(shard.index)")
+
+# Extracts the tags of one shard into its own output folder with a TagFileWriter. Runs wherever it is called,
+# including on a worker process. Returns its counts in the same form as write_to_file_count_to_dict, along with
+# what was measured of it (metrics.total) and prefilter_stats, or nothing for either if it wasn't given, so that
+# what is measured on a worker gets back to the caller.
+function extract_shard(shard::ExtractionShard, config::Configuration, output_folder; metrics=nothing, prefilter_stats=nothing, kwargs...)
+  kwargs = (metrics=metrics, prefilter_stats=prefilter_stats, kwargs...)
+  counts = Dict()
+  writer = TagFileWriter(output_folder=output_folder)
+  output_function(source_file_name, template, tag, output_sequence, score) = write_to_file_count_to_dict(writer, counts, source_file_name, template, tag, output_sequence, score)
+  if shard.byte_range === nothing
+    extract_tags_from_file(shard.file_name, config, output_function; kwargs...)
+  else
+    iterator = open_sequence_reader(shard.file_name, config.filetype, shard.byte_range)
+    try
+      extract_tags_from_reader(iterator, shard.file_name, config, output_function; kwargs...)
+    finally
+      close(iterator)
+    end
+  end
+  close(writer)
+  return counts, (metrics === nothing ? nothing : metrics.total), prefilter_stats
+end
+
+# Adds counts from one count dictionary (as made by count_to_dict) into another
+function merge_counts!(counts, shard_counts)
+  for (directory, tag_counts) in shard_counts
+    if !haskey(counts, directory)
+      counts[directory] = Dict()
+    end
+    for (tag, count) in tag_counts
+      counts[directory][tag] = get(counts[directory], tag, 0) + count
+    end
+  end
+  return counts
+end
+
+# Files under folder, relative to it, sorted
+function relative_files(folder)
+  files = Vector{String}()
+  for (root, directories, file_names) in walkdir(folder)
+    for file_name in file_names
+      push!(files, relpath(joinpath(root, file_name), folder))
+    end
+  end
+  return sort!(files)
+end
+
+# Appends every shard's output to output_folder in shard order, so the result doesn't depend on which worker finished first,
+# and then removes the shard folders. Tag files are appended to like write_to_file does. Tag manifests are added up,
+# unless the directory already had output without a manifest, which is then left without one (as TagFileWriter does).
+function merge_shard_outputs(shard_folders, output_folder)
+  shard_files = Vector{Tuple{String, String}}()
+  for shard_folder in shard_folders
+    if isdir(shard_folder)
+      append!(shard_files, [(shard_folder, relative_file) for relative_file in relative_files(shard_folder)])
+    end
+  end
+  # Whether a manifest can be kept up to date has to be decided before any tag files are added
+  manifests = Dict{String, Union{Nothing, Dict{String, TagManifestEntry}}}()
+  for (shard_folder, relative_file) in shard_files
+    output_file = joinpath(output_folder, relative_file)
+    if basename(relative_file) == TAG_MANIFEST_FILE_NAME && !haskey(manifests, output_file)
+      directory = dirname(output_file)
+      if isfile(output_file)
+        manifests[output_file] = read_tag_manifest(output_file)
+      elseif isdir(directory) && !isempty(readdir(directory))
+        manifests[output_file] = nothing
+      else
+        manifests[output_file] = Dict{String, TagManifestEntry}()
+      end
+    end
+  end
+  for (shard_folder, relative_file) in shard_files
+    shard_file = joinpath(shard_folder, relative_file)
+    output_file = joinpath(output_folder, relative_file)
+    if basename(relative_file) == TAG_MANIFEST_FILE_NAME
+      manifest = manifests[output_file]
+      manifest === nothing && continue
+      for (tag, entry) in read_tag_manifest(shard_file)
+        if haskey(manifest, tag)
+          manifest[tag].count += entry.count
+          manifest[tag].score_sum += entry.score_sum
+        else
+          manifest[tag] = entry
+        end
+      end
+    else
+      mkpath(dirname(output_file))
+      open(output_file, "a") do output
+        write(output, read(shard_file))
+      end
+    end
+  end
+  for (manifest_file_name, manifest) in manifests
+    manifest === nothing || write_tag_manifest(manifest_file_name, manifest)
+  end
+  for shard_folder in shard_folders
+    rm(shard_folder, recursive=true, force=true)
+  end
+end
+
+# extract_tags over worker processes: every file (or byte range of a big file, see plan_shards) is extracted by
+# extract_shard on one of the workers into its own folder, and the results are merged into output_folder by
+# merge_shard_outputs. Returns the merged counts. PORPID must be loaded on the workers (@everywhere using PORPID),
+# and they need to see the same file system, for the inputs and output_folder.
+# kwargs are passed on to extract_tags_from_file, e.g. threads for threads per worker.
+# metrics and prefilter_stats stay on the caller: every shard is measured on its own, and what it measured is added to
+# them here, with one final report per file.
+function extract_tags_distributed(config::Configuration; output_folder=OUTPUT_FOLDER, worker_ids=workers(), max_shard_bytes=DEFAULT_SHARD_BYTES,
+                                  metrics=nothing, prefilter_stats=nothing, kwargs...)
+  shards = plan_shards(config; max_shard_bytes=max_shard_bytes)
+  output_folder = abspath(output_folder)
+  shard_folders = [shard_output_folder(output_folder, shard) for shard in shards]
+  for shard_folder in shard_folders
+    rm(shard_folder, recursive=true, force=true)
+  end
+  measure, count_prefilter = metrics !== nothing, prefilter_stats !== nothing
+  shard_results = pmap(WorkerPool(worker_ids), shards, shard_folders) do shard, shard_folder
+    extract_shard(shard, config, shard_folder; metrics=measure ? ExtractionMetrics() : nothing,
+                  prefilter_stats=count_prefilter ? PrefilterStats() : nothing, kwargs...)
+  end
+  counts = Dict()
+  for (counts_of_shard, metrics_of_shard, stats_of_shard) in shard_results
+    merge_counts!(counts, counts_of_shard)
+    add_prefilter_stats!(prefilter_stats, stats_of_shard)
+  end
+  if metrics !== nothing
+    for file_name in unique(shard.file_name for shard in shards)
+      start_file!(metrics)
+      for (shard, (counts_of_shard, metrics_of_shard, stats_of_shard)) in zip(shards, shard_results)
+        shard.file_name == file_name && merge_metrics!(metrics.file, metrics_of_shard)
+      end
+      report_metrics(metrics; file_name=file_name, final=true)
+      finish_file!(metrics)
+    end
+  end
+  merge_shard_outputs(shard_folders, output_folder)
+  rm(joinpath(output_folder, SHARD_FOLDER), recursive=true, force=true)
+  return counts
+end
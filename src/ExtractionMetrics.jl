@@ -0,0 +1,194 @@
+#export ExtractionMetrics, JSONLinesSink, SummarySink, metrics_summary, report_metrics
+import JSON
+using PORPID
+
+const STAGES = [:parsing, :slicing, :alignment, :template_choice, :output]
+const SCORE_BIN_WIDTH = 1.0
+
+# What has been measured over some of the reads. Each is only ever written by one task at a time (a chunk's is handed
+# from the reader to a worker to the writer along with the chunk), so no atomics or locks are needed.
+# Times are in nanoseconds. Alignment is the time spent in extract_tag, template choice the rest of choosing a template.
+mutable struct PartitionMetrics
+  parsing_ns::UInt64
+  slicing_ns::UInt64
+  alignment_ns::UInt64
+  template_choice_ns::UInt64
+  output_ns::UInt64
+  reads::Int
+  dp_cells::Int
+  forward_wins::Int
+  reverse_wins::Int
+  no_tag::Int
+  rejects::Int
+  template_wins::Dict{String, Int}
+  score_histogram::Dict{Int, Int}
+  error_histogram::Dict{Int, Int}
+end
+
+PartitionMetrics() = PartitionMetrics(0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, Dict{String, Int}(), Dict{Int, Int}(), Dict{Int, Int}())
+
+# Timers, counters and histograms for extract_tags. Reads aligned in parallel are measured per chunk, and each chunk's
+# measurements are merged into file by the calling task as its reads are written. file starts afresh with every file,
+# and is added to total once the file is done.
+# Pass one as metrics=... to extract_tags (or extract_tags_from_file); without it nothing is measured.
+# sink is called as sink(summary, final) with the summary of what has been measured of the current file so far:
+# every report_every reads of it (if report_every > 0) and with final=true once it is done. A sink can be any function,
+# or a JSONLinesSink or SummarySink. metrics_summary gives the total over every file done.
+struct ExtractionMetrics
+  file::PartitionMetrics
+  total::PartitionMetrics
+  sink::Any
+  report_every::Int
+end
+
+ExtractionMetrics(; sink=nothing, report_every=0) = ExtractionMetrics(PartitionMetrics(), PartitionMetrics(), sink, report_every)
+
+file_metrics(metrics::ExtractionMetrics) = metrics.file
+file_metrics(metrics::Nothing) = nothing
+
+function start_file!(metrics::ExtractionMetrics)
+  reset_metrics!(metrics.file)
+  return metrics.file
+end
+start_file!(metrics::Nothing) = nothing
+
+function finish_file!(metrics::ExtractionMetrics)
+  merge_metrics!(metrics.total, metrics.file)
+  reset_metrics!(metrics.file)
+end
+finish_file!(metrics::Nothing) = nothing
+
+# A fresh PartitionMetrics for a chunk, if anything is being measured
+partition_metrics(metrics::ExtractionMetrics) = PartitionMetrics()
+partition_metrics(metrics::Nothing) = nothing
+
+# Writes every summary as a line of JSON
+struct JSONLinesSink
+  io::IO
+end
+
+function (sink::JSONLinesSink)(summary, final)
+  println(sink.io, JSON.json(summary))
+  flush(sink.io)
+end
+
+# Prints a readable summary once a file is done, ignoring intermediate reports
+struct SummarySink
+  io::IO
+end
+
+SummarySink() = SummarySink(stderr)
+
+function (sink::SummarySink)(summary, final)
+  final || return
+  io = sink.io
+  reads = summary["reads"]
+  println(io, "Extracted tags from $(reads) reads of $(summary["file"])")
+  println(io, "  Forward wins: $(summary["forward_wins"]), reverse wins: $(summary["reverse_wins"])")
+  println(io, "  NO_TAG: $(summary["no_tag"]) ($(round(100 * summary["no_tag_rate"], digits=2))%), ",
+              "REJECTS: $(summary["rejects"]) ($(round(100 * summary["rejects_rate"], digits=2))%)")
+  println(io, "  DP cells: $(summary["dp_cells"])")
+  for (name, count) in sort(collect(summary["template_wins"]), by=last, rev=true)
+    println(io, "  $(name): $(count)")
+  end
+  for stage in STAGES
+    println(io, "  $(stage): $(round(summary["seconds"][string(stage)], digits=3))s")
+  end
+end
+
+stage_ns(metrics::PartitionMetrics, stage::Symbol) = getfield(metrics, Symbol(stage, :_ns))
+
+# The outcome of aligning one read
+function record_read!(metrics::PartitionMetrics, template, tag, score, errors, is_reverse_complement)
+  metrics.reads += 1
+  if is_reverse_complement
+    metrics.reverse_wins += 1
+  else
+    metrics.forward_wins += 1
+  end
+  if tag == "NO_TAG"
+    metrics.no_tag += 1
+  elseif tag == "REJECTS"
+    metrics.rejects += 1
+  end
+  if template !== nothing
+    metrics.template_wins[template.name] = get(metrics.template_wins, template.name, 0) + 1
+  end
+  if isfinite(score)
+    bin = floor(Int, score / SCORE_BIN_WIDTH)
+    metrics.score_histogram[bin] = get(metrics.score_histogram, bin, 0) + 1
+  end
+  if errors !== nothing
+    metrics.error_histogram[errors] = get(metrics.error_histogram, errors, 0) + 1
+  end
+end
+
+# iterate, timed as parsing
+timed_iterate(metrics::Nothing, iterator, state...) = iterate(iterator, state...)
+
+function timed_iterate(metrics::PartitionMetrics, iterator, state...)
+  start = time_ns()
+  next = iterate(iterator, state...)
+  metrics.parsing_ns += time_ns() - start
+  return next
+end
+
+function add_counts!(total, counts)
+  for (key, count) in counts
+    total[string(key)] = get(total, string(key), 0) + count
+  end
+  return total
+end
+
+# Adds what partition has measured to total
+function merge_metrics!(total::PartitionMetrics, partition::PartitionMetrics)
+  for field in (:parsing_ns, :slicing_ns, :alignment_ns, :template_choice_ns, :output_ns,
+                :reads, :dp_cells, :forward_wins, :reverse_wins, :no_tag, :rejects)
+    setfield!(total, field, getfield(total, field) + getfield(partition, field))
+  end
+  merge!(+, total.template_wins, partition.template_wins)
+  merge!(+, total.score_histogram, partition.score_histogram)
+  merge!(+, total.error_histogram, partition.error_histogram)
+  return total
+end
+merge_metrics!(total::Nothing, partition::Nothing) = nothing
+
+function reset_metrics!(metrics::PartitionMetrics)
+  for field in (:parsing_ns, :slicing_ns, :alignment_ns, :template_choice_ns, :output_ns,
+                :reads, :dp_cells, :forward_wins, :reverse_wins, :no_tag, :rejects)
+    setfield!(metrics, field, zero(fieldtype(PartitionMetrics, field)))
+  end
+  empty!(metrics.template_wins)
+  empty!(metrics.score_histogram)
+  empty!(metrics.error_histogram)
+  return metrics
+end
+
+# Everything measured over the files done so far, as a Dict that JSON.json can write (see partition_summary)
+metrics_summary(metrics::ExtractionMetrics; file_name="") = partition_summary(metrics.total; file_name=file_name)
+
+# Everything measured in a PartitionMetrics, as a Dict that JSON.json can write.
+# Histogram keys are score bins (of width SCORE_BIN_WIDTH, by their lower bound) and error counts.
+function partition_summary(total::PartitionMetrics; file_name="")
+  summary = Dict{String, Any}("file" => file_name)
+  for counter in (:reads, :dp_cells, :forward_wins, :reverse_wins, :no_tag, :rejects)
+    summary[string(counter)] = getfield(total, counter)
+  end
+  reads = summary["reads"]
+  summary["no_tag_rate"] = reads > 0 ? summary["no_tag"] / reads : 0.0
+  summary["rejects_rate"] = reads > 0 ? summary["rejects"] / reads : 0.0
+  summary["seconds"] = Dict(string(stage) => stage_ns(total, stage) / 1e9 for stage in STAGES)
+  summary["template_wins"] = add_counts!(Dict{String, Int}(), total.template_wins)
+  summary["score_histogram"] = add_counts!(Dict{String, Int}(), total.score_histogram)
+  summary["error_histogram"] = add_counts!(Dict{String, Int}(), total.error_histogram)
+  return summary
+end
+
+# Passes a summary of the current file to the sink, if there is one. Called by the task that merges into metrics.file.
+function report_metrics(metrics::ExtractionMetrics; file_name="", final=false)
+  metrics.sink === nothing && return
+  summary = partition_summary(metrics.file; file_name=file_name)
+  summary["final"] = final
+  metrics.sink(summary, final)
+end
+report_metrics(metrics::Nothing; kwargs...) = nothing
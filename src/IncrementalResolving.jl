@@ -0,0 +1,244 @@
+#export ResolutionState, update_resolution_state!, write_resolution_state, read_resolution_state, resolve_tags_incrementally
+using PORPID
+
+const RESOLUTION_STATE_MAGIC = "PORPIDRS"
+const RESOLUTION_STATE_VERSION = UInt32(1)
+
+# Everything resolve_tags_in_dir works out for a library, kept between sequencing batches:
+# the tags in index order, their counts and files summed over every batch so far, the likelihood rows and the converged prior.
+# tag_to_index isn't stored, it is rebuilt from tags when the state is read.
+mutable struct ResolutionState
+  error_model::ErrorModel
+  recurse::Int
+  batches::Vector{String}
+  tags::Vector{String}
+  tag_to_index::Dict{String, Int32}
+  counts::Vector{Int64}
+  file_names::Vector{Vector{String}}
+  likelihoods::LikelihoodMatrix
+  prior::Vector{Float64}
+end
+
+ResolutionState(error_model::ErrorModel=PacBioErrorModel(), recurse=0) =
+    ResolutionState(error_model, recurse, Vector{String}(), Vector{String}(), Dict{String, Int32}(), Vector{Int64}(),
+                    Vector{Vector{String}}(), LikelihoodMatrix(Vector{Vector{Tuple{Int32, Float64}}}()), Vector{Float64}())
+
+function write_state_string(io, str)
+  write(io, htol(UInt32(sizeof(str))))
+  write(io, str)
+end
+
+read_state_string(io) = String(read(io, ltoh(read(io, UInt32))))
+
+function read_state_vector(io, T, n)
+  vector = Vector{T}(undef, n)
+  read!(io, vector)
+  return ltoh.(vector)
+end
+
+# Binary layout, all little-endian:
+#   magic ("PORPIDRS"), version (UInt32), the four error model rates (Float64), recurse (Int64),
+#   number of batches (UInt64) and their paths, number of tags (UInt64), then for each tag
+#   the tag, its count (Int64), number of files (UInt32) and their paths, then the prior (Float64 per tag)
+#   and the likelihoods as row starts (Int64, one more than there are tags), columns (Int32) and values (Float64).
+# Strings are stored as their length in bytes (UInt32) followed by the bytes.
+function write_resolution_state(state_file_name, state::ResolutionState)
+  open(state_file_name, "w") do io
+    write(io, RESOLUTION_STATE_MAGIC)
+    write(io, htol(RESOLUTION_STATE_VERSION))
+    model = state.error_model
+    write(io, htol.([model.error_rate, model.deletion_ratio, model.insertion_ratio, model.mutation_ratio]))
+    write(io, htol(Int64(state.recurse)))
+    write(io, htol(UInt64(length(state.batches))))
+    for batch in state.batches
+      write_state_string(io, batch)
+    end
+    write(io, htol(UInt64(length(state.tags))))
+    for index in 1:length(state.tags)
+      write_state_string(io, state.tags[index])
+      write(io, htol(state.counts[index]))
+      write(io, htol(UInt32(length(state.file_names[index]))))
+      for file_name in state.file_names[index]
+        write_state_string(io, file_name)
+      end
+    end
+    write(io, htol.(state.prior))
+    write(io, htol.(Vector{Int64}(state.likelihoods.row_starts)))
+    write(io, htol.(state.likelihoods.columns))
+    write(io, htol.(state.likelihoods.values))
+  end
+end
+
+function read_resolution_state(state_file_name)
+  open(state_file_name, "r") do io
+    if String(read(io, sizeof(RESOLUTION_STATE_MAGIC))) != RESOLUTION_STATE_MAGIC
+      error("$(state_file_name) is not a resolution state")
+    end
+    version = ltoh(read(io, UInt32))
+    if version != RESOLUTION_STATE_VERSION
+      error("$(state_file_name) has unsupported resolution state version $(version)")
+    end
+    state = ResolutionState(ErrorModel(read_state_vector(io, Float64, 4)...), ltoh(read(io, Int64)))
+    for i in 1:ltoh(read(io, UInt64))
+      push!(state.batches, read_state_string(io))
+    end
+    tag_count = ltoh(read(io, UInt64))
+    for index in 1:tag_count
+      tag = read_state_string(io)
+      push!(state.tags, tag)
+      state.tag_to_index[tag] = index
+      push!(state.counts, ltoh(read(io, Int64)))
+      push!(state.file_names, String[read_state_string(io) for i in 1:ltoh(read(io, UInt32))])
+    end
+    state.prior = read_state_vector(io, Float64, tag_count)
+    row_starts = Vector{Int}(read_state_vector(io, Int64, tag_count + 1))
+    columns = read_state_vector(io, Int32, row_starts[end] - 1)
+    values = read_state_vector(io, Float64, row_starts[end] - 1)
+    state.likelihoods = LikelihoodMatrix(row_starts, columns, values)
+    return state
+  end
+end
+
+# Indices of the tags in tag_to_index that are at most distance insertions, deletions or mutations away from tag
+function indices_within_distance(tag, tag_to_index::AbstractDict, distance)
+  indices = Set{Int32}()
+  visited = Set([tag])
+  frontier = [tag]
+  for step in 1:distance
+    next_frontier = Vector{typeof(tag)}()
+    for word in frontier
+      neighbors = [without(word, i) for i in 1:length(word)]
+      for c in "ACTG"
+        append!(neighbors, [insert_at(word, i, c) for i in 1:length(word) + 1])
+        append!(neighbors, [replace_at(word, i, c) for i in 1:length(word)])
+      end
+      for neighbor in neighbors
+        if !(neighbor in visited)
+          push!(visited, neighbor)
+          push!(next_frontier, neighbor)
+          if haskey(tag_to_index, neighbor)
+            push!(indices, tag_to_index[neighbor])
+          end
+        end
+      end
+    end
+    frontier = next_frontier
+  end
+  return indices
+end
+
+function indices_within_distance(tag::String, tag_to_index::Dict{String, Int32}, packed_to_index::Dict{PackedTag, Int32}, distance)
+  packed_tag = pack_tag(tag)
+  if packed_tag !== nothing && length(tag) + distance <= MAX_PACKED_TAG_LENGTH
+    return indices_within_distance(packed_tag, packed_to_index, distance)
+  end
+  return indices_within_distance(tag, tag_to_index, distance)
+end
+
+# Adds one batch of tag counts (and the files, relative to batch, that they came from) to the state.
+# New tags are given the next indices, and likelihood rows are only computed for them and for the existing tags within
+# recurse + 1 errors of one, as those are the only rows that gain an entry. Entries already in a row never change,
+# since the likelihood of one tag given another doesn't depend on what other tags there are.
+# The prior is extended to the new tags for warm starting EM. Returns the number of likelihood rows that were computed.
+function update_resolution_state!(state::ResolutionState, counts::AbstractDict, tag_file_names::AbstractDict=Dict{String, String}(); batch="")
+  old_tag_count = length(state.tags)
+  old_weight = sum(state.counts) + old_tag_count * DEFAULT_CONCENTRATION
+  batch_counts = zeros(Int64, old_tag_count)
+  for tag in sort!(collect(keys(counts)))
+    if !haskey(state.tag_to_index, tag)
+      push!(state.tags, tag)
+      state.tag_to_index[tag] = length(state.tags)
+      push!(state.counts, 0)
+      push!(state.file_names, Vector{String}())
+      push!(batch_counts, 0)
+    end
+    index = state.tag_to_index[tag]
+    state.counts[index] += counts[tag]
+    batch_counts[index] += counts[tag]
+    if haskey(tag_file_names, tag)
+      push!(state.file_names[index], joinpath(batch, tag_file_names[tag]))
+    end
+  end
+  push!(state.batches, batch)
+  tag_count = length(state.tags)
+
+  packed_to_index = pack_tag_index(state.tag_to_index)
+  to_compute = Set{Int32}(old_tag_count+1:tag_count)
+  if old_tag_count > 0
+    for index in old_tag_count+1:tag_count
+      for neighbor_index in indices_within_distance(state.tags[index], state.tag_to_index, packed_to_index, state.recurse + 1)
+        neighbor_index <= old_tag_count && push!(to_compute, neighbor_index)
+      end
+    end
+  end
+  recompute_likelihoods!(state, to_compute, packed_to_index)
+
+  # Warm start: existing tags keep the mass the previous prior gave them, and every tag gains its counts from this batch
+  new_weight = sum(state.counts) + tag_count * DEFAULT_CONCENTRATION
+  prior = Vector{Float64}(undef, tag_count)
+  for index in 1:tag_count
+    if index <= old_tag_count
+      prior[index] = (state.prior[index] * old_weight + batch_counts[index]) / new_weight
+    else
+      prior[index] = (state.counts[index] + DEFAULT_CONCENTRATION) / new_weight
+    end
+  end
+  state.prior = prior
+  return length(to_compute)
+end
+
+# Replaces the likelihood rows of the tags in to_compute, keeping every other row as it was
+function recompute_likelihoods!(state::ResolutionState, to_compute, packed_to_index=pack_tag_index(state.tag_to_index))
+  old_likelihoods = state.likelihoods
+  memoisation = NeighborCache{String}()
+  packed_memoisation = NeighborCache{PackedTag}()
+  deletion_index = state.recurse > 0 ? DeletionIndex(keys(packed_to_index), state.recurse) : nothing
+  rows = Vector{Vector{Tuple{Int32, Float64}}}(undef, length(state.tags))
+  for index in 1:length(state.tags)
+    if index in to_compute
+      rows[index] = prob_observed_tag_given_reals(state.tags[index], state.tag_to_index, packed_to_index,
+                                                  state.error_model, state.recurse, memoisation, packed_memoisation, deletion_index)
+    else
+      row = old_likelihoods.row_starts[index]:old_likelihoods.row_starts[index+1]-1
+      rows[index] = collect(zip(old_likelihoods.columns[row], old_likelihoods.values[row]))
+    end
+  end
+  state.likelihoods = LikelihoodMatrix(rows)
+end
+
+# Like resolve_tags_in_dir for one sequencing batch of a library, carrying on from state_file_name if it exists.
+# Prints the files of every tag that resolves to itself, across all batches so far, and saves the state for the next batch.
+function resolve_tags_incrementally(path, state_file_name, error_model=PacBioErrorModel(); recurse=0)
+  path = normpath(path)
+  state = isfile(state_file_name) ? read_resolution_state(state_file_name) : ResolutionState(error_model, recurse)
+  if path in state.batches
+    throw(ArgumentError("$(path) has already been added to $(state_file_name)"))
+  end
+  if state.error_model != error_model || state.recurse != recurse
+    println(stderr, "Error model changed since $(state_file_name) was saved, recomputing every likelihood...")
+    state.error_model = error_model
+    state.recurse = recurse
+    recompute_likelihoods!(state, Set{Int32}(1:length(state.tags)))
+  end
+  counts, tag_file_names = read_tag_counts(path)
+
+  println(stderr, "Updating likelihood distributions...")
+  computed_rows = update_resolution_state!(state, counts, tag_file_names; batch=path)
+  println(stderr, "Computed $(computed_rows) of $(length(state.tags)) likelihood rows")
+
+  println(stderr, "Iterating..."  )
+  result = sparse_LDA(state.likelihoods, state.counts; initial_prior=state.prior)
+  println(stderr, result)
+  state.prior = result.prior
+  write_resolution_state(state_file_name, state)
+
+  for observed_index in 1:length(result.most_likely_real_for_each_obs)
+    real_index, prob = result.most_likely_real_for_each_obs[observed_index]
+    if (prob > 0.99 && real_index == observed_index)
+      for file_name in state.file_names[real_index]
+        println(file_name)
+      end
+    end
+  end
+  return result
+end
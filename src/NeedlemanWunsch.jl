@@ -1,6 +1,6 @@
 using BioSequences
 using PORPID
-#export extract_tag
+#export extract_tag, alignment_score, AlignmentBuffer
 
 const STAR_INSERTION_SCORE = 0
 const SCORE_EPSILON = 1e-10
@@ -8,64 +8,163 @@ const SCORE_EPSILON = 1e-10
 #e.g. log(0.25) + log(0.01) + log(0.25) != log(0.25) + log(0.25) + log(0.01)
 
 @enum AlignOp OP_MATCH=1 OP_DEL=2 OP_INS=3
-function extract_tag(record::FASTQ.Record, states::AbstractVector{AbstractState})
-  seq = FASTQ.sequence(sequence)
-  quality_view = view(record.quality)
-  extract_tag(seq, quality_view, states)
+
+#Scratch space for extract_tag. The matrices only ever grow, so after the first few reads
+#no further allocation happens. Matrices are indexed [column, row] (read position, template state)
+#so that the inner loop over the read walks contiguous memory.
+#alignment_score only needs two rows of scores, previous_row and current_row.
+#cells counts every score matrix cell filled in with this buffer, for ExtractionMetrics.
+mutable struct AlignmentBuffer
+  scores::Matrix{Float64}
+  ops::Matrix{AlignOp}
+  row_start::Vector{Int}
+  row_end::Vector{Int}
+  previous_row::Vector{Float64}
+  current_row::Vector{Float64}
+  cells::Int
 end
 
-function extract_tag(seq::BioSequence{DNAAlphabet{4}}, quality, states::AbstractVector{AbstractState})
-  rows = length(states)
-  cols = length(seq) + 1 #first column is for 'before first symbol' position
-  scores = zeros(Float64, rows, cols)
-  ops = Array{AlignOp}(undef, rows, cols)
-  #Left-most column contains all deletions
-  for r = 2:rows
-    if typeof(states[r]) <: AbstractRepeatingAnyState
-      scores[r,1] = scores[r-1,1] #Deletion of RepeatingAnyState is free
-    else
-      scores[r,1] = scores[r-1,1] + L_PROBABILITY_OF_DELETION
+AlignmentBuffer() = AlignmentBuffer(Matrix{Float64}(undef, 0, 0), Matrix{AlignOp}(undef, 0, 0), Vector{Int}(), Vector{Int}(),
+                                    Vector{Float64}(), Vector{Float64}(), 0)
+
+#Default buffer for callers that don't pass one: one per task, kept in task local storage, so that it is never shared
+#even when tasks move between threads. Code that aligns in parallel makes a buffer per partition and passes it explicitly.
+task_alignment_buffer() = get!(AlignmentBuffer, task_local_storage(), :porpid_alignment_buffer)::AlignmentBuffer
+
+function ensure_capacity!(buffer::AlignmentBuffer, rows, cols)
+  if size(buffer.scores, 1) < cols || size(buffer.scores, 2) < rows
+    new_cols = max(cols, size(buffer.scores, 1))
+    new_rows = max(rows, size(buffer.scores, 2))
+    buffer.scores = Matrix{Float64}(undef, new_cols, new_rows)
+    buffer.ops = Matrix{AlignOp}(undef, new_cols, new_rows)
+  end
+  ensure_row_capacity!(buffer, rows, cols)
+end
+
+function ensure_row_capacity!(buffer::AlignmentBuffer, rows, cols)
+  if length(buffer.row_start) < rows
+    resize!(buffer.row_start, rows)
+    resize!(buffer.row_end, rows)
+  end
+  if length(buffer.current_row) < cols
+    resize!(buffer.previous_row, cols)
+    resize!(buffer.current_row, cols)
+  end
+end
+
+#Score of a cell and the operation it comes from, given the scores of reaching it by each operation
+#(for a RepeatingAnyState, matchscore is ignored). Shared by extract_tag and alignment_score so that they always agree.
+@inline function cell_score(is_repeating_any, matchscore, left, above)
+  if is_repeating_any
+    #RepeatingAnyState represents any number of insertions at star_insertion_score or can be freely deleted
+    inscore = left + STAR_INSERTION_SCORE
+    delscore = above
+    if delscore > inscore - SCORE_EPSILON
+      return delscore, OP_DEL
+    end
+    return inscore, OP_INS
+  end
+  inscore = left + L_PROBABILITY_OF_INSERTION
+  delscore = above + L_PROBABILITY_OF_DELETION
+  #The order of operations is significant in the case of multiple paths with the same score
+  #In this case, a single path is chosen based on operation order
+  #Currently matching is done first (when backtracing) so that insertions in the tag section are aligned to N symbols
+  #If early insertion is preferred over early matching, such insertions might be aligned to known symbols in the template instead
+  if matchscore > delscore - SCORE_EPSILON && matchscore > inscore - SCORE_EPSILON
+    return matchscore, OP_MATCH
+  elseif inscore > delscore - SCORE_EPSILON
+    return inscore, OP_INS
+  end
+  return delscore, OP_DEL
+end
+
+#Works out which columns of each row get filled in.
+#Without a band (band_width < 0) every row spans the whole read.
+#With a band, a row may only stray band_width columns from the diagonal. A RepeatingAnyState can absorb
+#any number of symbols, so it widens the diagonal by max_star_gap (or up to the end of the read if max_star_gap < 0).
+#The last row always extends to the end of the read, so trailing symbols can still be aligned as insertions.
+function alignment_windows!(buffer::AlignmentBuffer, template::CompiledTemplate, rows, cols, band_width, max_star_gap)
+  if band_width < 0
+    for r = 1:rows
+      buffer.row_start[r] = 1
+      buffer.row_end[r] = cols
     end
-    ops[r,1] = OP_DEL
+    return
   end
+  low_diagonal = 1
+  high_diagonal = 1
+  for r = 1:rows
+    if r > 1
+      if template.kinds[r] == STATE_ANY
+        high_diagonal = max_star_gap < 0 ? cols : high_diagonal + max_star_gap
+      else
+        low_diagonal += 1
+        high_diagonal += 1
+      end
+    end
+    row_start = min(cols, max(1, low_diagonal - band_width))
+    buffer.row_start[r] = row_start
+    buffer.row_end[r] = r == rows ? cols : min(cols, max(row_start, high_diagonal + band_width))
+  end
+end
+
+function extract_tag(record::FASTQ.Record, states::Union{AbstractVector{<:AbstractState}, CompiledTemplate}, buffer::AlignmentBuffer=task_alignment_buffer(); kwargs...)
+  seq = FASTQ.sequence(record)
+  quality = FASTQ.quality(record)
+  extract_tag(seq, quality, states, buffer; kwargs...)
+end
+
+#Compiles the states on every call; templates that are used more than once should be compiled once (Template does this)
+function extract_tag(seq::BioSequence{DNAAlphabet{4}}, quality, states::AbstractVector{<:AbstractState},
+                     buffer::AlignmentBuffer=task_alignment_buffer(); kwargs...)
+  extract_tag(seq, quality, CompiledTemplate(states), buffer; kwargs...)
+end
+
+function extract_tag(seq::BioSequence{DNAAlphabet{4}}, quality, template::CompiledTemplate,
+                     buffer::AlignmentBuffer=task_alignment_buffer(); band_width=-1, max_star_gap=-1, score_floor=-Inf)
+  rows = length(template)
+  cols = length(seq) + 1 #first column is for 'before first symbol' position
+  kinds = template.kinds
+  values = template.values
+  ensure_capacity!(buffer, rows, cols)
+  alignment_windows!(buffer, template, rows, cols, band_width, max_star_gap)
+  scores = buffer.scores
+  ops = buffer.ops
+  row_start = buffer.row_start
+  row_end = buffer.row_end
   #Top row contains all insertions
-  for c = 2:cols
-    scores[1,c] = scores[1,c-1] + L_PROBABILITY_OF_INSERTION
-    ops[1,c] = OP_INS
+  scores[1,1] = 0.0
+  for c = 2:row_end[1]
+    scores[c,1] = scores[c-1,1] + L_PROBABILITY_OF_INSERTION
+    ops[c,1] = OP_INS
   end
-  #Fill in scores for the rest of the matrix
+  buffer.cells += row_end[1]
+  #Fill in scores for the rest of the matrix, treating cells outside of the previous row's window as unreachable
+  #The left-most column only has deletions available, so it ends up containing all deletions
   for r = 2:rows
-    for c = 2:cols
-      currentstate = states[r]
-      if typeof(currentstate) <: AbstractRepeatingAnyState
-        #RepeatingAnyState represents any number of insertions at star_insertion_score or can be freely deleted
-        inscore = scores[r, c-1] + STAR_INSERTION_SCORE
-        delscore = scores[r-1, c]
-        if delscore > inscore - SCORE_EPSILON
-          scores[r,c] = delscore
-          ops[r,c] = OP_DEL
-        else
-          scores[r,c] = inscore
-          ops[r,c] = OP_INS
-        end
+    is_repeating_any = kinds[r] == STATE_ANY
+    value = values[r]
+    previous_start = row_start[r-1]
+    previous_end = row_end[r-1]
+    buffer.cells += row_end[r] - row_start[r] + 1
+    for c = row_start[r]:row_end[r]
+      above = previous_start <= c <= previous_end ? scores[c,r-1] : -Inf
+      left = c > row_start[r] ? scores[c-1,r] : -Inf
+      if !is_repeating_any && c > 1 && previous_start <= c-1 <= previous_end
+        matchscore = scores[c-1,r-1] + log_emission_prob(value, seq[c-1], quality[c-1])
       else
-        matchscore = scores[r-1,c-1] + log(prob(currentstate.value, seq[c-1], phred_score_to_prob(quality[c-1])))
-        inscore = scores[r,c-1] + L_PROBABILITY_OF_INSERTION
-        delscore = scores[r-1,c] + L_PROBABILITY_OF_DELETION
-        #The order of operations is significant in the case of multiple paths with the same score
-        #In this case, a single path is chosen based on operation order
-        #Currently matching is done first (when backtracing) so that insertions in the tag section are aligned to N symbols
-        #If early insertion is preferred over early matching, such insertions might be aligned to known symbols in the template instead
-        if matchscore > delscore - SCORE_EPSILON && matchscore > inscore - SCORE_EPSILON
-          scores[r,c] = matchscore
-          ops[r,c] = OP_MATCH
-        elseif inscore > delscore - SCORE_EPSILON
-          scores[r,c] = inscore
-          ops[r,c] = OP_INS
-        else
-          scores[r,c] = delscore
-          ops[r,c] = OP_DEL
-        end
+        matchscore = -Inf
+      end
+      scores[c,r], ops[c,r] = cell_score(is_repeating_any, matchscore, left, above)
+    end
+    #With a score_floor, the alignment is abandoned (and scored -Inf) as soon as it can no longer reach score_floor
+    if score_floor > -Inf && r < rows
+      row_best = -Inf
+      for c = row_start[r]:row_end[r]
+        row_best = max(row_best, scores[c,r])
+      end
+      if row_best + template.remaining_bound[r] < score_floor - SCORE_EPSILON
+        return (-Inf, DNASequence(), 0)
       end
     end
   end
@@ -77,38 +176,87 @@ function extract_tag(seq::BioSequence{DNAAlphabet{4}}, quality, states::Abstract
   c = cols
   while r > 1 || c > 1
     #Debugging print: path and operations
-    #print("r=$r\tc=$c\t$(ops[r,c])$(ops[r,c]!=OP_MATCH ? "\t\t" : "\t")Obs=$(c > 1 ? string(seq[c-1]) : "0")")
-    #print("\tState=$(typeof(states[r]) <: AbstractRepeatingAnyState ? "*" : (typeof(states[r]) <: AbstractStartingState ? "0" : string(states[r].value)))")
-    #print("\t\tScore=$(round(scores[r,c], 2))\n")
-    if ops[r,c] == OP_MATCH
-      if typeof(states[r]) <: AbstractBarcodeState
+    #print("r=$r\tc=$c\t$(ops[c,r])$(ops[c,r]!=OP_MATCH ? "\t\t" : "\t")Obs=$(c > 1 ? string(seq[c-1]) : "0")")
+    #print("\tState=$(kinds[r] == STATE_ANY ? "*" : (kinds[r] == STATE_START ? "0" : string(values[r])))")
+    #print("\t\tScore=$(round(scores[c,r], 2))\n")
+    if ops[c,r] == OP_MATCH
+      if kinds[r] == STATE_BARCODE
         pushfirst!(tag, Char(seq[c-1]))
       end
-      if typeof(states[r]) <: AbstractObservableState
-        if !(iscompatible(seq[c-1], states[r].value))
+      if kinds[r] >= STATE_OBSERVABLE
+        if !(iscompatible(seq[c-1], values[r]))
           errors = errors + 1
         end
       end
       r = r - 1
       c = c - 1
-    elseif ops[r,c] == OP_INS
+    elseif ops[c,r] == OP_INS
       #Include in the tag any insertions that are aligned to an N or aligned adjacent to an N
       #No need to check states[r-1] as long as matching is done before insertion, because any insertions to the right of a series of Ns will
       #  be matched to the Ns and the symbols aligned to the left of the Ns will be considered insertions instead (and included in the tag)
-      if typeof(states[r]) <: AbstractBarcodeState ||
-          (r < rows && typeof(states[r+1]) <: AbstractBarcodeState)
+      if template.insertion_in_tag[r]
         pushfirst!(tag, Char(seq[c-1]))
       end
-      if !(typeof(states[r]) <: AbstractRepeatingAnyState)
+      if kinds[r] != STATE_ANY
         errors = errors + 1
       end
       c = c - 1
     else #OP_DEL
-      if !(typeof(states[r]) <: AbstractRepeatingAnyState)
+      if kinds[r] != STATE_ANY
         errors = errors + 1
       end
       r = r - 1
     end
   end
-  return (scores[rows,cols], tag, errors)
+  return (scores[cols,rows], tag, errors)
+end
+
+#The score extract_tag would give, filling in the same cells in the same way but keeping only two rows of scores
+#and no operations, so it needs memory proportional to the read rather than the matrix, and does no traceback.
+#Used to rank templates, so that only the best one has to be aligned in full.
+function alignment_score(seq::BioSequence{DNAAlphabet{4}}, quality, template::CompiledTemplate,
+                         buffer::AlignmentBuffer=task_alignment_buffer(); band_width=-1, max_star_gap=-1, score_floor=-Inf)
+  rows = length(template)
+  cols = length(seq) + 1
+  kinds = template.kinds
+  values = template.values
+  ensure_row_capacity!(buffer, rows, cols)
+  alignment_windows!(buffer, template, rows, cols, band_width, max_star_gap)
+  previous_row = buffer.previous_row
+  current_row = buffer.current_row
+  row_start = buffer.row_start
+  row_end = buffer.row_end
+  current_row[1] = 0.0
+  for c = 2:row_end[1]
+    current_row[c] = current_row[c-1] + L_PROBABILITY_OF_INSERTION
+  end
+  buffer.cells += row_end[1]
+  for r = 2:rows
+    previous_row, current_row = current_row, previous_row
+    is_repeating_any = kinds[r] == STATE_ANY
+    value = values[r]
+    previous_start = row_start[r-1]
+    previous_end = row_end[r-1]
+    buffer.cells += row_end[r] - row_start[r] + 1
+    for c = row_start[r]:row_end[r]
+      above = previous_start <= c <= previous_end ? previous_row[c] : -Inf
+      left = c > row_start[r] ? current_row[c-1] : -Inf
+      if !is_repeating_any && c > 1 && previous_start <= c-1 <= previous_end
+        matchscore = previous_row[c-1] + log_emission_prob(value, seq[c-1], quality[c-1])
+      else
+        matchscore = -Inf
+      end
+      current_row[c] = cell_score(is_repeating_any, matchscore, left, above)[1]
+    end
+    if score_floor > -Inf && r < rows
+      row_best = -Inf
+      for c = row_start[r]:row_end[r]
+        row_best = max(row_best, current_row[c])
+      end
+      if row_best + template.remaining_bound[r] < score_floor - SCORE_EPSILON
+        return -Inf
+      end
+    end
+  end
+  return current_row[cols]
 end
@@ -1,5 +1,5 @@
 using BioSequences
-#export Observation, phred_score_to_prob, prob
+#export Observation, phred_score_to_prob, prob, log_emission_prob
 #export PROBABILITY_OF_INSERTION, PROBABILITY_OF_DELETION, L_PROBABILITY_OF_INSERTION, L_PROBABILITY_OF_DELETION
 #export L_PROBABILITY_PER_EXTRA_BASE, L_PROBABILITY_OF_NORMAL_TRANSITION
 
@@ -52,3 +52,19 @@ end
 function prob(expected::DNA, observed::DNA, prob_observed::AbstractFloat)
   return prob(expected, 1.0, observed, prob_observed)
 end
+
+const MAX_PHRED_SCORE = 93
+#log(prob(expected, observed, phred_score_to_prob(phred))) for every DNA code and phred score,
+#indexed by [expected code + 1, observed code + 1, phred + 1]
+const L_EMISSION_TABLE = [log(prob(reinterpret(DNA, UInt8(expected)), reinterpret(DNA, UInt8(observed)), phred_score_to_prob(phred)))
+                          for expected in 0:15, observed in 0:15, phred in 0:MAX_PHRED_SCORE]
+
+#Best log_emission_prob achievable for each expected DNA code, whatever is observed
+const L_MAX_EMISSION = [maximum(x -> isnan(x) ? -Inf : x, view(L_EMISSION_TABLE, expected, :, :)) for expected in 1:16]
+
+@inline function log_emission_prob(expected::DNA, observed::DNA, phred::Integer)
+  if 0 <= phred <= MAX_PHRED_SCORE
+    return @inbounds L_EMISSION_TABLE[convert(UInt8, expected) + 1, convert(UInt8, observed) + 1, phred + 1]
+  end
+  return log(prob(expected, observed, phred_score_to_prob(phred)))
+end
@@ -10,15 +10,23 @@ export # States
     ObservableState,
     AbstractBarcodeState,
     BarcodeState,
-    string_to_state_array
+    string_to_state_array,
+    CompiledTemplate
 export # LDA
-    LDA
+    LDA,
+    LikelihoodMatrix,
+    LDAResult,
+    sparse_LDA,
+    components_LDA
 export # NeedlemanWunsch
-    extract_tag
+    extract_tag,
+    alignment_score,
+    AlignmentBuffer
 export # Observations
     Observation,
     phred_score_to_prob,
     prob,
+    log_emission_prob,
     PROBABILITY_OF_INSERTION,
     PROBABILITY_OF_DELETION,
     L_PROBABILITY_OF_INSERTION,
@@ -30,17 +38,53 @@ export # PORPIDConfig
     Template,
     fasta,
     fastq,
+    auto,
     load_config_from_json,
     extract_tags,
     extract_tags_from_file,
     sequence_to_observation,
     best_of_forward_and_reverse,
     slice_sequence
+export # SequenceInput
+    open_sequence_reader,
+    detect_file_type
+export # ReadViews
+    ConstantQuality,
+    QualityView,
+    OrientedRecord
+export # TemplatePrefilter
+    TemplatePrefilter,
+    PrefilterStats
+export # ExtractionMetrics
+    ExtractionMetrics,
+    JSONLinesSink,
+    SummarySink,
+    metrics_summary,
+    report_metrics
+export # DistributedExtraction
+    ExtractionShard,
+    plan_shards,
+    extract_shard,
+    merge_shard_outputs,
+    extract_tags_distributed
+export # TagManifest
+    TagManifestEntry,
+    write_tag_manifest,
+    read_tag_manifest
+export # TagFileWriter
+    TagFileWriter,
+    write_to_tag_file_writer
 export # Resolvng
     resolve_tags_in_dir,
     tag_index_mapping,
     prob_observed_tags_given_reals,
     index_counts
+export # IncrementalResolving
+    ResolutionState,
+    update_resolution_state!,
+    write_resolution_state,
+    read_resolution_state,
+    resolve_tags_incrementally
 
 using BioSequences
 
@@ -49,7 +93,15 @@ include("CustomLDA.jl")
 include("NeedlemanWunsch.jl")
 include("Observations.jl")
 include("PORPIDConfig.jl")
+include("SequenceInput.jl")
+include("ReadViews.jl")
+include("TemplatePrefilter.jl")
+include("ExtractionMetrics.jl")
+include("TagManifest.jl")
+include("TagFileWriter.jl")
 include("PORPIDMethods.jl")
+include("DistributedExtraction.jl")
 include("Resolving.jl")
+include("IncrementalResolving.jl")
 
 end # module
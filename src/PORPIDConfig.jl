@@ -1,34 +1,45 @@
-#export Configuration, Template, fasta, fastq, load_config_from_json
+#export Configuration, Template, fasta, fastq, auto, load_config_from_json
 import JSON
 using PORPID
 
+# reference is kept as states for building and inspecting templates, compiled is what gets aligned against
 struct Template
-  name::AbstractString
+  name::String
   reference::Vector{AbstractState}
+  compiled::CompiledTemplate
 end
 
+Template(name::AbstractString, reference::AbstractVector{<:AbstractState}) =
+    Template(String(name), reference, CompiledTemplate(reference))
+
 Template(name::AbstractString, reference::AbstractString) =
     Template(name, string_to_state_array(reference))
 
-@enum FileType fastq=1 fasta=2
+# auto finds the file type of each file from its extension or first character (see detect_file_type)
+@enum FileType fastq=1 fasta=2 auto=3
 
 function Base.convert(::Type{FileType}, str_repr::AbstractString)
-  return (lowercase(str_repr) == "fasta") ? fasta : fastq
+  str_repr = lowercase(str_repr)
+  return str_repr == "fasta" ? fasta : str_repr == "auto" ? auto : fastq
 end
 
 mutable struct Configuration
-  files::Vector{AbstractString}
+  files::Vector{String}
   filetype::FileType
-  start_inclusive::Integer
-  reverse_start_inclusive::Integer
-  end_inclusive::Integer
-  reverse_end_inclusive::Integer
-  max_allowed_errors::Integer
+  start_inclusive::Int
+  reverse_start_inclusive::Int
+  end_inclusive::Int
+  reverse_end_inclusive::Int
+  max_allowed_errors::Int
   try_reverse_complement::Bool
   templates::Vector{Template}
+  band_width::Int
+  max_star_gap::Int
+  prefilter_seed_length::Int
+  prune_alignments::Bool
 end
 
-Configuration() = Configuration(Vector{AbstractString}(undef, 0), fastq, -1, -1, -1, -1, 4, false, Vector{Template}(undef, 0))
+Configuration() = Configuration(Vector{String}(undef, 0), fastq, -1, -1, -1, -1, 4, false, Vector{Template}(undef, 0), -1, -1, -1, false)
 
 function load_config_from_json(json_file_location)
   config = Configuration()
@@ -43,6 +54,10 @@ function load_config_from_json(json_file_location)
   config.end_inclusive = get(params, "end_inclusive", config.end_inclusive)
   config.reverse_end_inclusive = get(params, "reverse_end_inclusive", config.reverse_end_inclusive)
   config.max_allowed_errors = get(params, "max_allowed_errors", config.max_allowed_errors)
+  config.band_width = get(params, "band_width", config.band_width)
+  config.max_star_gap = get(params, "max_star_gap", config.max_star_gap)
+  config.prefilter_seed_length = get(params, "prefilter_seed_length", config.prefilter_seed_length)
+  config.prune_alignments = get(params, "prune_alignments", config.prune_alignments)
   for json_template in params["templates"]
     template = Template(json_template["name"], json_template["reference"])
     push!(config.templates, template)
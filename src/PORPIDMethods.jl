@@ -6,73 +6,225 @@ const DEFAULT_MAX_ERRORS = 2
 const DEFAULT_MAX_FILE_DESCRIPTORS = 1024
 const OUTPUT_FOLDER = "output"
 const DEFAULT_QUALITY = 30
+const DEFAULT_CHUNK_SIZE = 1024
 
-function extract_tags(config::Configuration, output_function)
+# output_function is called as output_function(source_file_name, template, tag, record, score) for every read.
+# record is an OrientedRecord (see ReadViews.jl), not a FASTQ.Record: it has the FASTQ accessors and can be written
+# with a FASTQ.Writer, and FASTQ.Record(record) converts it for anything else that needs a FASTQ.Record.
+function extract_tags(config::Configuration, output_function; kwargs...)
   # Get configuration from json
   for file_name in config.files
-    extract_tags_from_file(file_name, config, output_function)
+    extract_tags_from_file(file_name, config, output_function; kwargs...)
   end
 end
 
 # For every file
-function extract_tags_from_file(file_name, config, output_function; print_every=0, print_callback=x->println("Processed $(x) sequences"), ignore_phreds_for_tag_extraction = true)
-  start_i = config.start_inclusive
-  r_start_i = config.reverse_start_inclusive
-  end_i = config.end_inclusive
-  r_end_i = config.reverse_end_inclusive
-  try_reverse_complement = config.try_reverse_complement
-  if config.filetype == fastq
-    iterator = open(FASTQ.Reader, file_name)
-  else
-    iterator = open(FASTA.Reader, file_name)
+# With threads > 1, reads are parsed chunk_size at a time on one task, aligned on `threads` worker tasks (each with its
+# own alignment buffer) and written by the calling task, all at the same time, connected by Channels.
+# output_function is always called from the calling task, either in input order (ordered=true) or chunk by chunk
+# in the order in which the chunks finished aligning (ordered=false).
+# When config.prefilter_seed_length > 0, templates are only aligned if they share enough exact seeds with the read.
+# Counts of skipped and abandoned alignments are added to prefilter_stats, if given.
+# Files may be gzip or bgzip compressed (see open_sequence_reader).
+# Stage timings, counters and histograms are gathered into metrics, if given, and reported per file (see ExtractionMetrics).
+function extract_tags_from_file(file_name, config, output_function; threads=1, kwargs...)
+  iterator = open_sequence_reader(file_name, config.filetype; threads=threads)
+  try
+    extract_tags_from_reader(iterator, file_name, config, output_function; threads=threads, kwargs...)
+  finally
+    close(iterator)
   end
+end
+
+# What extract_tag_from_record returns for a record of type R
+extraction_result_type(::Type{R}) where R = Tuple{Union{Nothing, Template}, String, OrientedRecord{R}, Float64}
+extraction_result_type(::Type{Any}) = Any
+
+# The work of extract_tags_from_file on an already open reader, whose records are reported as coming from file_name
+function extract_tags_from_reader(iterator, file_name, config, output_function; print_every=0, print_callback=x->println("Processed $(x) sequences"),
+                                  ignore_phreds_for_tag_extraction = true, threads=1, chunk_size=DEFAULT_CHUNK_SIZE, ordered=true, prefilter_stats=nothing,
+                                  metrics=nothing)
+  prefilter = config.prefilter_seed_length > 0 ? TemplatePrefilter(config.templates, config.prefilter_seed_length) : nothing
+  # Output happens on the calling task, which is the only one to write to the file's metrics
+  caller_metrics = start_file!(metrics)
   i = 0
-  for sequence in iterator
-    if typeof(sequence) <: FASTA.Record
-      # Could do this is the slice_sequence method, but if we want to print out the sequences, it's best to have it here
-      sequence = FASTQ.Record(FASTA.identifier(sequence),
-                              FASTA.description(sequence),
-                              FASTA.sequence(sequence),
-                              fill(Int8(DEFAULT_QUALITY), length(FASTA.sequence(sequence))))
-    end
-    forward_seq, forward_quality = slice_sequence(sequence, start_i, r_start_i, end_i, r_end_i, false)
-    if ignore_phreds_for_tag_extraction
-      forward_quality = fill(Int8(DEFAULT_QUALITY),length(forward_quality)) #Disabling quality for NNNN matching...
+  if threads <= 1
+    next = timed_iterate(caller_metrics, iterator)
+    while next !== nothing
+      sequence, state = next
+      best_template, tag, sequence, best_score = extract_tag_from_record(sequence, config, ignore_phreds_for_tag_extraction;
+                                                                         prefilter=prefilter, stats=prefilter_stats, metrics=caller_metrics)
+      timed_output(caller_metrics, output_function, file_name, best_template, tag, sequence, best_score)
+      i += 1
+      if print_every > 0 && i % print_every == 0
+        print_callback(i)
+      end
+      if metrics !== nothing && metrics.report_every > 0 && i % metrics.report_every == 0
+        report_metrics(metrics; file_name=file_name)
+      end
+      next = timed_iterate(caller_metrics, iterator, state)
     end
-    is_reverse_complement = false
-    if try_reverse_complement
-      reverse_seq, reverse_quality = slice_sequence(sequence, start_i, r_start_i, end_i, r_end_i, true)
-      if ignore_phreds_for_tag_extraction
-        reverse_quality = fill(Int8(DEFAULT_QUALITY),length(reverse_quality)) #Disabling quality for NNNN matching...
+  else
+    R = eltype(iterator)
+    result_type = extraction_result_type(R)
+    # Every chunk carries its own metrics (or nothing), from the reader to a worker to here, where they are merged
+    chunk_metrics_type = typeof(partition_metrics(metrics))
+    # Both channels hold a few chunks per worker, so that no stage waits on another as long as it keeps up
+    producer = Ref{Task}()
+    chunks = Channel{Tuple{Int, Vector{R}, chunk_metrics_type}}(chunks -> read_chunks(chunks, iterator, R, chunk_size, metrics), 2 * threads;
+                                                                spawn=true, taskref=producer)
+    aligned = Channel{Tuple{Int, Vector{result_type}, chunk_metrics_type}}(2 * threads)
+    workers = [Threads.@spawn align_chunks(chunks, aligned, result_type, config, ignore_phreds_for_tag_extraction;
+                                           prefilter=prefilter, stats=prefilter_stats) for worker in 1:threads]
+    closer = @async close_when_done(aligned, workers)
+    try
+      pending = Dict{Int, Tuple{Vector{result_type}, chunk_metrics_type}}()
+      next_chunk = 1
+      for (chunk_index, results, chunk_metrics) in aligned
+        pending[chunk_index] = (results, chunk_metrics)
+        # Unordered, every chunk is written as soon as it arrives, so pending never holds more than this one
+        ordered || (next_chunk = chunk_index)
+        while haskey(pending, next_chunk)
+          results, chunk_metrics = pop!(pending, next_chunk)
+          merge_metrics!(caller_metrics, chunk_metrics)
+          for (best_template, tag, sequence, best_score) in results
+            timed_output(caller_metrics, output_function, file_name, best_template, tag, sequence, best_score)
+            i += 1
+            if print_every > 0 && i % print_every == 0
+              print_callback(i)
+            end
+            if metrics !== nothing && metrics.report_every > 0 && i % metrics.report_every == 0
+              report_metrics(metrics; file_name=file_name)
+            end
+          end
+          next_chunk += 1
+        end
       end
-      best_score, best_template, best_tag, best_errors, is_reverse_complement = best_of_forward_and_reverse(forward_seq, forward_quality, reverse_seq, reverse_quality, config.templates)
-    else
-      best_score, best_template, best_tag, best_errors = choose_best_template(forward_seq, forward_quality, config.templates)
+    finally
+      # Stops every task early if anything failed, and makes sure nothing still reads from iterator once this returns
+      close(chunks)
+      close(aligned)
+      foreach(wait_quietly, [producer[]; workers; closer])
     end
-    if is_reverse_complement
-      sequence.data[sequence.sequence] = Vector{UInt8}(String(reverse_complement(FASTQ.sequence(sequence))))
-      sequence.data[sequence.quality] = reverse(sequence.data[sequence.quality])
+  end
+  report_metrics(metrics; file_name=file_name, final=true)
+  finish_file!(metrics)
+end
+
+timed_output(metrics::Nothing, output_function, args...) = output_function(args...)
+
+function timed_output(metrics::PartitionMetrics, output_function, args...)
+  start = time_ns()
+  output_function(args...)
+  metrics.output_ns += time_ns() - start
+end
+
+# Producer of extract_tags_from_reader: parses chunks of chunk_size records, numbered from 1, until the reader is done.
+# Each chunk gets metrics of its own, which start out with the time spent parsing it.
+function read_chunks(chunks, iterator, R, chunk_size, metrics)
+  chunk_index = 0
+  chunk, chunk_metrics = R[], partition_metrics(metrics)
+  next = timed_iterate(chunk_metrics, iterator)
+  while next !== nothing
+    record, state = next
+    push!(chunk, record)
+    if length(chunk) == chunk_size
+      chunk_index += 1
+      put!(chunks, (chunk_index, chunk, chunk_metrics))
+      chunk, chunk_metrics = R[], partition_metrics(metrics)
     end
-    tag = length(best_tag) > 0 ? string(best_tag) : "NO_TAG"
-    tag = best_errors <= config.max_allowed_errors ? tag : "REJECTS"
-    output_function(file_name, best_template, tag, sequence, best_score)
-    i += 1
-    if print_every > 0 && i % print_every == 0
-      print_callback(i)
+    next = timed_iterate(chunk_metrics, iterator, state)
+  end
+  isempty(chunk) || put!(chunks, (chunk_index + 1, chunk, chunk_metrics))
+end
+
+# Worker of extract_tags_from_reader: aligns chunks until there are none left, with an alignment buffer of its own
+function align_chunks(chunks, aligned, result_type, config, ignore_phreds_for_tag_extraction; kwargs...)
+  buffer = AlignmentBuffer()
+  for (chunk_index, chunk, chunk_metrics) in chunks
+    results = Vector{result_type}(undef, length(chunk))
+    for k in eachindex(chunk)
+      results[k] = extract_tag_from_record(chunk[k], config, ignore_phreds_for_tag_extraction, buffer; metrics=chunk_metrics, kwargs...)
     end
+    put!(aligned, (chunk_index, results, chunk_metrics))
+  end
+end
+
+# Closes channel once every task is done, passing on the error of the first that failed
+function close_when_done(channel, tasks)
+  try
+    foreach(wait, tasks)
+    close(channel)
+  catch e
+    close(channel, e)
+  end
+end
+
+# For cleaning up after a failure that is already being reported
+function wait_quietly(task)
+  try
+    wait(task)
+  catch
   end
 end
 
+# Everything that happens to a single read, independently of every other read
+# Returns the best template, the tag (or NO_TAG/REJECTS), the record as an OrientedRecord (reverse complemented if
+# the reverse strand won) and the score. Only the configured window of the read is decoded and aligned.
+# Its timings and counts are added to metrics, a PartitionMetrics, if given.
+function extract_tag_from_record(sequence, config, ignore_phreds_for_tag_extraction, buffer=task_alignment_buffer();
+                                 prefilter=nothing, stats=nothing, metrics=nothing)
+  metrics === nothing || (slicing_start = time_ns())
+  start_i = config.start_inclusive
+  r_start_i = config.reverse_start_inclusive
+  end_i = config.end_inclusive
+  r_end_i = config.reverse_end_inclusive
+  forward_seq, forward_quality = slice_sequence(sequence, start_i, r_start_i, end_i, r_end_i, false)
+  if ignore_phreds_for_tag_extraction
+    forward_quality = ConstantQuality(DEFAULT_QUALITY, length(forward_quality)) #Disabling quality for NNNN matching...
+  end
+  if config.try_reverse_complement
+    reverse_seq, reverse_quality = slice_sequence(sequence, start_i, r_start_i, end_i, r_end_i, true)
+    if ignore_phreds_for_tag_extraction
+      reverse_quality = ConstantQuality(DEFAULT_QUALITY, length(reverse_quality)) #Disabling quality for NNNN matching...
+    end
+  end
+  stats === nothing || Threads.atomic_add!(stats.reads, 1)
+  metrics === nothing || (choice_start = time_ns(); metrics.slicing_ns += choice_start - slicing_start; alignment_before = metrics.alignment_ns)
+  alignment_options = (band_width=config.band_width, max_star_gap=config.max_star_gap, prune=config.prune_alignments, buffer=buffer, stats=stats,
+                       metrics=metrics)
+  is_reverse_complement = false
+  if config.try_reverse_complement
+    best_score, best_template, best_tag, best_errors, is_reverse_complement = best_of_forward_and_reverse(forward_seq, forward_quality, reverse_seq, reverse_quality, config.templates;
+                                                                                                          prefilter=prefilter, alignment_options...)
+  else
+    candidates = prefilter === nothing ? nothing : seed_candidates(prefilter, forward_seq, nothing, stats)[1]
+    best_score, best_template, best_tag, best_errors = choose_best_template(forward_seq, forward_quality, config.templates;
+                                                                            candidates=candidates, alignment_options...)
+  end
+  tag = length(best_tag) > 0 ? string(best_tag) : "NO_TAG"
+  tag = best_errors <= config.max_allowed_errors ? tag : "REJECTS"
+  if metrics !== nothing
+    # Time spent aligning was added to alignment_ns as it happened, so it is taken back out of template choice
+    metrics.template_choice_ns += (time_ns() - choice_start) - (metrics.alignment_ns - alignment_before)
+    record_read!(metrics, best_template, tag, best_score, best_errors, is_reverse_complement)
+  end
+  return best_template, tag, OrientedRecord(sequence, is_reverse_complement), best_score
+end
+
+# Works on FASTQ and FASTA records. Only the window is decoded (and reverse complemented),
+# and its qualities are a view into the record (constant for FASTA records).
 function slice_sequence(sequence, start_i, r_start_i, end_i, r_end_i, do_reverse_complement)
+  sequence_length = read_length(sequence)
   if start_i < 0 && r_start_i > 0
-    start_i = length(FASTQ.sequence(sequence)) - r_start_i + 1
+    start_i = sequence_length - r_start_i + 1
   end
   if end_i < 0 && r_end_i > 0
-    end_i = length(FASTQ.sequence(sequence)) - r_end_i + 1
+    end_i = sequence_length - r_end_i + 1
   end
 
-  start_i = min(length(FASTQ.sequence(sequence)), max(1, start_i))
-  end_i = min(length(FASTQ.sequence(sequence)), max(1, end_i))
+  start_i = min(sequence_length, max(1, start_i))
+  end_i = min(sequence_length, max(1, end_i))
   # If the start and end are the other way around, we want our sequence to go backwards
   reverse_seq = false
   if start_i > end_i
@@ -80,41 +232,98 @@ function slice_sequence(sequence, start_i, r_start_i, end_i, r_end_i, do_reverse
     start_i, end_i = end_i, start_i
   end
   if do_reverse_complement
-    seq = reverse_complement(FASTQ.sequence(sequence))[start_i:end_i]
-    quality = view(sequence.quality, length(sequence.quality)-start_i+1:-1:length(sequence.quality)-end_i+1)
+    # start_i:end_i of the reverse complement is the reverse complement of this window of the read
+    first, last = sequence_length - end_i + 1, sequence_length - start_i + 1
+    seq = reverse_complement!(window_sequence(sequence, first, last))
+    quality = window_quality(sequence, first, last, true)
   else
-    seq = FASTQ.sequence(sequence)[start_i:end_i]
-    quality = view(FASTQ.quality(sequence), start_i:end_i)
+    seq = window_sequence(sequence, start_i, end_i)
+    quality = window_quality(sequence, start_i, end_i, false)
   end
   if reverse_seq
     seq = reverse(seq)
-    quality = view(quality, length(quality):-1:1)
+    quality = reverse(quality)
   end
   return seq, quality
 end
 
-function best_of_forward_and_reverse(forward_seq, forward_quality, reverse_seq, reverse_quality, templates)
-  forward_best_score, forward_best_template, forward_best_tag, forward_best_errors = choose_best_template(forward_seq, forward_quality, templates)
-  reverse_best_score, reverse_best_template, reverse_best_tag, reverse_best_errors = choose_best_template(reverse_seq, reverse_quality, templates)
+# Templates are ranked on both strands by score alone (see rank_templates), and only the winner is aligned in full
+function best_of_forward_and_reverse(forward_seq, forward_quality, reverse_seq, reverse_quality, templates; prefilter=nothing, prune=false, stats=nothing,
+                                     band_width=-1, max_star_gap=-1, buffer=task_alignment_buffer(), metrics=nothing)
+  forward_candidates, reverse_candidates = nothing, nothing
+  if prefilter !== nothing
+    forward_candidates, reverse_candidates = seed_candidates(prefilter, forward_seq, reverse_seq, stats)
+  end
+  alignment_options = (band_width=band_width, max_star_gap=max_star_gap, buffer=buffer, metrics=metrics)
+  forward_best_score, forward_best_index = rank_templates(forward_seq, forward_quality, templates;
+                                                          candidates=forward_candidates, prune=prune, stats=stats, alignment_options...)
+  # The reverse strand wins ties, so it only has to be able to match the forward strand's best score
+  reverse_best_score, reverse_best_index = rank_templates(reverse_seq, reverse_quality, templates;
+                                                          candidates=reverse_candidates, prune=prune, score_floor=forward_best_score, stats=stats, alignment_options...)
   if forward_best_score > reverse_best_score
-    return forward_best_score, forward_best_template, forward_best_tag, forward_best_errors, false
+    return (align_best_template(forward_seq, forward_quality, templates, forward_best_score, forward_best_index; alignment_options...)..., false)
   else
-    return reverse_best_score, reverse_best_template, reverse_best_tag, reverse_best_errors, true
+    return (align_best_template(reverse_seq, reverse_quality, templates, reverse_best_score, reverse_best_index; alignment_options...)..., true)
   end
 end
 
-function choose_best_template(seq, quality, templates)
+# Only templates marked in candidates are aligned (all of them if candidates is nothing)
+# With prune=true, alignments are abandoned once they can't reach the best score so far (or score_floor),
+# which never changes the result, as later templates win ties and ties are never abandoned
+function choose_best_template(seq, quality, templates; band_width=-1, max_star_gap=-1, buffer=task_alignment_buffer(), metrics=nothing, kwargs...)
+  alignment_options = (band_width=band_width, max_star_gap=max_star_gap, buffer=buffer, metrics=metrics)
+  best_score, best_index = rank_templates(seq, quality, templates; alignment_options..., kwargs...)
+  return align_best_template(seq, quality, templates, best_score, best_index; alignment_options...)
+end
+
+# The best score of any template and the index of the (last) template that has it, or 0 if no template was aligned.
+# Only scores are computed (see alignment_score), so nothing is traced back here.
+function rank_templates(seq, quality, templates; band_width=-1, max_star_gap=-1, buffer=task_alignment_buffer(),
+                        candidates=nothing, prune=false, score_floor=-Inf, stats=nothing, metrics=nothing)
   best_score = -Inf
-  best_template = nothing
-  best_tag = nothing
-  best_errors = nothing
-  for template in templates
-    score, tag, errors = extract_tag(seq, quality, template.reference)
+  best_index = 0
+  for (template_index, template) in enumerate(templates)
+    stats === nothing || Threads.atomic_add!(stats.alignments, 1)
+    if candidates !== nothing && !candidates[template_index]
+      stats === nothing || Threads.atomic_add!(stats.skipped, 1)
+      continue
+    end
+    abandon_below = prune ? max(best_score, score_floor) : -Inf
+    if metrics === nothing
+      score = alignment_score(seq, quality, template.compiled, buffer; band_width=band_width, max_star_gap=max_star_gap, score_floor=abandon_below)
+    else
+      alignment_start, cells_before = time_ns(), buffer.cells
+      score = alignment_score(seq, quality, template.compiled, buffer; band_width=band_width, max_star_gap=max_star_gap, score_floor=abandon_below)
+      metrics.alignment_ns += time_ns() - alignment_start
+      metrics.dp_cells += buffer.cells - cells_before
+    end
+    if score == -Inf && abandon_below > -Inf
+      stats === nothing || Threads.atomic_add!(stats.abandoned, 1)
+      continue
+    end
     if score >= best_score
-      best_score, best_template, best_tag, best_errors = score, template, tag, errors
+      best_score, best_index = score, template_index
     end
   end
-  return best_score, best_template, best_tag, best_errors
+  return best_score, best_index
+end
+
+# Aligns the template picked by rank_templates in full, for its tag and errors.
+# Returns the score, template, tag and errors, or nothing for all but the score if no template was picked.
+function align_best_template(seq, quality, templates, best_score, best_index; band_width=-1, max_star_gap=-1, buffer=task_alignment_buffer(), metrics=nothing)
+  if best_index == 0
+    return best_score, nothing, nothing, nothing
+  end
+  template = templates[best_index]
+  if metrics === nothing
+    score, tag, errors = extract_tag(seq, quality, template.compiled, buffer; band_width=band_width, max_star_gap=max_star_gap)
+  else
+    alignment_start, cells_before = time_ns(), buffer.cells
+    score, tag, errors = extract_tag(seq, quality, template.compiled, buffer; band_width=band_width, max_star_gap=max_star_gap)
+    metrics.alignment_ns += time_ns() - alignment_start
+    metrics.dp_cells += buffer.cells - cells_before
+  end
+  return score, template, tag, errors
 end
 
 function write_to_file(source_file_name, template, tag, output_sequence, score)
@@ -127,6 +336,7 @@ function write_to_file(source_file_name, template, tag, output_sequence, score)
   close(writer)
 end
 
+# Stores every read as a (score, FASTQ.Record) pair, oriented the way its tag was found
 function write_to_dictionary(dictionary, source_file_name, template, tag, output_sequence, score)
   directory = "$(source_file_name)/$(template.name)"
   if !haskey(dictionary, directory)
@@ -136,11 +346,15 @@ function write_to_dictionary(dictionary, source_file_name, template, tag, output
   if !haskey(directory_dict, tag)
     directory_dict[tag] = []
   end
-  push!(directory_dict[tag], (score, output_sequence))
+  push!(directory_dict[tag], (score, FASTQ.Record(output_sequence)))
 end
 
 function write_to_file_count_to_dict(dictionary, source_file_name, template, tag, output_sequence, score)
   write_to_file(source_file_name, template, tag, output_sequence, score)
+  count_to_dict(dictionary, source_file_name, template, tag)
+end
+
+function count_to_dict(dictionary, source_file_name, template, tag)
   directory = "$(source_file_name)/$(template.name)"
   if !haskey(dictionary, directory)
     dictionary[directory] = Dict()
@@ -153,8 +367,10 @@ if basename(PROGRAM_FILE) == basename(@__FILE__)
   println("Processing $(ARGS[1])")
   config = load_config_from_json(ARGS[1])
   dir_dict = Dict()
-  my_output_func(source_file_name, template, tag, output_sequence, score) = write_to_file_count_to_dict(dir_dict, source_file_name, template, tag, output_sequence, score)
-  extract_tags(my_output_func)
+  writer = TagFileWriter()
+  my_output_func(source_file_name, template, tag, output_sequence, score) = write_to_file_count_to_dict(writer, dir_dict, source_file_name, template, tag, output_sequence, score)
+  extract_tags(config, my_output_func)
+  close(writer)
   for dir in keys(dir_dict)
     println(dir)
     sizes = []
@@ -0,0 +1,77 @@
+#export ConstantQuality, QualityView, OrientedRecord
+using BioSequences
+using PORPID
+
+const PHRED_OFFSET = 0x21
+
+# The same phred score at every position, so that reads without (or ignoring) qualities don't need a filled vector
+struct ConstantQuality <: AbstractVector{Int8}
+  value::Int8
+  length::Int
+end
+
+Base.size(quality::ConstantQuality) = (quality.length,)
+Base.@propagate_inbounds Base.getindex(quality::ConstantQuality, i::Int) = quality.value
+
+# Phred scores read straight out of a FASTQ record's data, from position first in steps of step (1 or -1),
+# so that a window of the forward or reverse strand can be aligned without copying or decoding the whole quality string
+struct QualityView <: AbstractVector{Int8}
+  data::Vector{UInt8}
+  first::Int
+  step::Int
+  length::Int
+end
+
+Base.size(quality::QualityView) = (quality.length,)
+Base.@propagate_inbounds Base.getindex(quality::QualityView, i::Int) = reinterpret(Int8, quality.data[quality.first + quality.step * (i - 1)] - PHRED_OFFSET)
+
+Base.reverse(quality::QualityView) = QualityView(quality.data, quality.first + quality.step * (quality.length - 1), -quality.step, quality.length)
+Base.reverse(quality::ConstantQuality) = quality
+
+read_length(record::Union{FASTQ.Record, FASTA.Record}) = length(record.sequence)
+
+# Positions first:last of a read, decoding only that part of it
+window_sequence(record::FASTQ.Record, first, last) = FASTQ.sequence(DNASequence, record, first:last)
+window_sequence(record::FASTA.Record, first, last) = FASTA.sequence(DNASequence, record, first:last)
+
+# Qualities of positions first:last, running backwards from last when reversed
+function window_quality(record::FASTQ.Record, first, last, reversed)
+  start = reversed ? record.quality[last] : record.quality[first]
+  return QualityView(record.data, start, reversed ? -1 : 1, last - first + 1)
+end
+window_quality(record::FASTA.Record, first, last, reversed) = ConstantQuality(DEFAULT_QUALITY, last - first + 1)
+
+# A read as it should be output: the record it was parsed into, reverse complemented or not.
+# The oriented sequence and qualities are only built when they are asked for, through the FASTQ accessors,
+# FASTQ.Record(record) or by writing it with a FASTQ.Writer.
+struct OrientedRecord{R}
+  record::R
+  reverse_complemented::Bool
+end
+
+BioSequences.FASTQ.identifier(oriented::OrientedRecord{FASTQ.Record}) = FASTQ.identifier(oriented.record)
+BioSequences.FASTQ.identifier(oriented::OrientedRecord{FASTA.Record}) = FASTA.identifier(oriented.record)
+
+BioSequences.FASTQ.hasdescription(oriented::OrientedRecord{FASTQ.Record}) = FASTQ.hasdescription(oriented.record)
+BioSequences.FASTQ.hasdescription(oriented::OrientedRecord{FASTA.Record}) = FASTA.hasdescription(oriented.record)
+BioSequences.FASTQ.description(oriented::OrientedRecord{FASTQ.Record}) = FASTQ.description(oriented.record)
+BioSequences.FASTQ.description(oriented::OrientedRecord{FASTA.Record}) = FASTA.description(oriented.record)
+
+function BioSequences.FASTQ.sequence(oriented::OrientedRecord)
+  sequence = window_sequence(oriented.record, 1, read_length(oriented.record))
+  return oriented.reverse_complemented ? reverse_complement!(sequence) : sequence
+end
+
+function BioSequences.FASTQ.quality(oriented::OrientedRecord)
+  return collect(window_quality(oriented.record, 1, read_length(oriented.record), oriented.reverse_complemented))
+end
+
+function BioSequences.FASTQ.Record(oriented::OrientedRecord)
+  if oriented.record isa FASTQ.Record && !oriented.reverse_complemented
+    return oriented.record
+  end
+  description = FASTQ.hasdescription(oriented) ? FASTQ.description(oriented) : nothing
+  return FASTQ.Record(FASTQ.identifier(oriented), description, FASTQ.sequence(oriented), FASTQ.quality(oriented))
+end
+
+Base.write(writer::FASTQ.Writer, oriented::OrientedRecord) = write(writer, FASTQ.Record(oriented))
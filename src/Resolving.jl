@@ -2,6 +2,8 @@
 using PORPID
 
 const REJECT_TAG = "REJECTS"
+const MAX_PACKED_TAG_LENGTH = 31
+const DEFAULT_NEIGHBOR_CACHE_SIZE = 1_000_000
 
 struct ErrorModel
   error_rate::Float64
@@ -13,22 +15,29 @@ end
 PacBioErrorModel(error_rate=0.005) = ErrorModel(error_rate, 0.4, 0.4, 0.2)
 IlluminaErrorModel(error_rate=0.001) = ErrorModel(error_rate, 0.05, 0.05, 0.9)
 
-function resolve_tags_in_dir(path, error_model=PacBioErrorModel())
+# lda_method chooses the EM backend: :classic for LDA, :sparse for sparse_LDA,
+# :components for components_LDA (sparse_LDA on each connected component of the tags)
+function resolve_tags_in_dir(path, error_model=PacBioErrorModel(); lda_method=:classic)
   path = normpath(path)
-  println(STDERR, "Reading tag files...")
-  counts = tag_counts(path)
-  tag_file_names = tag_to_filename(path)
+  counts, tag_file_names = read_tag_counts(path)
 
-  println(STDERR, "Generating index mapping...")
+  println(stderr, "Generating index mapping...")
   tag_to_index, index_to_tag = tag_index_mapping(Set(keys(counts)))
 
-  println(STDERR, "Generating likelihood distributions...")
+  println(stderr, "Generating likelihood distributions...")
   probabilities_array = prob_observed_tags_given_reals(tag_to_index, error_model)
 
   indexed_counts = index_counts(counts, tag_to_index)
 
-  println(STDERR, "Iterating..."  )
-  most_likely_real_for_each_obs = LDA(probabilities_array, indexed_counts)
+  println(stderr, "Iterating..."  )
+  if lda_method == :sparse || lda_method == :components
+    likelihoods = LikelihoodMatrix(probabilities_array)
+    result = lda_method == :sparse ? sparse_LDA(likelihoods, indexed_counts) : components_LDA(likelihoods, indexed_counts)
+    println(stderr, result)
+    most_likely_real_for_each_obs = result.most_likely_real_for_each_obs
+  else
+    most_likely_real_for_each_obs = LDA(probabilities_array, indexed_counts)
+  end
 
   tag_count = length(most_likely_real_for_each_obs)
   for observed_index in 1:tag_count
@@ -41,6 +50,37 @@ function resolve_tags_in_dir(path, error_model=PacBioErrorModel())
   end
 end
 
+# Tag counts and file names for a directory of per-tag files, from its tag manifest if it has one that is still current
+# (see manifest_is_current), else by counting the reads of every file.
+# Single sorted files (TagFileWriter with single_file=true) can't be resolved yet: their manifest is never read.
+function read_tag_counts(path)
+  if !isdir(path)
+    throw(ArgumentError("$(path) is not a directory of per-tag files; single sorted files can't be resolved yet"))
+  end
+  manifest_file_name = joinpath(path, TAG_MANIFEST_FILE_NAME)
+  if isfile(manifest_file_name)
+    manifest = read_tag_manifest(manifest_file_name)
+    if manifest_is_current(path, manifest_file_name, manifest)
+      println(stderr, "Reading tag manifest...")
+      return manifest_counts(manifest)
+    end
+    println(stderr, "Tag manifest is out of date, ignoring it...")
+  end
+  println(stderr, "Reading tag files...")
+  return tag_counts(path), tag_to_filename(path)
+end
+
+# Whether a manifest still describes the tag files next to it: it must list exactly the FASTQ files there are,
+# and none of them may have changed since it was written (as when write_to_file appends to them later)
+function manifest_is_current(path, manifest_file_name, manifest)
+  tag_files = Set(file for file in readdir(path) if splitext(file)[2] == ".fastq")
+  if tag_files != Set(entry.file_name for entry in values(manifest))
+    return false
+  end
+  manifest_time = mtime(manifest_file_name)
+  return all(mtime(joinpath(path, file)) <= manifest_time for file in tag_files)
+end
+
 function index_counts(counts, tag_to_index)
   tags = keys(counts)
   indexed_counts = Vector{Int32}(undef, length(tags))
@@ -94,7 +134,7 @@ function tag_counts(path)
           lines = countlines(tagfile)
         end
         if (lines % 4 != 0)
-          println(STDERR, "Warning! $f appears to have incorrect format: expected file to contain 4 lines per sequence, and to end on a new line.")
+          println(stderr, "Warning! $f appears to have incorrect format: expected file to contain 4 lines per sequence, and to end on a new line.")
         end
         counts[fname] = round(lines / 4)
       end
@@ -103,31 +143,110 @@ function tag_counts(path)
   return counts
 end
 
+# Memoised neighbor likelihoods, keyed by (tag, recurse).
+# Emptied whenever it fills up, so that memory stays bounded however many intermediate tags recursion visits.
+struct NeighborCache{T}
+  entries::Dict{Tuple{T, Int}, Vector{Tuple{Int32, Float64}}}
+  max_size::Int
+end
+
+NeighborCache{T}(max_size::Int=DEFAULT_NEIGHBOR_CACHE_SIZE) where T = NeighborCache{T}(Dict{Tuple{T, Int}, Vector{Tuple{Int32, Float64}}}(), max_size)
+
+function cache!(memoisation::NeighborCache, key, value)
+  if length(memoisation.entries) >= memoisation.max_size
+    empty!(memoisation.entries)
+  end
+  memoisation.entries[key] = value
+end
+
+# Symmetric deletion index: every tag that can be made by deleting up to max_deletions nucleotides from a real tag,
+# with the fewest deletions that make it. Two tags within edit distance d always have a common tag that takes at most
+# d deletions from each, so a tag with no such common tag has no real tag within distance d.
+struct DeletionIndex{T}
+  deletions::Dict{T, Int}
+  max_deletions::Int
+end
+
+function DeletionIndex(tags, max_deletions)
+  index = DeletionIndex(Dict{eltype(tags), Int}(), max_deletions)
+  for tag in tags
+    add_deletions!(index, tag, 0)
+  end
+  return index
+end
+
+function add_deletions!(index::DeletionIndex, tag, deletions)
+  # A tag already reached with as few deletions has had everything below it added
+  if get(index.deletions, tag, index.max_deletions + 1) <= deletions
+    return
+  end
+  index.deletions[tag] = deletions
+  if deletions < index.max_deletions
+    for i in 1:length(tag)
+      add_deletions!(index, without(tag, i), deletions + 1)
+    end
+  end
+end
+
+# Whether tag might have a real tag within edit distance distance (never false if it does)
+may_have_real_within(index::Nothing, tag, distance) = true
+
+function may_have_real_within(index::DeletionIndex, tag, distance, deletions=0)
+  if get(index.deletions, tag, distance + 1) <= distance
+    return true
+  end
+  if deletions < distance
+    for i in 1:length(tag)
+      may_have_real_within(index, without(tag, i), distance, deletions + 1) && return true
+    end
+  end
+  return false
+end
+
 function prob_observed_tags_given_reals(tag_to_index::Dict{String, Int32}, error_model::ErrorModel, recurse=0)
   prob_observed_tags_given_reals = Vector{Vector{Tuple{Int32, Float64}}}(undef, length(tag_to_index))
-  global memoisation = Dict{Tuple{String, Int64}, Vector{Tuple{Int32, Float64}}}()
+  packed_to_index = pack_tag_index(tag_to_index)
+  memoisation = NeighborCache{String}()
+  packed_memoisation = NeighborCache{PackedTag}()
+  deletion_index = recurse > 0 ? DeletionIndex(keys(packed_to_index), recurse) : nothing
   for observed_tag in keys(tag_to_index)
-    observed_index = tag_to_index[observed_tag]
-    prob_observed_tags_given_reals[observed_index] = prob_observed_tag_given_reals(observed_tag, tag_to_index, error_model, recurse)
+    prob_observed_tags_given_reals[tag_to_index[observed_tag]] = prob_observed_tag_given_reals(observed_tag, tag_to_index, packed_to_index,
+                                                                                               error_model, recurse, memoisation, packed_memoisation,
+                                                                                               deletion_index)
   end
   return prob_observed_tags_given_reals
 end
 
-function prob_observed_tag_given_reals(observed_tag::String, tag_to_index::Dict{String, Int32}, error_model::ErrorModel, recurse=0)
-  global memoisation
-  if haskey(memoisation, (observed_tag, recurse))
-    return memoisation[(observed_tag, recurse)]
+# Every neighbor of a tag made of A, C, G and T is made of A, C, G and T too, so it can be generated and looked up packed,
+# as long as recursion can't make it too long to pack. Anything else (e.g. NO_TAG) goes through the String versions.
+# deletion_index, a DeletionIndex of the packed real tags, lets recursion skip neighbors that can't lead to a real tag.
+function prob_observed_tag_given_reals(observed_tag::String, tag_to_index::Dict{String, Int32}, packed_to_index::Dict{PackedTag, Int32},
+                                       error_model::ErrorModel, recurse, memoisation::NeighborCache{String}, packed_memoisation::NeighborCache{PackedTag},
+                                       deletion_index::Union{Nothing, DeletionIndex{PackedTag}}=nothing)
+  packed_tag = pack_tag(observed_tag)
+  if packed_tag !== nothing && length(observed_tag) + recurse + 1 <= MAX_PACKED_TAG_LENGTH
+    return prob_observed_tag_given_reals(packed_tag, packed_to_index, error_model, recurse, packed_memoisation, deletion_index)
+  end
+  return prob_observed_tag_given_reals(observed_tag, tag_to_index, error_model, recurse, memoisation)
+end
+
+# Only tags within recurse + 1 errors of observed_tag can get a likelihood, so with a deletion_index, neighbors
+# without a real tag within recurse errors are skipped rather than recursed into. This gives exactly the same result.
+function prob_observed_tag_given_reals(observed_tag, tag_to_index::AbstractDict, error_model::ErrorModel, recurse=0,
+                                       memoisation=NeighborCache{typeof(observed_tag)}(), deletion_index=nothing)
+  if haskey(memoisation.entries, (observed_tag, recurse))
+    return memoisation.entries[(observed_tag, recurse)]
   end
   prob_given_reals_dict = Dict{Int32, Float64}()
-  ins_nbrs = insertion_neighbors(observed_tag, tag_to_index, error_model, recurse)
+  ins_nbrs = insertion_neighbors(observed_tag, tag_to_index, error_model, recurse, memoisation, deletion_index)
   for (index, prob) in ins_nbrs
     prob_given_reals_dict[index] = get(prob_given_reals_dict, index, 0.0) + error_model.error_rate * error_model.insertion_ratio * (1/4) * prob
   end
-  del_nbrs = deletion_neighbors(observed_tag, tag_to_index, error_model, recurse)
+  del_nbrs = deletion_neighbors(observed_tag, tag_to_index, error_model, recurse, memoisation, deletion_index)
   for (index, prob) in del_nbrs
     prob_given_reals_dict[index] = get(prob_given_reals_dict, index, 0.0) + error_model.error_rate * error_model.deletion_ratio * prob
   end
-  mut_nbrs = mutation_neighbors(observed_tag, tag_to_index, error_model, recurse)
+  mut_nbrs = mutation_neighbors(observed_tag, tag_to_index, error_model, recurse, memoisation, deletion_index)
   for (index, prob) in mut_nbrs
     prob_given_reals_dict[index] = get(prob_given_reals_dict, index, 0.0) + error_model.error_rate * error_model.mutation_ratio * (1/3) * prob
   end
@@ -141,23 +260,25 @@ function prob_observed_tag_given_reals(observed_tag::String, tag_to_index::Dict{
     tuple_array[i] = (index, prob)
     i += 1
   end
-  memoisation[(observed_tag, recurse)] = tuple_array
+  cache!(memoisation, (observed_tag, recurse), tuple_array)
   return tuple_array
 end
 
 #The three neighbor functions below can have duplicate tags in the returned lists
 #This is used to accumulate probabilities when there are multiple error paths between two tags
 # e.g. there are three different deletions that turn AAA into AA
+#They work on both String and PackedTag tags, with tag_to_index keyed by the same type
 
 #tag -> insertion -> neighbors
-function insertion_neighbors(tag::String, tag_to_index::Dict{String, Int32}, error_model, recurse)
+function insertion_neighbors(tag, tag_to_index::AbstractDict, error_model, recurse, memoisation=NeighborCache{typeof(tag)}(), deletion_index=nothing)
   neighbors = Vector{Tuple{Int32, Float64}}(undef, 0)
-  word = ""
   for c in "ACTG"
     for i in 1:length(tag) + 1
       word = insert_at(tag, i, c)
       if recurse > 0
-        append!(neighbors, prob_observed_tag_given_reals(word, tag_to_index, error_model, recurse-1))
+        if may_have_real_within(deletion_index, word, recurse)
+          append!(neighbors, prob_observed_tag_given_reals(word, tag_to_index, error_model, recurse-1, memoisation, deletion_index))
+        end
       elseif haskey(tag_to_index, word)
         push!(neighbors, (tag_to_index[word], 1.0))
       end
@@ -167,13 +288,14 @@ function insertion_neighbors(tag::String, tag_to_index::Dict{String, Int32}, err
 end
 
 #tag -> deletion -> neighbors
-function deletion_neighbors(tag::String, tag_to_index::Dict{String, Int32}, error_model, recurse)
+function deletion_neighbors(tag, tag_to_index::AbstractDict, error_model, recurse, memoisation=NeighborCache{typeof(tag)}(), deletion_index=nothing)
   neighbors = Vector{Tuple{Int32, Float64}}(undef, 0)
-  word = ""
   for i in 1:length(tag)
     word = without(tag, i)
     if recurse > 0
-      append!(neighbors, prob_observed_tag_given_reals(word, tag_to_index, error_model, recurse-1))
+      if may_have_real_within(deletion_index, word, recurse)
+        append!(neighbors, prob_observed_tag_given_reals(word, tag_to_index, error_model, recurse-1, memoisation, deletion_index))
+      end
     elseif haskey(tag_to_index, word)
       push!(neighbors, (tag_to_index[word], 1.0))
     end
@@ -182,14 +304,15 @@ function deletion_neighbors(tag::String, tag_to_index::Dict{String, Int32}, erro
 end
 
 #tag -> mutation -> neighbors
-function mutation_neighbors(tag::String, tag_to_index::Dict{String, Int32}, error_model, recurse)
+function mutation_neighbors(tag, tag_to_index::AbstractDict, error_model, recurse, memoisation=NeighborCache{typeof(tag)}(), deletion_index=nothing)
   neighbors = Vector{Tuple{Int32, Float64}}(undef, 0)
-  word = ""
   for c in "ACTG"
     for i in 1:length(tag)
       word = replace_at(tag, i, c)
       if recurse > 0
-        append!(neighbors, prob_observed_tag_given_reals(word, tag_to_index, error_model, recurse-1))
+        if may_have_real_within(deletion_index, word, recurse)
+          append!(neighbors, prob_observed_tag_given_reals(word, tag_to_index, error_model, recurse-1, memoisation, deletion_index))
+        end
       elseif haskey(tag_to_index, word) && word != tag
         push!(neighbors, (tag_to_index[word], 1.0))
       end
@@ -210,6 +333,84 @@ function replace_at(str::String, i, c)
   return "$(str[1:i-1])$c$(str[i+1:length(str)])"
 end
 
+# A tag packed two bits per nucleotide (A=0, C=1, G=2, T=3), first nucleotide in the highest bits,
+# under a leading 1 bit that marks where the tag starts, so tags of different lengths never share a code.
+# Neighbors are then built with shifts and masks, and looked up by hashing a single integer.
+struct PackedTag
+  code::UInt64
+end
+
+Base.hash(tag::PackedTag, h::UInt) = hash(tag.code, h)
+Base.length(tag::PackedTag) = (63 - leading_zeros(tag.code)) >> 1
+
+function nucleotide_bits(c::Char)
+  if c == 'A'
+    return UInt64(0)
+  elseif c == 'C'
+    return UInt64(1)
+  elseif c == 'G'
+    return UInt64(2)
+  elseif c == 'T'
+    return UInt64(3)
+  end
+  return nothing
+end
+
+# Returns nothing for tags that are too long to pack, or contain anything other than A, C, G or T
+function pack_tag(tag::String)
+  if length(tag) > MAX_PACKED_TAG_LENGTH
+    return nothing
+  end
+  code = UInt64(1)
+  for c in tag
+    bits = nucleotide_bits(c)
+    if bits === nothing
+      return nothing
+    end
+    code = (code << 2) | bits
+  end
+  return PackedTag(code)
+end
+
+function Base.string(tag::PackedTag)
+  tag_length = length(tag)
+  chars = Vector{Char}(undef, tag_length)
+  for i in 1:tag_length
+    chars[i] = "ACGT"[((tag.code >> (2 * (tag_length - i))) & 0x3) + 1]
+  end
+  return String(chars)
+end
+
+# Index of every tag that can be packed
+function pack_tag_index(tag_to_index::Dict{String, Int32})
+  packed_to_index = Dict{PackedTag, Int32}()
+  sizehint!(packed_to_index, length(tag_to_index))
+  for (tag, index) in tag_to_index
+    packed_tag = pack_tag(tag)
+    if packed_tag !== nothing
+      packed_to_index[packed_tag] = index
+    end
+  end
+  return packed_to_index
+end
+
+function without(tag::PackedTag, i)
+  low_bits = 2 * (length(tag) - i)
+  low = tag.code & ((UInt64(1) << low_bits) - 1)
+  return PackedTag(((tag.code >> (low_bits + 2)) << low_bits) | low)
+end
+
+function insert_at(tag::PackedTag, i, c::Char)
+  low_bits = 2 * (length(tag) - i + 1)
+  low = tag.code & ((UInt64(1) << low_bits) - 1)
+  return PackedTag(((((tag.code >> low_bits) << 2) | nucleotide_bits(c)) << low_bits) | low)
+end
+
+function replace_at(tag::PackedTag, i, c::Char)
+  shift = 2 * (length(tag) - i)
+  return PackedTag((tag.code & ~(UInt64(3) << shift)) | (nucleotide_bits(c) << shift))
+end
+
 if PROGRAM_FILE == @__FILE__
   resolve_tags_in_dir(ARGS[1])
 end
@@ -0,0 +1,196 @@
+#export open_sequence_reader, detect_file_type
+using BioSequences
+using Mmap
+using PORPID
+
+const GZIP_MAGIC = [0x1f, 0x8b]
+const GZIP_FLAG_EXTRA = 0x04
+const GZIP_HEADER_LENGTH = 18
+const FASTQ_EXTENSIONS = [".fastq", ".fq"]
+const FASTA_EXTENSIONS = [".fasta", ".fa", ".fna", ".fas"]
+const COMPRESSED_EXTENSIONS = [".gz", ".bgz", ".bgzf"]
+
+# Records decompressed by an external process. Once the records run out, the process's exit status is checked,
+# so that a truncated or corrupt file raises an error rather than silently losing the reads that couldn't be decompressed.
+mutable struct DecompressedReader{R}
+  reader::R
+  process::Base.Process
+  file_name::String
+  checked::Bool
+end
+
+DecompressedReader(reader, process, file_name) = DecompressedReader(reader, process, file_name, false)
+
+Base.eltype(::Type{DecompressedReader{R}}) where R = eltype(R)
+Base.IteratorSize(::Type{<:DecompressedReader}) = Base.SizeUnknown()
+
+function Base.iterate(reader::DecompressedReader, state...)
+  next = iterate(reader.reader, state...)
+  next === nothing && check_decompression(reader)
+  return next
+end
+
+function check_decompression(reader::DecompressedReader)
+  reader.checked && return
+  reader.checked = true
+  if !success(reader.process)
+    error("Decompressing $(reader.file_name) failed with exit code $(reader.process.exitcode), so some of its reads could not be read")
+  end
+end
+
+# Never raises an error of its own, as it is called while cleaning up after other errors.
+# A decompressor that is still running when the reader is closed early is stopped rather than checked.
+function Base.close(reader::DecompressedReader)
+  reader.checked = true
+  process_exited(reader.process) || kill(reader.process)
+  close(reader.reader)
+end
+
+function read_header(file_name, byte_count)
+  open(file_name, "r") do io
+    return read(io, byte_count)
+  end
+end
+
+is_gzip(header) = length(header) >= 2 && header[1:2] == GZIP_MAGIC
+
+# BGZF (as written by bgzip) is gzip with a "BC" extra subfield, made of independent blocks that can be decompressed in parallel
+function is_bgzf(header)
+  return is_gzip(header) && length(header) >= GZIP_HEADER_LENGTH && (header[4] & GZIP_FLAG_EXTRA) != 0 &&
+         header[13] == UInt8('B') && header[14] == UInt8('C')
+end
+
+# Decompresses to stdout with as many threads as the format and the available tools allow:
+# bgzip for BGZF, then pigz, then gzip.
+function decompression_command(file_name, bgzf, threads)
+  bgzip = Sys.which("bgzip")
+  if bgzf && bgzip !== nothing
+    return `$bgzip -@ $(threads) -dc $(file_name)`
+  end
+  pigz = Sys.which("pigz")
+  if pigz !== nothing
+    return `$pigz -p $(threads) -dc $(file_name)`
+  end
+  gzip = Sys.which("gzip")
+  if gzip !== nothing
+    return `$gzip -dc $(file_name)`
+  end
+  error("Can't read $(file_name): it is gzip compressed, and none of bgzip, pigz or gzip were found")
+end
+
+# An empty file has no records, which either reader reads just as well
+function file_type_of_first_byte(first_byte, file_name)
+  if first_byte === nothing || first_byte == UInt8('@')
+    return fastq
+  elseif first_byte == UInt8('>')
+    return fasta
+  end
+  error("Can't tell whether $(file_name) is FASTQ or FASTA")
+end
+
+# The file type of a file, from its extension (ignoring any compression extension) if it has a known one,
+# else from its first character ('@' for FASTQ, '>' for FASTA). Empty files are taken to be FASTQ.
+function detect_file_type(file_name)
+  name, extension = splitext(lowercase(basename(file_name)))
+  if extension in COMPRESSED_EXTENSIONS
+    name, extension = splitext(name)
+  end
+  if extension in FASTQ_EXTENSIONS
+    return fastq
+  elseif extension in FASTA_EXTENSIONS
+    return fasta
+  end
+  header = read_header(file_name, GZIP_HEADER_LENGTH)
+  if is_gzip(header)
+    first_byte = UInt8[]
+    process = open(decompression_command(file_name, is_bgzf(header), 1), "r")
+    if !eof(process)
+      first_byte = read(process, 1)
+    end
+    close(process)
+    return file_type_of_first_byte(isempty(first_byte) ? nothing : first_byte[1], file_name)
+  end
+  return file_type_of_first_byte(isempty(header) ? nothing : header[1], file_name)
+end
+
+# A FASTQ.Reader or FASTA.Reader for file_name, which may be gzip or bgzip compressed.
+# Compressed files are streamed through an external decompressor using up to `threads` threads (and the reader is
+# wrapped in a DecompressedReader), uncompressed files are read through a file handle.
+# BioSequences' readers copy their input into a buffer of their own and each record's bytes into the record,
+# so memory mapping the file would save no copies.
+# With filetype=auto, the file type is found by detect_file_type.
+function open_sequence_reader(file_name, filetype=auto; threads=1)
+  if filetype == auto
+    filetype = detect_file_type(file_name)
+  end
+  Reader = filetype == fasta ? FASTA.Reader : FASTQ.Reader
+  header = read_header(file_name, GZIP_HEADER_LENGTH)
+  if is_gzip(header)
+    process = open(decompression_command(file_name, is_bgzf(header), max(1, threads)), "r")
+    return DecompressedReader(Reader(process), process, file_name)
+  end
+  return Reader(open(file_name, "r"))
+end
+
+# A reader over byte_range of an uncompressed file, mapping only that part of it rather than reading the whole file.
+# The range should start at the start of a record and end at the end of one (see record_aligned_ranges).
+function open_sequence_reader(file_name, filetype, byte_range::UnitRange{Int})
+  if filetype == auto
+    filetype = detect_file_type(file_name)
+  end
+  Reader = filetype == fasta ? FASTA.Reader : FASTQ.Reader
+  if isempty(byte_range)
+    return Reader(IOBuffer(UInt8[]))
+  end
+  data = open(file_name, "r") do io
+    Mmap.mmap(io, Vector{UInt8}, length(byte_range), first(byte_range) - 1)
+  end
+  return Reader(IOBuffer(data))
+end
+
+is_compressed(file_name) = is_gzip(read_header(file_name, 2))
+
+# Position just after the next newline at or after position, or nothing if there isn't one
+function next_line_start(data, position)
+  newline = findnext(isequal(UInt8('\n')), data, position)
+  return newline === nothing ? nothing : newline + 1
+end
+
+# Position of the first record that starts at or after position, or nothing if there are none.
+# A FASTQ record starts with a line beginning with '@' whose second line after begins with '+', which a quality line
+# that happens to begin with '@' doesn't have.
+function record_start_after(data, position, filetype)
+  line_start = position == 1 || data[position-1] == UInt8('\n') ? position : next_line_start(data, position)
+  while line_start !== nothing && line_start <= length(data)
+    if filetype == fasta
+      data[line_start] == UInt8('>') && return line_start
+    elseif data[line_start] == UInt8('@')
+      sequence_start = next_line_start(data, line_start)
+      separator_start = sequence_start === nothing ? nothing : next_line_start(data, sequence_start)
+      if separator_start !== nothing && separator_start <= length(data) && data[separator_start] == UInt8('+')
+        return line_start
+      end
+    end
+    line_start = next_line_start(data, line_start)
+  end
+  return nothing
+end
+
+# Splits an uncompressed file into consecutive byte ranges of at least max_bytes (bar the last one), each starting at a record
+function record_aligned_ranges(file_name, filetype, max_bytes)
+  size = filesize(file_name)
+  if size == 0
+    return [1:0]
+  end
+  if filetype == auto
+    filetype = detect_file_type(file_name)
+  end
+  data = Mmap.mmap(file_name)
+  starts = [1]
+  while starts[end] + max_bytes <= size
+    next_start = record_start_after(data, starts[end] + max_bytes, filetype)
+    next_start === nothing && break
+    push!(starts, next_start)
+  end
+  return [starts[k]:(k < length(starts) ? starts[k+1] - 1 : size) for k in 1:length(starts)]
+end
@@ -4,7 +4,7 @@ using PORPID
 #export AbstractState, AbstractStartingState, StartingState
 #export AbstractRepeatingAnyState, RepeatingAnyState, AbstractObservableState
 #export ObservableState, AbstractBarcodeState, BarcodeState
-#export string_to_state_array
+#export string_to_state_array, CompiledTemplate
 
 abstract type AbstractState end
 abstract type AbstractStartingState <: AbstractState end
@@ -44,3 +44,51 @@ function string_to_state_array(string_sequence::String)
   end
   return states
 end
+
+#Kinds of state in a CompiledTemplate. Barcode states are observable too, so kind >= STATE_OBSERVABLE means observable.
+const STATE_START = 0x00
+const STATE_ANY = 0x01
+const STATE_OBSERVABLE = 0x02
+const STATE_BARCODE = 0x03
+
+#A state array flattened into concretely typed vectors, which is what extract_tag aligns against.
+#kinds and values hold each state's kind and DNA (DNA_N for the starting state).
+#insertion_in_tag marks the rows where an inserted symbol belongs to the tag: barcode rows and the row just before a barcode region.
+#remaining_bound is an upper bound on how much rows r+1:end can still add to a score, for abandoning alignments early:
+#a RepeatingAnyState can be deleted for free, every other state has to be matched or deleted, and insertions only ever lower the score.
+struct CompiledTemplate
+  kinds::Vector{UInt8}
+  values::Vector{DNA}
+  insertion_in_tag::Vector{Bool}
+  remaining_bound::Vector{Float64}
+end
+
+function state_kind(state::AbstractState)
+  if typeof(state) <: AbstractBarcodeState
+    return STATE_BARCODE
+  elseif typeof(state) <: AbstractObservableState
+    return STATE_OBSERVABLE
+  elseif typeof(state) <: AbstractRepeatingAnyState
+    return STATE_ANY
+  end
+  return STATE_START
+end
+
+function CompiledTemplate(states::AbstractVector{<:AbstractState})
+  rows = length(states)
+  kinds = [state_kind(state) for state in states]
+  values = [kind == STATE_START ? DNA_N : state.value for (kind, state) in zip(kinds, states)]
+  insertion_in_tag = [kinds[r] == STATE_BARCODE || (r < rows && kinds[r+1] == STATE_BARCODE) for r in 1:rows]
+  remaining_bound = zeros(Float64, rows)
+  for r = rows-1:-1:1
+    if kinds[r+1] == STATE_ANY
+      step = 0.0
+    else
+      step = max(L_MAX_EMISSION[convert(UInt8, values[r+1]) + 1], L_PROBABILITY_OF_DELETION)
+    end
+    remaining_bound[r] = remaining_bound[r+1] + step
+  end
+  return CompiledTemplate(kinds, values, insertion_in_tag, remaining_bound)
+end
+
+Base.length(template::CompiledTemplate) = length(template.kinds)
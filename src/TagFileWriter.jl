@@ -0,0 +1,195 @@
+#export TagFileWriter, write_to_tag_file_writer
+using BioSequences
+using PORPID
+
+const DEFAULT_MAX_BUFFERED_BYTES = 16 * 1024 * 1024
+const SORTED_INDEX_EXTENSION = ".index"
+const UNSORTED_EXTENSION = ".unsorted"
+
+# Demultiplexing writer that replaces write_to_file's open/append/close per read.
+# Records are buffered in memory per output file and written out in batches once max_buffered_bytes is reached.
+# At most max_open_files files are kept open; the ones least recently written to are closed when more are needed.
+# With single_file=true, every record for a template goes to one file which is sorted by tag when the writer is closed,
+# alongside an index giving the byte offset, byte length and record count of each tag.
+# A tag manifest (see TagManifest.jl) is written next to the output when the writer is closed, so that resolution
+# doesn't have to count the records again. It is skipped for per-tag directories that already held output without one.
+# Single files get a <template>.manifest, which resolution doesn't read yet (see read_tag_counts).
+# A closed writer can't be written to again, as that would start its single files afresh.
+mutable struct TagFileWriter
+  output_folder::String
+  single_file::Bool
+  max_open_files::Int
+  max_buffered_bytes::Int
+  pending::Dict{String, IOBuffer}
+  pending_bytes::Int
+  dirty::Set{String}
+  open_files::Dict{String, IOStream}
+  opened::Set{String}
+  last_used::Dict{String, Int}
+  clock::Int
+  created_directories::Set{String}
+  file_sizes::Dict{String, Int}
+  tag_offsets::Dict{String, Dict{String, Vector{Tuple{Int, Int}}}}
+  manifests::Dict{String, Union{Nothing, Dict{String, TagManifestEntry}}}
+  closed::Bool
+end
+
+TagFileWriter(; output_folder=OUTPUT_FOLDER, single_file=false, max_open_files=DEFAULT_MAX_FILE_DESCRIPTORS, max_buffered_bytes=DEFAULT_MAX_BUFFERED_BYTES) =
+    TagFileWriter(output_folder, single_file, max_open_files, max_buffered_bytes, Dict{String, IOBuffer}(), 0, Set{String}(),
+                  Dict{String, IOStream}(), Set{String}(), Dict{String, Int}(), 0, Set{String}(), Dict{String, Int}(),
+                  Dict{String, Dict{String, Vector{Tuple{Int, Int}}}}(), Dict{String, Union{Nothing, Dict{String, TagManifestEntry}}}(), false)
+
+function write_to_tag_file_writer(writer::TagFileWriter, source_file_name, template, tag, output_sequence, score)
+  writer.closed && error("TagFileWriter for $(writer.output_folder) is already closed")
+  directory = "$(writer.output_folder)/$(basename(source_file_name))"
+  if writer.single_file
+    output_file_name = "$(directory)/$(template.name).fastq$(UNSORTED_EXTENSION)"
+    manifest_file_name = "$(directory)/$(template.name)$(TAG_MANIFEST_EXTENSION)"
+    manifest_tag_file_name = "$(template.name).fastq"
+  else
+    directory = "$(directory)/$(template.name)"
+    output_file_name = "$(directory)/$(tag).fastq"
+    manifest_file_name = "$(directory)/$(TAG_MANIFEST_FILE_NAME)"
+    manifest_tag_file_name = "$(tag).fastq"
+  end
+  manifest = tag_manifest!(writer, manifest_file_name, directory)
+  if manifest !== nothing
+    add_to_tag_manifest!(manifest, tag, manifest_tag_file_name, score)
+  end
+  if !(directory in writer.created_directories)
+    mkpath(directory)
+    push!(writer.created_directories, directory)
+  end
+  if !haskey(writer.pending, output_file_name)
+    writer.pending[output_file_name] = IOBuffer()
+  end
+  buffer = writer.pending[output_file_name]
+  buffer_start = position(buffer)
+  write(FASTQ.Writer(buffer), output_sequence)
+  record_length = position(buffer) - buffer_start
+  writer.pending_bytes += record_length
+  push!(writer.dirty, output_file_name)
+  writer.clock += 1
+  writer.last_used[output_file_name] = writer.clock
+  if writer.single_file
+    offset = get(writer.file_sizes, output_file_name, 0)
+    writer.file_sizes[output_file_name] = offset + record_length
+    if !haskey(writer.tag_offsets, output_file_name)
+      writer.tag_offsets[output_file_name] = Dict{String, Vector{Tuple{Int, Int}}}()
+    end
+    offsets = writer.tag_offsets[output_file_name]
+    if !haskey(offsets, tag)
+      offsets[tag] = Vector{Tuple{Int, Int}}()
+    end
+    push!(offsets[tag], (offset, record_length))
+  end
+  if writer.pending_bytes >= writer.max_buffered_bytes
+    flush(writer)
+  end
+end
+
+# Only files written to since the last flush are touched, oldest first, so that any files closed to make room for
+# the later ones are the least recently written to
+function Base.flush(writer::TagFileWriter)
+  for output_file_name in sort!(collect(writer.dirty), by=name -> writer.last_used[name])
+    write(file_handle!(writer, output_file_name), take!(writer.pending[output_file_name]))
+  end
+  empty!(writer.dirty)
+  writer.pending_bytes = 0
+end
+
+function Base.close(writer::TagFileWriter)
+  writer.closed && return
+  flush(writer)
+  writer.closed = true
+  empty!(writer.pending)
+  for handle in values(writer.open_files)
+    close(handle)
+  end
+  empty!(writer.open_files)
+  empty!(writer.opened)
+  empty!(writer.last_used)
+  for (manifest_file_name, manifest) in writer.manifests
+    if manifest !== nothing
+      write_tag_manifest(manifest_file_name, manifest)
+    end
+  end
+  empty!(writer.manifests)
+  if writer.single_file
+    for (unsorted_file_name, offsets) in writer.tag_offsets
+      sort_by_tag(unsorted_file_name, offsets)
+      rm(unsorted_file_name)
+    end
+    empty!(writer.tag_offsets)
+    empty!(writer.file_sizes)
+  end
+end
+
+# The manifest for a per-tag directory or single file, picking up where an earlier manifest left off, since per-tag files
+# are appended to. Returns nothing when the directory already has output that no manifest accounts for.
+function tag_manifest!(writer::TagFileWriter, manifest_file_name, directory)
+  if !haskey(writer.manifests, manifest_file_name)
+    if writer.single_file
+      writer.manifests[manifest_file_name] = Dict{String, TagManifestEntry}()
+    elseif isfile(manifest_file_name)
+      writer.manifests[manifest_file_name] = read_tag_manifest(manifest_file_name)
+    elseif isdir(directory) && !isempty(readdir(directory))
+      writer.manifests[manifest_file_name] = nothing
+    else
+      writer.manifests[manifest_file_name] = Dict{String, TagManifestEntry}()
+    end
+  end
+  return writer.manifests[manifest_file_name]
+end
+
+function file_handle!(writer::TagFileWriter, output_file_name)
+  if !haskey(writer.open_files, output_file_name)
+    if length(writer.open_files) >= writer.max_open_files
+      close_least_recently_used!(writer)
+    end
+    # Single files are started afresh by this writer, per-tag files are appended to like write_to_file does
+    first_open = !(output_file_name in writer.opened)
+    push!(writer.opened, output_file_name)
+    writer.open_files[output_file_name] = open(output_file_name, writer.single_file && first_open ? "w" : "a")
+  end
+  return writer.open_files[output_file_name]
+end
+
+# Closes the eighth of the open files least recently written to, so that eviction isn't needed on every new file
+function close_least_recently_used!(writer::TagFileWriter)
+  open_file_names = sort!(collect(keys(writer.open_files)), by=name -> writer.last_used[name])
+  for output_file_name in open_file_names[1:min(length(open_file_names), max(1, writer.max_open_files ÷ 8))]
+    close(pop!(writer.open_files, output_file_name))
+  end
+end
+
+# Rewrites a single unsorted file so that each tag's records are contiguous, and writes the index of where each tag is
+function sort_by_tag(unsorted_file_name, offsets)
+  sorted_file_name = unsorted_file_name[1:end-length(UNSORTED_EXTENSION)]
+  index_file_name = "$(splitext(sorted_file_name)[1])$(SORTED_INDEX_EXTENSION)"
+  buffer = Vector{UInt8}()
+  open(unsorted_file_name, "r") do unsorted
+    open(sorted_file_name, "w") do sorted
+      open(index_file_name, "w") do index
+        sorted_offset = 0
+        for tag in sort!(collect(keys(offsets)))
+          tag_length = 0
+          for (offset, record_length) in offsets[tag]
+            resize!(buffer, record_length)
+            seek(unsorted, offset)
+            read!(unsorted, buffer)
+            write(sorted, buffer)
+            tag_length += record_length
+          end
+          println(index, "$(tag)\t$(sorted_offset)\t$(tag_length)\t$(length(offsets[tag]))")
+          sorted_offset += tag_length
+        end
+      end
+    end
+  end
+end
+
+function write_to_file_count_to_dict(writer::TagFileWriter, dictionary, source_file_name, template, tag, output_sequence, score)
+  write_to_tag_file_writer(writer, source_file_name, template, tag, output_sequence, score)
+  count_to_dict(dictionary, source_file_name, template, tag)
+end
@@ -0,0 +1,80 @@
+#export TagManifestEntry, write_tag_manifest, read_tag_manifest
+
+const TAG_MANIFEST_FILE_NAME = "tags.manifest"
+const TAG_MANIFEST_EXTENSION = ".manifest"
+const TAG_MANIFEST_MAGIC = "PORPIDTM"
+const TAG_MANIFEST_VERSION = UInt32(1)
+
+# What extraction knows about every tag of a source file and template: how many reads it has,
+# the sum of their alignment scores and which file they were written to (relative to the manifest)
+mutable struct TagManifestEntry
+  count::Int64
+  score_sum::Float64
+  file_name::String
+end
+
+# Binary layout, all little-endian:
+#   magic ("PORPIDTM"), version (UInt32), number of entries (UInt64), then for each entry
+#   tag length (UInt16), tag, count (Int64), summed score (Float64), file name length (UInt16), file name
+function write_tag_manifest(manifest_file_name, entries::Dict{String, TagManifestEntry})
+  open(manifest_file_name, "w") do io
+    write(io, TAG_MANIFEST_MAGIC)
+    write(io, htol(TAG_MANIFEST_VERSION))
+    write(io, htol(UInt64(length(entries))))
+    for tag in sort!(collect(keys(entries)))
+      entry = entries[tag]
+      write(io, htol(UInt16(sizeof(tag))))
+      write(io, tag)
+      write(io, htol(entry.count))
+      write(io, htol(entry.score_sum))
+      write(io, htol(UInt16(sizeof(entry.file_name))))
+      write(io, entry.file_name)
+    end
+  end
+end
+
+function read_tag_manifest(manifest_file_name)
+  entries = Dict{String, TagManifestEntry}()
+  open(manifest_file_name, "r") do io
+    if String(read(io, sizeof(TAG_MANIFEST_MAGIC))) != TAG_MANIFEST_MAGIC
+      error("$(manifest_file_name) is not a tag manifest")
+    end
+    version = ltoh(read(io, UInt32))
+    if version != TAG_MANIFEST_VERSION
+      error("$(manifest_file_name) has unsupported tag manifest version $(version)")
+    end
+    entry_count = ltoh(read(io, UInt64))
+    sizehint!(entries, entry_count)
+    for i in 1:entry_count
+      tag = String(read(io, ltoh(read(io, UInt16))))
+      count = ltoh(read(io, Int64))
+      score_sum = ltoh(read(io, Float64))
+      file_name = String(read(io, ltoh(read(io, UInt16))))
+      entries[tag] = TagManifestEntry(count, score_sum, file_name)
+    end
+  end
+  return entries
+end
+
+function add_to_tag_manifest!(entries::Dict{String, TagManifestEntry}, tag, file_name, score)
+  if haskey(entries, tag)
+    entry = entries[tag]
+    entry.count += 1
+    entry.score_sum += score
+  else
+    entries[tag] = TagManifestEntry(1, score, file_name)
+  end
+end
+
+# The counts and file names that resolve_tags_in_dir would otherwise get from tag_counts and tag_to_filename
+function manifest_counts(entries::Dict{String, TagManifestEntry})
+  counts = Dict{String, Int32}()
+  file_name_of_tag = Dict{String, String}()
+  for (tag, entry) in entries
+    if tag != REJECT_TAG
+      counts[tag] = entry.count
+      file_name_of_tag[tag] = entry.file_name
+    end
+  end
+  return counts, file_name_of_tag
+end
@@ -0,0 +1,126 @@
+#export TemplatePrefilter, PrefilterStats
+using BioSequences
+using PORPID
+
+const DEFAULT_SEED_LENGTH = 8
+const DEFAULT_HIT_FRACTION = 0.5
+const NO_TEMPLATES = Vector{Int}()
+
+# Index of every seed_length-mer found in the known (ObservableState) parts of each template.
+# Barcode and RepeatingAnyState regions are never indexed, since they aren't expected to match exactly.
+struct TemplatePrefilter
+  seed_length::Int
+  hit_fraction::Float64
+  template_count::Int
+  seeds::Dict{UInt64, Vector{Int}}
+end
+
+# Counters for how much work the prefilter and score bounds saved; safe to share between threads
+struct PrefilterStats
+  reads::Threads.Atomic{Int}
+  alignments::Threads.Atomic{Int}
+  skipped::Threads.Atomic{Int}
+  abandoned::Threads.Atomic{Int}
+  fallbacks::Threads.Atomic{Int}
+end
+
+PrefilterStats() = PrefilterStats(Threads.Atomic{Int}(0), Threads.Atomic{Int}(0), Threads.Atomic{Int}(0), Threads.Atomic{Int}(0), Threads.Atomic{Int}(0))
+
+# Adds the counts of other into stats
+function add_prefilter_stats!(stats::PrefilterStats, other::PrefilterStats)
+  for counter in (:reads, :alignments, :skipped, :abandoned, :fallbacks)
+    Threads.atomic_add!(getfield(stats, counter), getfield(other, counter)[])
+  end
+  return stats
+end
+add_prefilter_stats!(stats::Nothing, other::Nothing) = nothing
+
+function Base.show(io::IO, stats::PrefilterStats)
+  print(io, "PrefilterStats(reads=$(stats.reads[]), alignments=$(stats.alignments[]), skipped=$(stats.skipped[]), ",
+            "abandoned=$(stats.abandoned[]), fallbacks=$(stats.fallbacks[]))")
+end
+
+function two_bit_code(nucleotide::DNA)
+  if nucleotide == DNA_A
+    return 0
+  elseif nucleotide == DNA_C
+    return 1
+  elseif nucleotide == DNA_G
+    return 2
+  elseif nucleotide == DNA_T
+    return 3
+  end
+  return -1
+end
+
+function TemplatePrefilter(templates, seed_length=DEFAULT_SEED_LENGTH; hit_fraction=DEFAULT_HIT_FRACTION)
+  if !(1 <= seed_length <= 31)
+    throw(ArgumentError("seed_length must be between 1 and 31, got $(seed_length)"))
+  end
+  mask = (UInt64(1) << (2 * seed_length)) - 1
+  seeds = Dict{UInt64, Vector{Int}}()
+  for (template_index, template) in enumerate(templates)
+    code = UInt64(0)
+    run_length = 0
+    compiled = template.compiled
+    for (kind, value) in zip(compiled.kinds, compiled.values)
+      nucleotide_code = -1
+      if kind == STATE_OBSERVABLE
+        nucleotide_code = two_bit_code(value)
+      end
+      if nucleotide_code < 0
+        code = UInt64(0)
+        run_length = 0
+        continue
+      end
+      code = ((code << 2) | UInt64(nucleotide_code)) & mask
+      run_length += 1
+      if run_length >= seed_length
+        template_indices = get!(seeds, code, Vector{Int}())
+        if isempty(template_indices) || template_indices[end] != template_index
+          push!(template_indices, template_index)
+        end
+      end
+    end
+  end
+  return TemplatePrefilter(seed_length, hit_fraction, length(templates), seeds)
+end
+
+# Number of seeds of each template found in seq
+function seed_hits(prefilter::TemplatePrefilter, seq)
+  hits = zeros(Int, prefilter.template_count)
+  mask = (UInt64(1) << (2 * prefilter.seed_length)) - 1
+  code = UInt64(0)
+  run_length = 0
+  for nucleotide in seq
+    nucleotide_code = two_bit_code(nucleotide)
+    if nucleotide_code < 0
+      code = UInt64(0)
+      run_length = 0
+      continue
+    end
+    code = ((code << 2) | UInt64(nucleotide_code)) & mask
+    run_length += 1
+    if run_length >= prefilter.seed_length
+      for template_index in get(prefilter.seeds, code, NO_TEMPLATES)
+        hits[template_index] += 1
+      end
+    end
+  end
+  return hits
+end
+
+# Chooses which templates are worth aligning on each strand: those with at least hit_fraction of the best seed hit count.
+# The strand with fewer hits usually ends up with no candidates at all.
+# Returns nothing for both strands (align everything) when no seeds are found, as there's nothing to go on.
+function seed_candidates(prefilter::TemplatePrefilter, forward_seq, reverse_seq=nothing, stats=nothing)
+  forward_hits = seed_hits(prefilter, forward_seq)
+  reverse_hits = reverse_seq === nothing ? zeros(Int, 0) : seed_hits(prefilter, reverse_seq)
+  best_hits = max(isempty(forward_hits) ? 0 : maximum(forward_hits), isempty(reverse_hits) ? 0 : maximum(reverse_hits))
+  if best_hits == 0
+    stats === nothing || Threads.atomic_add!(stats.fallbacks, 1)
+    return nothing, nothing
+  end
+  threshold = max(1, ceil(Int, best_hits * prefilter.hit_fraction))
+  return forward_hits .>= threshold, reverse_hits .>= threshold
+end
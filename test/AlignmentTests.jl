@@ -0,0 +1,107 @@
+using Test
+using BioSequences
+using PORPID
+
+@testset "Alignment" begin
+    seqs = getsequences("test_data/basic.fastq")
+    templates = example_config().templates
+    window(seq) = FASTQ.sequence(seq)[1:min(39, length(FASTQ.sequence(seq)))]
+
+    @testset "Reused buffer gives the same result as a fresh one" begin
+        buffer = AlignmentBuffer()
+        for seq in seqs, template in templates
+            forward = window(seq)
+            quality = fill(Int8(30), length(forward))
+            @test extract_tag(forward, quality, template.reference, buffer) ==
+                  extract_tag(forward, quality, template.reference, AlignmentBuffer())
+        end
+        # The default buffer belongs to the task, not the thread it happens to be running on
+        @test PORPID.task_alignment_buffer() === PORPID.task_alignment_buffer()
+        @test fetch(@async PORPID.task_alignment_buffer()) !== PORPID.task_alignment_buffer()
+    end
+
+    @testset "Wide band gives the same result as the full matrix" begin
+        for seq in seqs, template in templates
+            forward = window(seq)
+            quality = fill(Int8(30), length(forward))
+            @test extract_tag(forward, quality, template.reference; band_width=length(forward)) ==
+                  extract_tag(forward, quality, template.reference)
+        end
+    end
+
+    @testset "Narrow band still finds the tag" begin
+        sequence = dna"GATTACAGATTACAACTGGTGATTACAAAAATAGGGGGG"
+        quality = fill(Int8(30), length(sequence))
+        reference = string_to_state_array("GATTACAGATTACAnnnnnnGATTACA*")
+        score, tag, errors = extract_tag(sequence, quality, reference; band_width=2, max_star_gap=0)
+        @test (score, tag, errors) == extract_tag(sequence, quality, reference)
+        @test string(tag) == "ACTGGT"
+    end
+
+    @testset "Compiled templates" begin
+        compiled = CompiledTemplate(string_to_state_array("GAnn*T"))
+        @test compiled.kinds == [PORPID.STATE_START, PORPID.STATE_OBSERVABLE, PORPID.STATE_OBSERVABLE,
+                                 PORPID.STATE_BARCODE, PORPID.STATE_BARCODE, PORPID.STATE_ANY, PORPID.STATE_OBSERVABLE]
+        @test compiled.values[2:end] == [DNA_G, DNA_A, DNA_N, DNA_N, DNA_N, DNA_T]
+        @test compiled.insertion_in_tag == [false, false, true, true, true, false, false]
+        @test compiled.remaining_bound[end] == 0.0
+        @test compiled.remaining_bound[5] == compiled.remaining_bound[6]
+        for seq in seqs, template in templates
+            forward = window(seq)
+            quality = fill(Int8(30), length(forward))
+            @test extract_tag(forward, quality, template.compiled) == extract_tag(forward, quality, template.reference)
+        end
+    end
+
+    @testset "Score-only ranking" begin
+        buffer = AlignmentBuffer()
+        for seq in seqs
+            forward = window(seq)
+            quality = fill(Int8(30), length(forward))
+            full = [extract_tag(forward, quality, template.compiled) for template in templates]
+            for (template, (score, tag, errors)) in zip(templates, full)
+                @test alignment_score(forward, quality, template.compiled, buffer) == score
+                @test alignment_score(forward, quality, template.compiled, buffer; band_width=2, max_star_gap=0) ==
+                      extract_tag(forward, quality, template.compiled; band_width=2, max_star_gap=0)[1]
+            end
+            # Later templates win ties, as they did when every template was aligned in full
+            best = 0
+            for k in 1:length(full)
+                if best == 0 || full[k][1] >= full[best][1]
+                    best = k
+                end
+            end
+            @test PORPID.choose_best_template(forward, quality, templates) == (full[best][1], templates[best], full[best][2], full[best][3])
+        end
+    end
+
+    @testset "Prefilter and pruning" begin
+        # simulated.fastq has reads on both strands, and noisy ones whose primers have few exact seeds left
+        results(config; kwargs...) = begin
+            found = []
+            extract_tags_from_file("test_data/simulated.fastq", config,
+                                   (source, template, tag, sequence, score) -> push!(found, (FASTQ.identifier(sequence), template === nothing ? "" : template.name, tag, score)); kwargs...)
+            found
+        end
+        exhaustive = results(example_config())
+        pruned_config = example_config()
+        pruned_config.prune_alignments = true
+        stats = PrefilterStats()
+        @test results(pruned_config; prefilter_stats=stats) == exhaustive
+        @test stats.skipped[] == 0
+        @test stats.abandoned[] > 0
+        seeded_config = example_config()
+        seeded_config.prefilter_seed_length = 7
+        stats = PrefilterStats()
+        seeded = results(seeded_config; prefilter_stats=stats)
+        @test length(seeded) == length(exhaustive)
+        # Junk reads have no template to find, so the prefilter is free to pick another one for them
+        for ((identifier, name, tag, score), (exhaustive_identifier, exhaustive_name, exhaustive_tag, exhaustive_score)) in zip(seeded, exhaustive)
+            @test identifier == exhaustive_identifier
+            startswith(identifier, "Junk") && continue
+            @test (name, tag) == (exhaustive_name, exhaustive_tag)
+        end
+        @test stats.reads[] == length(exhaustive)
+        @test stats.skipped[] > 0
+    end
+end
@@ -19,4 +19,116 @@ using Test
   @testset "Processing more than basic fastq" begin
     extract_tags_from_file("test_data/more_than_basic.fastq", cfg, check_bins)
   end
+  @testset "Processing simulated reads on both strands" begin
+    # simulated.fastq has 400 reads of either template on either strand (F or R at the end of the read name):
+    # clean ones, noisy ones with substitutions or an indel in the primer, and junk
+    results = []
+    extract_tags_from_file("test_data/simulated.fastq", cfg, (source, template, tag, record, score) -> push!(results, (FASTQ.identifier(record), template, tag, record.reverse_complemented)))
+    @test length(results) == 400
+    @test count(result -> result[4], results) > 100
+    for (identifier, template, tag, reverse_complemented) in results
+      startswith(identifier, "Clean") || continue
+      name, authority_template, authority_tag = split(identifier, "-")
+      @test template.name == authority_template
+      @test tag == authority_tag
+      @test reverse_complemented == endswith(name, "R")
+    end
+  end
+  @testset "Dictionary output holds FASTQ records" begin
+    dictionary, oriented = Dict(), Dict()
+    extract_tags_from_file("test_data/simulated.fastq", cfg, (args...) -> PORPID.write_to_dictionary(dictionary, args...))
+    extract_tags_from_file("test_data/simulated.fastq", cfg, (source, template, tag, record, score) -> oriented[FASTQ.identifier(record)] = record)
+    stored = [record for tags in values(dictionary) for scored_records in values(tags) for (score, record) in scored_records]
+    @test length(stored) == 400
+    for record in stored
+      @test record isa FASTQ.Record
+      @test FASTQ.sequence(record) == FASTQ.sequence(oriented[FASTQ.identifier(record)])
+      @test FASTQ.quality(record) == FASTQ.quality(oriented[FASTQ.identifier(record)])
+    end
+    # Reverse strand reads are stored reverse complemented
+    @test any(oriented[FASTQ.identifier(record)].reverse_complemented for record in stored)
+  end
+  @testset "Processing in parallel chunks" begin
+    extract_tags_from_file("test_data/basic.fastq", cfg, check_bins; threads=4, chunk_size=1)
+    serial, parallel, unordered = [], [], []
+    collect_to(results) = (source_file_name, template, tag, output_sequence, score) -> push!(results, (FASTQ.identifier(output_sequence), template === nothing ? "" : template.name, tag, score))
+    extract_tags_from_file("test_data/simulated.fastq", cfg, collect_to(serial))
+    # Far more chunks than threads, so chunks finish out of order and the channels fill up
+    extract_tags_from_file("test_data/simulated.fastq", cfg, collect_to(parallel); threads=4, chunk_size=7)
+    extract_tags_from_file("test_data/simulated.fastq", cfg, collect_to(unordered); threads=4, chunk_size=7, ordered=false)
+    @test length(serial) == 400
+    @test parallel == serial
+    @test sort(unordered) == sort(serial)
+    # A failure while writing stops the readers and aligners instead of leaving them waiting
+    failing_output(source_file_name, template, tag, output_sequence, score) = error("output failed")
+    @test_throws ErrorException extract_tags_from_file("test_data/basic.fastq", cfg, failing_output; threads=4, chunk_size=1)
+  end
+  @testset "Compressed and auto-detected input" begin
+    @test detect_file_type("test_data/basic.fastq") == fastq
+    results(file_name, config) = begin
+      collected = []
+      extract_tags_from_file(file_name, config, (source, template, tag, record, score) -> push!(collected, (FASTQ.identifier(record), template.name, tag, score)))
+      collected
+    end
+    plain = results("test_data/basic.fastq", cfg)
+    auto_cfg = example_config()
+    auto_cfg.filetype = auto
+    @test results("test_data/basic.fastq", auto_cfg) == plain
+    # more_than_basic.fastq is empty, which is no records rather than an unknown file type
+    empty_file_name = joinpath(mktempdir(), "empty")
+    cp("test_data/more_than_basic.fastq", empty_file_name)
+    @test detect_file_type(empty_file_name) == fastq
+    @test isempty(results(empty_file_name, auto_cfg))
+    @test isempty(results("test_data/more_than_basic.fastq", auto_cfg))
+    gzip = Sys.which("gzip")
+    if gzip !== nothing
+      compressed_file_name = joinpath(mktempdir(), "basic")
+      run(pipeline(`$gzip -c test_data/basic.fastq`, stdout=compressed_file_name))
+      @test detect_file_type(compressed_file_name) == fastq
+      @test results(compressed_file_name, auto_cfg) == plain
+      # A truncated file fails instead of quietly losing the reads after the cut
+      truncated_file_name = joinpath(mktempdir(), "basic.fastq.gz")
+      write(truncated_file_name, read(compressed_file_name)[1:div(filesize(compressed_file_name), 2)])
+      @test_throws ErrorException results(truncated_file_name, cfg)
+      # Closing doesn't raise it, so that it can't hide the error that stopped the extraction early
+      reader = open_sequence_reader(truncated_file_name, fastq)
+      wait(reader.process)
+      @test close(reader) === nothing
+    end
+  end
+  @testset "Extraction metrics" begin
+    plain, measured = [], []
+    collect_to(results) = (source_file_name, template, tag, output_sequence, score) -> push!(results, (template.name, tag, score))
+    extract_tags_from_file("test_data/basic.fastq", cfg, collect_to(plain))
+    io = IOBuffer()
+    metrics = ExtractionMetrics(sink=JSONLinesSink(io), report_every=2)
+    extract_tags_from_file("test_data/basic.fastq", cfg, collect_to(measured); metrics=metrics)
+    @test measured == plain
+    summary = metrics_summary(metrics)
+    reads = length(plain)
+    @test summary["reads"] == reads
+    @test summary["forward_wins"] + summary["reverse_wins"] == reads
+    @test summary["no_tag"] == count(result -> result[2] == "NO_TAG", plain)
+    @test summary["rejects"] == count(result -> result[2] == "REJECTS", plain)
+    @test sum(values(summary["template_wins"])) == reads
+    @test sum(values(summary["error_histogram"])) == reads
+    @test summary["dp_cells"] > 0
+    lines = [PORPID.JSON.parse(line) for line in split(strip(String(take!(io))), '\n')]
+    @test length(lines) == div(reads, 2) + 1
+    @test lines[end]["final"] && lines[end]["reads"] == reads
+    @test !lines[1]["final"] && lines[1]["reads"] == 2
+    # Reports are per file, and the summary adds the files up
+    extract_tags_from_file("test_data/basic.fastq", cfg, (args...) -> nothing; metrics=metrics)
+    lines = [PORPID.JSON.parse(line) for line in split(strip(String(take!(io))), '\n')]
+    @test length(lines) == div(reads, 2) + 1
+    @test lines[end]["final"] && lines[end]["reads"] == reads
+    @test metrics_summary(metrics)["reads"] == 2 * reads
+    # Chunks aligned in parallel are measured on their own and merged into the same totals
+    threaded_metrics = ExtractionMetrics()
+    extract_tags_from_file("test_data/basic.fastq", cfg, (args...) -> nothing; metrics=threaded_metrics, threads=4, chunk_size=1, ordered=false)
+    threaded_summary = metrics_summary(threaded_metrics)
+    for key in ("reads", "dp_cells", "forward_wins", "reverse_wins", "no_tag", "rejects", "template_wins", "error_histogram")
+      @test threaded_summary[key] == summary[key]
+    end
+  end
 end
@@ -0,0 +1,84 @@
+using Test
+using PORPID
+
+@testset "LDA backends" begin
+    counts = Dict("GATTACA" => 50, "GATTAC" => 2, "GATTTACA" => 1, "GCTTACA" => 3, "TAGACAT" => 20,
+                  "TAGACAA" => 1, "CCCGGGA" => 7, "CCCGGGAA" => 7, "ACGTACG" => 1)
+    tag_to_index, index_to_tag = tag_index_mapping(keys(counts))
+    probabilities_array = prob_observed_tags_given_reals(tag_to_index, PORPID.PacBioErrorModel())
+    indexed_counts = index_counts(counts, tag_to_index)
+    classic = LDA(probabilities_array, indexed_counts)
+    likelihoods = LikelihoodMatrix(probabilities_array)
+
+    @testset "CSR storage keeps every likelihood" begin
+        @test length(likelihoods) == length(probabilities_array)
+        for obs in 1:length(probabilities_array)
+            row = likelihoods.row_starts[obs]:likelihoods.row_starts[obs+1]-1
+            @test collect(zip(likelihoods.columns[row], likelihoods.values[row])) == probabilities_array[obs]
+        end
+    end
+
+    @testset "sparse_LDA agrees with LDA (accelerate=$accelerate)" for accelerate in [false, true]
+        result = sparse_LDA(likelihoods, indexed_counts; accelerate=accelerate)
+        @test 0 < result.iterations <= 1000
+        @test sum(result.prior) ≈ 1.0
+        for obs in 1:length(classic)
+            @test result.most_likely_real_for_each_obs[obs][1] == classic[obs][1]
+            @test isapprox(result.most_likely_real_for_each_obs[obs][2], classic[obs][2]; atol=1e-4)
+        end
+    end
+
+    @testset "components_LDA agrees with sparse_LDA" begin
+        components = PORPID.likelihood_components(likelihoods)
+        @test sort(vcat(components...)) == 1:length(likelihoods)
+        @test [tag_to_index["ACGTACG"]] in components
+        @test any(component -> tag_to_index["GATTACA"] in component && tag_to_index["GATTAC"] in component, components)
+        sparse = sparse_LDA(likelihoods, indexed_counts)
+        result = components_LDA(likelihoods, indexed_counts)
+        @test sum(result.prior) ≈ 1.0
+        @test result.most_likely_real_for_each_obs[tag_to_index["ACGTACG"]] == (tag_to_index["ACGTACG"], 1.0)
+        for obs in 1:length(classic)
+            @test result.most_likely_real_for_each_obs[obs][1] == sparse.most_likely_real_for_each_obs[obs][1]
+            @test isapprox(result.most_likely_real_for_each_obs[obs][2], sparse.most_likely_real_for_each_obs[obs][2]; atol=1e-4)
+            @test isapprox(result.prior[obs], sparse.prior[obs]; atol=1e-6)
+        end
+    end
+end
+
+@testset "Incremental resolution" begin
+    first_batch = Dict("GATTACA" => 30, "GATTAC" => 1, "TAGACAT" => 12, "CCCGGGA" => 4, "ACGTACG" => 1)
+    second_batch = Dict("GATTACA" => 20, "GATTAC" => 1, "GATTTACA" => 1, "GCTTACA" => 3, "TAGACAT" => 8,
+                        "TAGACAA" => 1, "CCCGGGA" => 3, "CCCGGGAA" => 7)
+    state = ResolutionState(PORPID.PacBioErrorModel())
+    @test update_resolution_state!(state, first_batch; batch="first") == length(first_batch)
+    computed_rows = update_resolution_state!(state, second_batch; batch="second")
+    @test computed_rows < length(state.tags)
+    @test sum(state.prior) ≈ 1.0
+
+    counts = merge(+, first_batch, second_batch)
+    probabilities_array = prob_observed_tags_given_reals(state.tag_to_index, PORPID.PacBioErrorModel())
+    for obs in 1:length(state.tags)
+        row = state.likelihoods.row_starts[obs]:state.likelihoods.row_starts[obs+1]-1
+        @test Dict(zip(state.likelihoods.columns[row], state.likelihoods.values[row])) == Dict(probabilities_array[obs])
+        @test state.counts[obs] == counts[state.tags[obs]]
+    end
+
+    classic = LDA(probabilities_array, index_counts(counts, state.tag_to_index))
+    result = sparse_LDA(state.likelihoods, state.counts; initial_prior=state.prior)
+    for obs in 1:length(classic)
+        @test result.most_likely_real_for_each_obs[obs][1] == classic[obs][1]
+        @test isapprox(result.most_likely_real_for_each_obs[obs][2], classic[obs][2]; atol=1e-4)
+    end
+
+    state_file_name = joinpath(mktempdir(), "resolution.state")
+    write_resolution_state(state_file_name, state)
+    saved = read_resolution_state(state_file_name)
+    @test saved.tags == state.tags
+    @test saved.tag_to_index == state.tag_to_index
+    @test saved.counts == state.counts
+    @test saved.batches == ["first", "second"]
+    @test saved.prior == state.prior
+    @test saved.likelihoods.row_starts == state.likelihoods.row_starts
+    @test saved.likelihoods.columns == state.likelihoods.columns
+    @test saved.likelihoods.values == state.likelihoods.values
+end
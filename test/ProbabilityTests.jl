@@ -18,4 +18,13 @@ using PORPID
         #@test prob(DNA_M, DNA_A, 0.9) ≈ 0.9 + 0.1/3
         #@test prob(DNA_M, DNA_T, 0.9) ≈ 0.1*2/3
     end
+
+    @testset "Log emission table matches direct calculation" begin
+        for expected in [DNA_A, DNA_C, DNA_G, DNA_T, DNA_M, DNA_N], observed in [DNA_A, DNA_C, DNA_G, DNA_T, DNA_N]
+            for phred in 0:PORPID.MAX_PHRED_SCORE
+                @test log_emission_prob(expected, observed, phred) ===
+                      log(prob(expected, observed, phred_score_to_prob(phred)))
+            end
+        end
+    end
 end
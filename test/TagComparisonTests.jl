@@ -77,4 +77,55 @@ end
         words = """AT CT CA"""
         test_neighbors(tag, words, PORPID.deletion_neighbors)
     end
+
+    @testset "Packed tags" begin
+        tag = "GATTACA"
+        packed = PORPID.pack_tag(tag)
+        @test length(packed) == length(tag)
+        @test string(packed) == tag
+        @test PORPID.pack_tag("NO_TAG") === nothing
+        for c in "ACTG"
+            for i in 1:length(tag) + 1
+                @test string(PORPID.insert_at(packed, i, c)) == PORPID.insert_at(tag, i, c)
+            end
+            for i in 1:length(tag)
+                @test string(PORPID.replace_at(packed, i, c)) == PORPID.replace_at(tag, i, c)
+            end
+        end
+        for i in 1:length(tag)
+            @test string(PORPID.without(packed, i)) == PORPID.without(tag, i)
+        end
+    end
+
+    @testset "Packed and String likelihoods are identical (recurse=$recurse)" for recurse in [0, 1]
+        tags = ["CAT", "CAAT", "CCAT", "AT", "CA", "CGT", "CATG", "GATTACA", "GATACA", "NO_TAG"]
+        tag_to_index, index_to_tag = tag_index_mapping(tags)
+        packed_to_index = PORPID.pack_tag_index(tag_to_index)
+        for tag in tags[1:end-1]
+            @test PORPID.prob_observed_tag_given_reals(PORPID.pack_tag(tag), packed_to_index, PORPID.PacBioErrorModel(), recurse) ==
+                  PORPID.prob_observed_tag_given_reals(tag, tag_to_index, PORPID.PacBioErrorModel(), recurse)
+        end
+        probabilities_array = prob_observed_tags_given_reals(tag_to_index, PORPID.PacBioErrorModel(), recurse)
+        @test probabilities_array[tag_to_index["NO_TAG"]] == [(tag_to_index["NO_TAG"], (1 - 0.005) ^ 6)]
+    end
+
+    @testset "Deletion index" begin
+        tags = ["CAT", "CAAT", "CCAT", "AT", "CGT", "CATG", "GATTACA", "GATACA", "TTTTTTTT"]
+        tag_to_index, index_to_tag = tag_index_mapping(tags)
+        packed_to_index = PORPID.pack_tag_index(tag_to_index)
+        deletion_index = PORPID.DeletionIndex(keys(packed_to_index), 2)
+        for word in ["CAT", "GGGG", "TTTTTT", "GATTTTACA", "ACGTACGT", "", "AAAAAAAAAAAA"], distance in 0:2
+            packed = PORPID.pack_tag(word)
+            within = haskey(packed_to_index, packed) || !isempty(PORPID.indices_within_distance(packed, packed_to_index, distance))
+            # Never rules out a tag that does have a real tag close enough
+            @test PORPID.may_have_real_within(deletion_index, packed, distance) || !within
+        end
+        @test !PORPID.may_have_real_within(deletion_index, PORPID.pack_tag("AAAAAAAAAAAA"), 2)
+        for recurse in [1, 2], tag in tags
+            packed = PORPID.pack_tag(tag)
+            @test PORPID.prob_observed_tag_given_reals(packed, packed_to_index, PORPID.PacBioErrorModel(), recurse,
+                                                       PORPID.NeighborCache{PORPID.PackedTag}(), PORPID.DeletionIndex(keys(packed_to_index), recurse)) ==
+                  PORPID.prob_observed_tag_given_reals(packed, packed_to_index, PORPID.PacBioErrorModel(), recurse)
+        end
+    end
 end
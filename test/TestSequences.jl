@@ -27,10 +27,36 @@ test_slices = [((1, -1, -1, 1, false), gattaca_seq, "Full Seq"),
     seqs = getsequences("test_data/basic.fastq")
     @test length(seqs) == 2
     @test string(FASTQ.sequence(seqs[1])) == uppercase(gattaca_seq)
+    # Reverse complements the whole read and then takes the window, as slicing used to
+    function full_read_quality_slice(record, start_i, r_start_i, end_i, r_end_i, do_reverse_complement)
+        quality = Int8.(FASTQ.quality(record))
+        do_reverse_complement && reverse!(quality)
+        read_length = length(quality)
+        start_i = start_i < 0 && r_start_i > 0 ? read_length - r_start_i + 1 : start_i
+        end_i = end_i < 0 && r_end_i > 0 ? read_length - r_end_i + 1 : end_i
+        start_i, end_i = min(read_length, max(1, start_i)), min(read_length, max(1, end_i))
+        return start_i > end_i ? reverse(quality[end_i:start_i]) : quality[start_i:end_i]
+    end
     @testset "Slicing: $(t[3])" for t in test_slices
         sliced_sequence, sliced_quality = slice_sequence(seqs[1], t[1]...)
         @test string(sliced_sequence) == uppercase(t[2])
-        # TODO: Test that the qualitie's get sliced correctly too
+        @test collect(sliced_quality) == full_read_quality_slice(seqs[1], t[1]...)
     end
 
+    @testset "Oriented records" begin
+        forward = OrientedRecord(seqs[1], false)
+        @test FASTQ.Record(forward) === seqs[1]
+        reverse_record = FASTQ.Record(OrientedRecord(seqs[1], true))
+        @test FASTQ.identifier(reverse_record) == FASTQ.identifier(seqs[1])
+        @test string(FASTQ.sequence(reverse_record)) == uppercase(reversecomplement)
+        @test FASTQ.quality(reverse_record) == reverse(FASTQ.quality(seqs[1]))
+        fasta_record = FASTA.Record("fasta_read", FASTQ.sequence(seqs[1]))
+        @test string(slice_sequence(fasta_record, test_slices[7][1]...)[1]) == test_slices[7][2]
+        @test all(slice_sequence(fasta_record, test_slices[7][1]...)[2] .== PORPID.DEFAULT_QUALITY)
+        output = IOBuffer()
+        write(FASTQ.Writer(output), OrientedRecord(fasta_record, true))
+        written = first(collect(FASTQ.Reader(IOBuffer(take!(output)))))
+        @test string(FASTQ.sequence(written)) == uppercase(reversecomplement)
+        @test all(FASTQ.quality(written) .== PORPID.DEFAULT_QUALITY)
+    end
 end
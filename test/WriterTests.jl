@@ -0,0 +1,132 @@
+using Test
+using BioSequences
+using Distributed
+using PORPID
+
+@testset "Tag file writer" begin
+    cfg = example_config()
+    expected_counts = Dict()
+    extract_tags_from_file("test_data/basic.fastq", cfg, (args...) -> PORPID.count_to_dict(expected_counts, args[1:3]...))
+
+    @testset "One file per tag with a tiny pool" begin
+        output_folder = mktempdir()
+        writer = TagFileWriter(output_folder=output_folder, max_open_files=1, max_buffered_bytes=1)
+        extract_tags_from_file("test_data/basic.fastq", cfg, (args...) -> write_to_tag_file_writer(writer, args...))
+        close(writer)
+        for template in cfg.templates
+            directory = joinpath(output_folder, "basic.fastq", template.name)
+            for (tag, count) in get(expected_counts, "test_data/basic.fastq/$(template.name)", Dict())
+                @test length(getsequences(joinpath(directory, "$(tag).fastq"))) == count
+            end
+            if isdir(directory)
+                manifest = read_tag_manifest(joinpath(directory, PORPID.TAG_MANIFEST_FILE_NAME))
+                for (tag, entry) in manifest
+                    @test entry.count == expected_counts["test_data/basic.fastq/$(template.name)"][tag]
+                    @test entry.file_name == "$(tag).fastq"
+                end
+                manifest_tag_counts, file_names = PORPID.manifest_counts(manifest)
+                rm(joinpath(directory, PORPID.TAG_MANIFEST_FILE_NAME))
+                @test manifest_tag_counts == PORPID.tag_counts("$(directory)/")
+                @test file_names == PORPID.tag_to_filename(directory)
+            end
+        end
+    end
+
+    @testset "Out of date manifests are ignored" begin
+        output_folder = mktempdir()
+        writer = TagFileWriter(output_folder=output_folder)
+        extract_tags_from_file("test_data/basic.fastq", cfg, (args...) -> write_to_tag_file_writer(writer, args...))
+        close(writer)
+        directory = joinpath(output_folder, "basic.fastq", "GATTACA") * "/"
+        manifest_tag_counts, file_names = PORPID.manifest_counts(read_tag_manifest(joinpath(directory, PORPID.TAG_MANIFEST_FILE_NAME)))
+        @test PORPID.read_tag_counts(directory) == (manifest_tag_counts, file_names)
+        tag, count = first(manifest_tag_counts)
+        tag_file_name = joinpath(directory, "$(tag).fastq")
+        # Appended to after the manifest was written, as write_to_file does
+        sleep(1)
+        records = read(tag_file_name)
+        open(io -> write(io, records), tag_file_name, "a")
+        counts, file_names = PORPID.read_tag_counts(directory)
+        @test counts[tag] == 2 * count
+        # A tag file the manifest doesn't know about
+        touch(joinpath(directory, PORPID.TAG_MANIFEST_FILE_NAME))
+        cp(tag_file_name, joinpath(directory, "AAAAAA.fastq"))
+        counts, file_names = PORPID.read_tag_counts(directory)
+        @test counts["AAAAAA"] == 2 * count
+    end
+
+    @testset "Single sorted file with an index" begin
+        output_folder = mktempdir()
+        writer = TagFileWriter(output_folder=output_folder, single_file=true)
+        extract_tags_from_file("test_data/basic.fastq", cfg, (args...) -> write_to_tag_file_writer(writer, args...))
+        close(writer)
+        for template in cfg.templates
+            tag_counts = get(expected_counts, "test_data/basic.fastq/$(template.name)", Dict())
+            isempty(tag_counts) && continue
+            file_name = joinpath(output_folder, "basic.fastq", "$(template.name).fastq")
+            data = read(file_name)
+            for line in eachline(joinpath(output_folder, "basic.fastq", "$(template.name).index"))
+                tag, offset, len, count = split(line, '\t')
+                @test parse(Int, count) == tag_counts[tag]
+                records = collect(FASTQ.Reader(IOBuffer(data[parse(Int, offset)+1:parse(Int, offset)+parse(Int, len)])))
+                @test length(records) == tag_counts[tag]
+            end
+            @test_throws ArgumentError PORPID.read_tag_counts(file_name)
+        end
+    end
+
+    @testset "Closed writers" begin
+        output_folder = mktempdir()
+        writer = TagFileWriter(output_folder=output_folder, single_file=true)
+        extract_tags_from_file("test_data/basic.fastq", cfg, (args...) -> write_to_tag_file_writer(writer, args...))
+        close(writer)
+        written = Dict(file_name => read(joinpath(output_folder, file_name)) for file_name in PORPID.relative_files(output_folder))
+        @test !isempty(written)
+        close(writer)
+        @test_throws ErrorException extract_tags_from_file("test_data/basic.fastq", cfg, (args...) -> write_to_tag_file_writer(writer, args...))
+        @test Dict(file_name => read(joinpath(output_folder, file_name)) for file_name in PORPID.relative_files(output_folder)) == written
+    end
+
+    @testset "Distributed extraction over record aligned shards" begin
+        ranges = PORPID.record_aligned_ranges("test_data/basic.fastq", fastq, 100)
+        @test length(ranges) > 1
+        @test first(ranges[1]) == 1 && last(ranges[end]) == filesize("test_data/basic.fastq")
+        data = read("test_data/basic.fastq")
+        for k in 1:length(ranges)
+            @test data[first(ranges[k])] == UInt8('@')
+            k > 1 && @test first(ranges[k]) == last(ranges[k-1]) + 1
+        end
+
+        serial_folder = mktempdir()
+        writer = TagFileWriter(output_folder=serial_folder)
+        extract_tags_from_file("test_data/basic.fastq", cfg, (args...) -> write_to_tag_file_writer(writer, args...))
+        close(writer)
+
+        # Shards are extracted on two separate worker processes and merged on this one
+        worker_ids = addprocs(2; exeflags="--project=$(Base.active_project())")
+        try
+            @everywhere worker_ids using PORPID
+            output_folder = mktempdir()
+            metrics, prefilter_stats = ExtractionMetrics(), PrefilterStats()
+            counts = extract_tags_distributed(cfg, output_folder=output_folder, worker_ids=worker_ids, max_shard_bytes=100,
+                                              metrics=metrics, prefilter_stats=prefilter_stats)
+            @test counts == expected_counts
+            # What was measured on the workers makes it back here
+            reads = sum(sum(values(tag_counts)) for tag_counts in values(expected_counts))
+            @test metrics_summary(metrics)["reads"] == reads
+            @test prefilter_stats.reads[] == reads
+            @test !isdir(joinpath(output_folder, PORPID.SHARD_FOLDER))
+            for file_name in PORPID.relative_files(serial_folder)
+                if basename(file_name) == PORPID.TAG_MANIFEST_FILE_NAME
+                    manifest = read_tag_manifest(joinpath(output_folder, file_name))
+                    @test PORPID.manifest_counts(manifest) == PORPID.manifest_counts(read_tag_manifest(joinpath(serial_folder, file_name)))
+                else
+                    @test read(joinpath(output_folder, file_name)) == read(joinpath(serial_folder, file_name))
+                end
+            end
+            @test PORPID.relative_files(output_folder) == PORPID.relative_files(serial_folder)
+        finally
+            rmprocs(worker_ids)
+        end
+    end
+end
@@ -3,6 +3,9 @@ using PORPID
 
 @testset "Binning" begin
     include("BinningTests.jl")
+    include("AlignmentTests.jl")
+    include("WriterTests.jl")
     include("ProbabilityTests.jl")
     include("TagComparisonTests.jl")
+    include("LDATests.jl")
 end
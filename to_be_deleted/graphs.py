@@ -1,4 +1,4 @@
-from collections import namedtuple, defaultdict
+from collections import defaultdict
 try:
     import matplotlib as mpl
 #    mpl.use('Agg')
@@ -13,192 +13,347 @@ except ImportError:
     raise
 import argparse
 
-def log_tag_dist(input_file, line_order=["id"], threshold=None):
-    tag_dist(input_file, line_order, threshold, loglog=True)
+# The input is read this many bytes at a time (rounded up to the end of a line)
+CHUNK_BYTES = 64 * 1024 * 1024
+# Streaming histograms keep at most this many bins before doubling their bin width
+MAX_FINE_BINS = 8192
+NUMERIC_COLUMNS = {"likelihood": np.float64, "errors": np.int64}
+WHITESPACE = np.zeros(256, dtype=bool)
+WHITESPACE[[ord(c) for c in " \t\n\r\x0b\x0c"]] = True
 
-def tag_dist(input_file, line_order=["id"], threshold=None, loglog=False):
-    if "id" not in line_order:
-        print("Tag distribution needs id's")
-        return
 
-    tags = defaultdict(lambda: 0)
-    for line in input_file:
-        parts = line.strip().split()
-        if len(parts) != len(line_order):
-            continue
-        if threshold is not None and "likelihood" in line_order:
-            likelihood = float(parts[line_order.index("likelihood")])
-            if likelihood < threshold:
-                continue
-        barcode = parts[line_order.index("id")]
-        tags[barcode] += 1
-    max_count = 0
-    max_count_tag = None
-    count_dist = defaultdict(lambda: 0)
-    for tag, count in tags.items():
-        if count > max_count:
-            max_count = count
-            max_count_tag = tag
-        count_dist[count] += 1
-    plt.figure(figsize=(30, 5), dpi=300)
-    print("Most common tag: " + str(max_count_tag) + " appears " + str(max_count) +" times")
-    if max_count <= 1000:
-        count_counts = [np.log2(count_dist[i]) for i in range(1, max_count + 1)]
-        bars = plt.bar(range(np.log2(max_count)), count_counts, width=1.0, linewidth=0, log=True)
-        plt.ylim(0.1)
-        xtick_spacing = max(1, int(round(max_count / 250.0) * 5))
-        if loglog:
-            plt.xticks([xtick_spacing/2.0 + x for x in range(0, max_count, xtick_spacing)], [r'$2^{{{0}}}$'.format(x) for x in range(0, max_count, xtick_spacing)], rotation='vertical')
+class Chunk:
+    """The lines of one chunk that have one field per line_order entry, as typed columns.
+    Text columns are kept as bytes arrays. group holds, for each of those lines, how many lines with the wrong number of
+    fields came before it in the chunk; separator_count is how many there were in total."""
+    def __init__(self, columns, group, separator_count):
+        self.columns = columns
+        self.group = group
+        self.separator_count = separator_count
+
+    def __len__(self):
+        return len(self.group)
+
+
+def read_chunks(input_file, line_order, chunk_bytes=CHUNK_BYTES):
+    """Parses input_file (opened in binary mode) chunk_bytes at a time, without a Python loop over lines:
+    fields are split in one call, and the number of fields on each line is counted on the raw bytes."""
+    while True:
+        data = input_file.read(chunk_bytes)
+        if not data:
+            return
+        if not data.endswith(b"\n"):
+            data += input_file.readline()
+            if not data.endswith(b"\n"):
+                data += b"\n"
+        buffer = np.frombuffer(data, dtype=np.uint8)
+        is_space = WHITESPACE[buffer]
+        field_starts = np.flatnonzero(~is_space & np.concatenate(([True], is_space[:-1])))
+        newlines = np.flatnonzero(buffer == ord("\n"))
+        field_counts = np.bincount(np.searchsorted(newlines, field_starts), minlength=len(newlines))
+        first_fields = np.cumsum(field_counts) - field_counts
+        complete = field_counts == len(line_order)
+        group = np.cumsum(~complete)[complete]
+        fields = np.array(data.split())
+        columns = {}
+        for position, name in enumerate(line_order):
+            column = fields[first_fields[complete] + position]
+            if name in NUMERIC_COLUMNS:
+                column = column.astype(NUMERIC_COLUMNS[name])
+            columns[name] = column
+        yield Chunk(columns, group, int(np.count_nonzero(~complete)))
+
+
+class Interner:
+    """Gives every distinct tag or template an integer id, so that counts can be kept in arrays.
+    Only the distinct values of each chunk are looked up in the dictionary."""
+    def __init__(self):
+        self.ids = {}
+        self.names = []
+
+    def intern(self, values):
+        uniques, inverse = np.unique(values, return_inverse=True)
+        ids = np.empty(len(uniques), dtype=np.int64)
+        for i, value in enumerate(uniques):
+            if value not in self.ids:
+                self.ids[value] = len(self.names)
+                self.names.append(value.decode())
+            ids[i] = self.ids[value]
+        return ids[inverse]
+
+
+def add_counts(totals, ids, weights=None):
+    counts = np.bincount(ids, weights=weights, minlength=len(totals)).astype(totals.dtype)
+    if len(counts) > len(totals):
+        totals = np.concatenate([totals, np.zeros(len(counts) - len(totals), dtype=totals.dtype)])
+    totals[:len(counts)] += counts
+    return totals
+
+
+class StreamingHistogram:
+    """Counts in bins of a width that starts at initial_width and doubles (merging pairs of bins) whenever the values
+    seen so far would need more than MAX_FINE_BINS bins. Bins are anchored at zero so that merging is exact."""
+    def __init__(self, initial_width=1e-3):
+        self.width = initial_width
+        self.first_bin = 0
+        self.counts = np.zeros(0, dtype=np.int64)
+
+    def update(self, values):
+        if len(values) == 0:
+            return
+        while True:
+            bins = np.floor(values / self.width).astype(np.int64)
+            low = min(bins.min(), self.first_bin) if len(self.counts) else bins.min()
+            high = max(bins.max(), self.first_bin + len(self.counts) - 1) if len(self.counts) else bins.max()
+            if high - low < MAX_FINE_BINS:
+                break
+            self._double_width()
+        if len(self.counts) == 0:
+            self.first_bin = low
+        elif low < self.first_bin:
+            self.counts = np.concatenate([np.zeros(self.first_bin - low, dtype=np.int64), self.counts])
+            self.first_bin = low
+        self.counts = add_counts(self.counts, bins - self.first_bin)
+
+    def _double_width(self):
+        if len(self.counts):
+            merged_bins = np.floor_divide(np.arange(self.first_bin, self.first_bin + len(self.counts)), 2)
+            new_first_bin = merged_bins[0]
+            self.counts = np.bincount(merged_bins - new_first_bin, weights=self.counts).astype(np.int64)
+            self.first_bin = new_first_bin
+        self.width *= 2
+
+    def centers(self):
+        return (np.arange(self.first_bin, self.first_bin + len(self.counts)) + 0.5) * self.width
+
+    def hist(self, num_bins, **kwargs):
+        return plt.hist(self.centers(), num_bins, weights=self.counts, **kwargs)
+
+    def histogram(self, num_bins):
+        return np.histogram(self.centers(), bins=num_bins, weights=self.counts)
+
+
+class TagDistribution:
+    def __init__(self, line_order, threshold=None, loglog=False):
+        self.line_order = line_order
+        self.threshold = threshold
+        self.loglog = loglog
+        self.tags = Interner()
+        self.counts = np.zeros(0, dtype=np.int64)
+
+    def requirements_met(self):
+        if "id" not in self.line_order:
+            print("Tag distribution needs id's")
+            return False
+        return True
+
+    def update(self, chunk):
+        tags = chunk.columns["id"]
+        if self.threshold is not None and "likelihood" in self.line_order:
+            tags = tags[chunk.columns["likelihood"] >= self.threshold]
+        if len(tags):
+            self.counts = add_counts(self.counts, self.tags.intern(tags))
+
+    def plot(self):
+        if len(self.counts) == 0:
+            print("No tags found")
+            return
+        loglog = self.loglog
+        max_count_index = int(np.argmax(self.counts))
+        max_count = int(self.counts[max_count_index])
+        max_count_tag = self.tags.names[max_count_index]
+        count_dist = np.bincount(self.counts, minlength=max_count + 1)
+        plt.figure(figsize=(30, 5), dpi=300)
+        print("Most common tag: " + str(max_count_tag) + " appears " + str(max_count) +" times")
+        if max_count <= 1000:
+            count_counts = count_dist[1:max_count + 1]
+            bars = plt.bar(range(max_count), count_counts, width=1.0, linewidth=0, log=True)
+            plt.ylim(0.1)
+            xtick_spacing = max(1, int(round(max_count / 250.0) * 5))
+            if loglog:
+                plt.xticks([xtick_spacing/2.0 + x for x in range(0, max_count, xtick_spacing)], [r'$2^{{{0}}}$'.format(x) for x in range(0, max_count, xtick_spacing)], rotation='vertical')
+            else:
+                plt.xticks([xtick_spacing/2.0 + x for x in range(0, max_count, xtick_spacing)], range(0, max_count, xtick_spacing), rotation='vertical')
         else:
-            plt.xticks([xtick_spacing/2.0 + x for x in range(0, max_count, xtick_spacing)], range(0, max_count, xtick_spacing), rotation='vertical')
-    else:
-        num_bins = 250
-        array = list(tags.values())
-        xtick_spacing = max(1, int(round(max_count / 250.0) * 5))
-        if loglog:
-            max_count = int(np.log2(max_count))
-            array = np.array(np.log2(array))
-        n, bins, patches = plt.hist(array, num_bins, log=True)
-        plt.ylim(0.1)
+            num_bins = 250
+            array = self.counts[self.counts > 0]
+            xtick_spacing = max(1, int(round(max_count / 250.0) * 5))
+            if loglog:
+                max_count = int(np.log2(max_count))
+                array = np.log2(array)
+            n, bins, patches = plt.hist(array, num_bins, log=True)
+            plt.ylim(0.1)
+            if loglog:
+                plt.xticks([xtick_spacing/2.0 + x for x in range(0, max_count, xtick_spacing)], [r'$2^{{{0}}}$'.format(x) for x in range(0, max_count, xtick_spacing)], rotation='vertical')
         if loglog:
-            plt.xticks([xtick_spacing/2.0 + x for x in range(0, max_count, xtick_spacing)], [r'$2^{{{0}}}$'.format(x) for x in range(0, max_count, xtick_spacing)], rotation='vertical')
-    if loglog:
-        plt.xlabel('Floor(log2(number of copies in bin))')
-    else:
-        plt.xlabel('Number of copies in bin')
-    plt.ylabel('Unique ID\'s with bin size')
-    plt.savefig('bin_sizes')
-    #plt.show()
-    plt.cla()
-
-def likelihood_cutoffs(input_file, line_order=["likelihood"]):
-    num_bins = 50
-    if "likelihood" not in line_order:
-        print("Likelihood cutoff needs a likelihood score")
-        return
-    templates = defaultdict(list)
-    for line in input_file:
-        parts = line.strip().split()
-        if len(parts) != len(line_order): continue
-        likelihood = float(parts[line_order.index("likelihood")])
-        templates["All"].append(likelihood)
-        if "template" in line_order:
-            template = parts[line_order.index("template")]
-            templates[template].append(likelihood)
-    for template, scores in sorted(templates.items()):
-        n, bins, patches = plt.hist(scores, num_bins)
-        plt.xlabel('Likelihood')
-        plt.ylabel('Frequency')
-        plt.title(template)
-        plt.savefig(template)
+            plt.xlabel('Floor(log2(number of copies in bin))')
+        else:
+            plt.xlabel('Number of copies in bin')
+        plt.ylabel('Unique ID\'s with bin size')
+        plt.savefig('bin_sizes')
         #plt.show()
         plt.cla()
 
-def comparative_likelihood(input_file, line_order=["template", "likelihood"]):
+
+class LikelihoodCutoffs:
     num_bins = 50
-    if "likelihood" not in line_order or "template" not in line_order:
-        print("Comparative likelihood needs templates and likelihood scores")
-        return
-    relative_score = defaultdict(list)
-    group = []
-    best_score = float("-Inf")
-    best_template = None
-    for line in input_file:
-        parts = line.strip().split()
-        if len(parts) != len(line_order):
-            # Ending a group
-            if len(group) == 0: # There hasn't been a group yet
-                continue
-            for template, score in group:
-                relative_score[(best_template, template)].append(score)
-            # Reset group
-            group = []
-            best_score = float("-Inf")
-            best_template = None
-            continue
-
-        template = parts[line_order.index("template")]
-        score = float(parts[line_order.index("likelihood")])
-        if score > best_score:
-            best_score = score
-            best_template = template
-        group.append((template, score))
-
-    others = defaultdict(list)
-    for winner, other in relative_score.keys():
-        others[winner].append(other)
-
-    for winner in others.keys():
-        print(winner)
-        for other in others[winner]:
-            data = np.array(relative_score[(winner, other)])
-            y,binEdges=np.histogram(data, bins=50)
-            bincenters = 0.5*(binEdges[1:]+binEdges[:-1])
-            plt.plot(bincenters, y ,'-', label=other)
-        plt.xlabel('Likelihood')
-        plt.ylabel('Frequency')
-        plt.title(winner)
-        plt.legend(loc='upper left')
-        #plt.savefig(winner)
-        plt.show()
-        plt.cla()
-        
-def error_cutoffs(input_file, line_order=["errors"]):
+
+    def __init__(self, line_order):
+        self.line_order = line_order
+        self.templates = Interner()
+        self.histograms = defaultdict(StreamingHistogram)
+
+    def requirements_met(self):
+        if "likelihood" not in self.line_order:
+            print("Likelihood cutoff needs a likelihood score")
+            return False
+        return True
+
+    def update(self, chunk):
+        likelihoods = chunk.columns["likelihood"]
+        self.histograms["All"].update(likelihoods)
+        if "template" in self.line_order and len(chunk):
+            template_ids = self.templates.intern(chunk.columns["template"])
+            for template_id in np.unique(template_ids):
+                self.histograms[self.templates.names[template_id]].update(likelihoods[template_ids == template_id])
+
+    def plot(self):
+        for template, histogram in sorted(self.histograms.items()):
+            n, bins, patches = histogram.hist(self.num_bins)
+            plt.xlabel('Likelihood')
+            plt.ylabel('Frequency')
+            plt.title(template)
+            plt.savefig('likelihoods_' + template)
+            #plt.show()
+            plt.cla()
+
+
+class ComparativeLikelihood:
+    """Groups are runs of complete lines ended by a line with the wrong number of fields.
+    A group left open at the end of a chunk is carried into the next one, and one still open at the end of the file is ignored."""
+    def __init__(self, line_order):
+        self.line_order = line_order
+        self.templates = Interner()
+        self.histograms = defaultdict(StreamingHistogram)
+        self.pending_templates = np.zeros(0, dtype=np.int64)
+        self.pending_scores = np.zeros(0, dtype=np.float64)
+
+    def requirements_met(self):
+        if "likelihood" not in self.line_order or "template" not in self.line_order:
+            print("Comparative likelihood needs templates and likelihood scores")
+            return False
+        return True
+
+    def update(self, chunk):
+        new_templates = self.templates.intern(chunk.columns["template"]) if len(chunk) else np.zeros(0, dtype=np.int64)
+        templates = np.concatenate([self.pending_templates, new_templates])
+        scores = np.concatenate([self.pending_scores, chunk.columns["likelihood"]])
+        group = np.concatenate([np.zeros(len(self.pending_templates), dtype=np.int64), chunk.group])
+        closed = group < chunk.separator_count
+        self.pending_templates, self.pending_scores = templates[~closed], scores[~closed]
+        templates, scores, group = templates[closed], scores[closed], group[closed]
+        if len(group) == 0:
+            return
+        # Lines are in group order, the first of equally scoring templates wins
+        group_starts = np.flatnonzero(np.concatenate(([True], group[1:] != group[:-1])))
+        group_index = np.cumsum(np.concatenate(([False], group[1:] != group[:-1])))
+        best_scores = np.maximum.reduceat(scores, group_starts)
+        line_numbers = np.arange(len(scores))
+        best_lines = np.minimum.reduceat(np.where(scores == best_scores[group_index], line_numbers, len(scores)), group_starts)
+        winners = templates[best_lines][group_index]
+        pairs = winners * (len(self.templates.names) + 1) + templates
+        for pair in np.unique(pairs):
+            in_pair = pairs == pair
+            winner, other = divmod(int(pair), len(self.templates.names) + 1)
+            self.histograms[(self.templates.names[winner], self.templates.names[other])].update(scores[in_pair])
+
+    def plot(self):
+        others = defaultdict(list)
+        for winner, other in self.histograms.keys():
+            others[winner].append(other)
+
+        for winner in others.keys():
+            print(winner)
+            for other in others[winner]:
+                y, binEdges = self.histograms[(winner, other)].histogram(50)
+                bincenters = 0.5*(binEdges[1:]+binEdges[:-1])
+                plt.plot(bincenters, y ,'-', label=other)
+            plt.xlabel('Likelihood')
+            plt.ylabel('Frequency')
+            plt.title(winner)
+            plt.legend(loc='upper left')
+            #plt.savefig(winner)
+            plt.show()
+            plt.cla()
+
+
+class ErrorCutoffs:
     num_bins = 40
-    if "errors" not in line_order:
-        print("Error cutoff needs an error count")
+
+    def __init__(self, line_order):
+        self.line_order = line_order
+        self.templates = Interner()
+        self.counts = defaultdict(lambda: np.zeros(0, dtype=np.int64))
+
+    def requirements_met(self):
+        if "errors" not in self.line_order:
+            print("Error cutoff needs an error count")
+            return False
+        return True
+
+    def update(self, chunk):
+        errors = chunk.columns["errors"]
+        self.counts["All"] = add_counts(self.counts["All"], errors)
+        if "template" in self.line_order and len(chunk):
+            template_ids = self.templates.intern(chunk.columns["template"])
+            for template_id in np.unique(template_ids):
+                template = self.templates.names[template_id]
+                self.counts[template] = add_counts(self.counts[template], errors[template_ids == template_id])
+
+    def plot(self):
+        for template, counts in sorted(self.counts.items()):
+            n, bins, patches = plt.hist(np.arange(len(counts)), self.num_bins, weights=counts)
+            plt.xlabel('Errors')
+            plt.ylabel('Frequency')
+            plt.title(template)
+            plt.savefig('errors_' + template)
+            #plt.show()
+            plt.cla()
+
+
+def summarize(input_file, line_order, summaries, chunk_bytes=CHUNK_BYTES):
+    """Reads input_file once, updating every summary with each chunk, then plots them all."""
+    summaries = [summary for summary in summaries if summary.requirements_met()]
+    if not summaries:
         return
-    templates = defaultdict(list)
-    for line in input_file:
-        parts = line.strip().split()
-        if len(parts) != len(line_order): continue
-        errors = int(parts[line_order.index("errors")])
-        templates["All"].append(errors)
-        if "template" in line_order:
-            template = parts[line_order.index("template")]
-            templates[template].append(errors)
-    for template, errors in sorted(templates.items()):
-        n, bins, patches = plt.hist(errors, num_bins)
-        plt.xlabel('Errors')
-        plt.ylabel('Frequency')
-        plt.title(template)
-        plt.savefig(template)
-        #plt.show()
-        plt.cla()
+    for chunk in read_chunks(input_file, line_order, chunk_bytes):
+        for summary in summaries:
+            summary.update(chunk)
+    for summary in summaries:
+        summary.plot()
+
+
+DEFAULT_LINE_ORDERS = {"log_tag_dist": ["id"], "tag_dist": ["id"], "likelihoods": ["likelihood"],
+                       "comparative": ["template", "likelihood"], "errors": ["errors"]}
+
+def make_summary(command, line_order, threshold):
+    if command == "log_tag_dist":
+        return TagDistribution(line_order, threshold, loglog=True)
+    elif command == "tag_dist":
+        return TagDistribution(line_order, threshold)
+    elif command == "likelihoods":
+        return LikelihoodCutoffs(line_order)
+    elif command == "comparative":
+        return ComparativeLikelihood(line_order)
+    elif command == "errors":
+        return ErrorCutoffs(line_order)
 
 parser = argparse.ArgumentParser(description="Get info on PrimerID results")
-parser.add_argument('command', type=str, choices=["log_tag_dist", "tag_dist", "likelihoods", "comparative", "errors"], default="tag_dist")
-parser.add_argument('input', type=argparse.FileType('r'), help="the location of primer id results file to visualise")
+parser.add_argument('command', type=str, nargs='+', choices=["log_tag_dist", "tag_dist", "likelihoods", "comparative", "errors"], help="one or more summaries, all computed in a single pass")
+parser.add_argument('input', type=argparse.FileType('rb'), help="the location of primer id results file to visualise")
 parser.add_argument('-f', '--format', metavar='keyword', action='append', choices=["template", "id", "likelihood", "errors"], help='The format of the lines')
 parser.add_argument('-t', '--threshold', type=float, help='Likelihood threshold below which lines are ignored')
 args = parser.parse_args()
 
-if args.command == "log_tag_dist":
-    if args.format is not None and args.threshold is not None:
-        log_tag_dist(args.input, args.format, args.threshold)
-    elif args.format is not None:
-        log_tag_dist(args.input, args.format)
-    else:
-        log_tag_dist(args.input)
-if args.command == "tag_dist":
-    if args.format is not None and args.threshold is not None:
-        tag_dist(args.input, args.format, args.threshold)
-    elif args.format is not None:
-        tag_dist(args.input, args.format)
-    else:
-        tag_dist(args.input)
-elif args.command == "likelihoods":
-    if args.format is not None:
-        likelihood_cutoffs(args.input, args.format)
-    else:
-        likelihood_cutoffs(args.input)
-elif args.command == "comparative":
-    if args.format is not None:
-        comparative_likelihood(args.input, args.format)
-    else:
-        comparative_likelihood(args.input)
-elif args.command == "errors":
-    if args.format is not None:
-        error_cutoffs(args.input, args.format)
-    else:
-        error_cutoffs(args.input)
+line_order = args.format if args.format is not None else DEFAULT_LINE_ORDERS[args.command[0]]
+summarize(args.input, line_order, [make_summary(command, line_order, args.threshold) for command in args.command])
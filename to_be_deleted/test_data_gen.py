@@ -1,9 +1,25 @@
-from __future__ import division
-import sys
-import string
+"""Simulates a primer-ID-tagged amplicon library and streams sequencing reads of it as FASTQ.
+
+The population is a 2-D uint8 array (one row per strain, padded with PAD) with a matching array of
+region labels, so that mutation, indels and recombination are done for every strain at once.
+Reads are generated in chunks: each molecule gets a random primer ID, is sequenced family-size times
+with simulated phred qualities and substitution errors, and is written straight to the output.
+
+    python test_data_gen.py --reads 1000000 --seed 42 -o reads.fastq --pool-fasta pool.fasta
+"""
+import argparse
 import math
+import string
+import sys
 import numpy as np
 
+A, C, G, T, N = 0, 1, 2, 3, 4
+PAD = 255
+ALPHABET = np.frombuffer(b"ACGTN", dtype=np.uint8)
+COMPLEMENT = np.array([T, G, C, A, N], dtype=np.uint8)
+DECODE = np.full(256, ord("-"), dtype=np.uint8)
+DECODE[:len(ALPHABET)] = ALPHABET
+
 
 class Settings():
     def __init__(s):
@@ -11,7 +27,6 @@ class Settings():
         s.INDEL_LENGTH_STD = 2
         s.INDELS_MULTIPLES_OF_3 = False
         s.MINIMUM_REGION_LENGTH = 5
-        s.ALLOW_INDEL_IN_IN = False
 
         # Simulation poperties
         s.NUMBER_OF_GENERATIONS = 4
@@ -35,277 +50,337 @@ class Settings():
         s.VARIABLE_RECO = 0.0/length
         s.SWITCH_COUNT = 1
 
-def true_or_false(probability):
-    return np.random.rand(1) < probability
-
-class Nucleotide:
-    NUCLEOTIDES = set(["A", "C", "T", "G"])
-    @staticmethod
-    def mutate(nucleotide, mutation_rate):
-        if nucleotide == "N": return nucleotide
-        do_mutate =  true_or_false(mutation_rate)
-        if do_mutate:
-            return np.random.choice(list(Nucleotide.NUCLEOTIDES - set(nucleotide)))
-        else:
-            return nucleotide
-
-class Strain:
-    class Region:
-        def __init__(self, start, length, mutation_rate, indel_rate, reco_rate):
-            self.start = start
-            self.length = length
-            self.end = start + length
-            self.mutation_rate = mutation_rate # The likelihood of individual nucleotide mutating to a different nucleotide
-            self.indel_rate = indel_rate # The likelihood that an individual nucleotide will be the start of an insertion/deletion
-            self.reco_rate = reco_rate
-
-        def clone(self, start=None, length=None):
-            if start is None:
-                start = self.start
-            if length is None:
-                length = self.length
-            return Strain.Region(start, length, self.mutation_rate, self.indel_rate, self.reco_rate)
-
-    def __init__(self, sequence, regions, *parents):
-        self.sequence = sequence
-        self.contains_stop_codons = Strain.first_stop_codon_index(sequence) is not None
+        # Primer IDs and sequencing
+        s.PRIMER_ID_START = 10
+        s.PRIMER_ID_LENGTH = 6
+        s.MEAN_FAMILY_SIZE = 5
+        s.MEAN_PHRED = 30
+        s.PHRED_STD = 6
+        s.MIN_PHRED = 2
+        s.MAX_PHRED = 41
+        s.REVERSE_COMPLEMENT_FRACTION = 0.5
+
+
+class Population:
+    """Strains as rows of seqs (uint8 codes, PAD after each strain's end), with the region of every base in regions.
+    Each region has its own mutation, indel and recombination rate."""
+    def __init__(self, seqs, regions, lengths, ids, mutation_rates, indel_rates, reco_rates):
+        self.seqs = seqs
         self.regions = regions
-        if len(parents) == 0:
-           self.parents = None
-        else:
-           self.parents = parents
-
-    @staticmethod
-    def first_stop_codon_index(sequence, start_index=0):
-        for index in range(start_index, len(sequence) - 2, 3):
-            if sequence[index] == "T" and (sequence[index + 1] == "A" and (sequence[index + 2] == "A" or sequence[index + 2] == "G")
-                                        or sequence[index + 1] == "G" and sequence[index + 2] == "A"):
-                return index
-        return None
-
-    def fix_stop_codons(self):
-        next_stop = Strain.first_stop_codon_index(self.sequence)
-        while next_stop is not None:
-            self.sequence[next_stop] = np.random.choice(list("ACG"))
-            next_stop = Strain.first_stop_codon_index(self.sequence, next_stop + 3)
-        self.contains_stop_codons = False
-
-    def generate_offspring(self):
-        mutated_strain = self._mutate()
-        indeled_strain = mutated_strain._indel()
-        return indeled_strain
-
-    def _mutate(self):
-        new_sequence = []
-        new_regions = []
-        for region in self.regions:
-            for i in range(region.start, region.end):
-                new_sequence.append(Nucleotide.mutate(self.sequence[i], region.mutation_rate))
-            new_regions.append(region.clone())
-        return Strain(new_sequence, new_regions, self)
-
-    def _indel(self):
-        new_sequence = []
-        new_regions = []
-        i = 0
-        for region in self.regions:
-            new_region_start = len(new_sequence)
-            expected_region_length = region.length
-            max_i = 0
-            while i < region.length:
-                max_i = max(i, max_i)
-                if not s.ALLOW_INDEL_IN_IN and i < max_i:
-                    is_indel_start = False # Do not start insertions/deletions while busy with an insertion/deletion
-                else:
-                    is_indel_start = true_or_false(region.indel_rate)
-                if not is_indel_start:
-                    #print(region.start + i, region.start + region.length, len(self.sequence))
-                    new_sequence.append(self.sequence[max(0, region.start + i)])
-                    i += 1
-                    continue
-                insertion_not_deletion = true_or_false(0.5)
-                indel_length = abs(int(np.random.standard_normal() * s.INDEL_LENGTH_STD + s.INDEL_LENGTH_MEAN))
-                if s.INDELS_MULTIPLES_OF_3:
-                    indel_length = round(indel_length / 3) * 3
-                if insertion_not_deletion:
-                    # Go Back length letters, insert them again
-                    indel_length = min(indel_length, i + region.start) # Cannot go back before the start of the sequence
-                    i -= indel_length
-                    expected_region_length += indel_length
-                else:
-                    # Check that this deletion won't bring the total region length <  MINIMUM_REGION_LENGTH
-                    if expected_region_length - indel_length < s.MINIMUM_REGION_LENGTH:
-                        pass
-                    else:
-                        i += indel_length
-                        expected_region_length -= indel_length
-            i -= region.length # If there are still bases to be skipped (i > region.length), skip over the start of the next region
-            new_regions.append(region.clone(new_region_start, len(new_sequence) - new_region_start))
-        return Strain(new_sequence, new_regions, self)
-
-    @staticmethod
-    def get_random_recombine_positions(regions, N):
-        region_probs = np.array([region.length * region.reco_rate for region in regions])
-        region_probs /= sum(region_probs)
-        positions = []
-        for i in range(N):
-            chosen_region = np.random.choice(regions, p=region_probs)
-            position_in_region = np.random.randint(chosen_region.length)
-            positions.append(chosen_region.start + position_in_region)
-        positions.sort()
-        return positions
-
-    @staticmethod
-    def recombine(strain1, strain2):
-        active = 0
-        active_strain = strain1
-        switch_count = 0
-        new_sequence = []
-        new_regions = []
-        if len(strain1.regions) != len(strain2.regions):
-           raise ValueError("regions1 and regions2 should be similarly sized arrays")
-        recombine_positions = Strain.get_random_recombine_positions(strain1.regions, s.SWITCH_COUNT)
-        for region_index in range(len(strain1.regions)):
-            active_region = active_strain.regions[region_index]
-            i = 0
-            new_region_start = len(new_sequence)
-            while i < active_region.length:
-                switch = switch_count < len(recombine_positions) and i + active_region.start == recombine_positions[switch_count]
-                if switch:
-                    print("Switched at %d"%(active_region.start + i), file=sys.stderr)
-                    switch_count += 1
-                    current_percent = i / active_region.length
-                    active_strain = strain2 if active_strain == strain1 else strain1
-                    active_region = active_strain.regions[region_index]
-                    i = int(round(current_percent * active_region.length))
-                new_sequence.append(active_strain.sequence[active_region.start + i])
-                i += 1
-            new_regions.append(active_region.clone(new_region_start, len(new_sequence) - new_region_start))
-        print("Switched %d times"%(switch_count), file=sys.stderr)
-        offspring = Strain(new_sequence, new_regions, strain1, strain2)
-        return  offspring
-
-def random_strain(number_of_regions, conserved_region_size, variable_region_size, conserved_mutate, variable_mutate, conserved_indel, variable_indel, conserved_reco, variable_reco, alphabet=list(Nucleotide.NUCLEOTIDES)):
-    regions = []
-    size = 0
-    for i in range(number_of_regions):
-        mutate_rate = conserved_mutate if i%2 == 0 else variable_mutate
-        indel_rate = conserved_indel if i%2 == 0 else variable_indel
-        reco_rate = conserved_reco if i%2 == 0 else variable_reco
-        diff = conserved_region_size if i%2 == 0 else variable_region_size
-        region = Strain.Region(size, diff, mutate_rate, indel_rate, reco_rate)
-        size += diff
-        regions.append(region)
-    sequence = np.random.choice(alphabet, size=[size])
-    return Strain(sequence, regions)
-
-def simulation(starting_pool):
-    pool = starting_pool
+        self.lengths = lengths
+        self.ids = ids
+        self.mutation_rates = mutation_rates
+        self.indel_rates = indel_rates
+        self.reco_rates = reco_rates
+
+    def __len__(self):
+        return self.seqs.shape[0]
+
+    def take(self, rows, ids=None):
+        return Population(self.seqs[rows], self.regions[rows], self.lengths[rows], self.ids[rows] if ids is None else ids,
+                          self.mutation_rates, self.indel_rates, self.reco_rates)
+
+    def valid(self):
+        return np.arange(self.seqs.shape[1])[None, :] < self.lengths[:, None]
+
+    def region_lengths(self):
+        region_count = len(self.mutation_rates)
+        return np.stack([((self.regions == r) & self.valid()).sum(axis=1) for r in range(region_count)], axis=1)
+
+    def sequence(self, row):
+        return DECODE[self.seqs[row, :self.lengths[row]]].tobytes().decode()
+
+
+def random_population(s, rng, count=1):
+    region_sizes = [s.CONSERVED_REGION_SIZE if i % 2 == 0 else s.VARIABLE_REGION_SIZE for i in range(s.NUMBER_OF_REGIONS)]
+    mutation_rates = np.array([s.CONSERVED_MUTATE if i % 2 == 0 else s.VARIABLE_MUTATE for i in range(s.NUMBER_OF_REGIONS)])
+    indel_rates = np.array([s.CONSERVED_INDEL if i % 2 == 0 else s.VARIABLE_INDEL for i in range(s.NUMBER_OF_REGIONS)])
+    reco_rates = np.array([s.CONSERVED_RECO if i % 2 == 0 else s.VARIABLE_RECO for i in range(s.NUMBER_OF_REGIONS)])
+    size = sum(region_sizes)
+    seqs = rng.integers(0, 4, size=(count, size), dtype=np.uint8)
+    regions = np.tile(np.repeat(np.arange(len(region_sizes), dtype=np.int8), region_sizes), (count, 1))
+    ids = np.array([str(i) for i in range(count)], dtype=object)
+    return Population(seqs, regions, np.full(count, size, dtype=np.int64), ids, mutation_rates, indel_rates, reco_rates)
+
+
+def stop_codons(population):
+    """Boolean (strains, codons) array of in-frame TAA, TAG and TGA codons."""
+    codon_count = population.seqs.shape[1] // 3
+    codons = population.seqs[:, :3 * codon_count].reshape(len(population), codon_count, 3)
+    first, second, third = codons[:, :, 0], codons[:, :, 1], codons[:, :, 2]
+    return (first == T) & (((second == A) & ((third == A) | (third == G))) | ((second == G) & (third == A)))
+
+
+def fix_stop_codons(population, rng):
+    stops = stop_codons(population)
+    rows, codon_indices = np.nonzero(stops)
+    population.seqs[rows, 3 * codon_indices] = rng.integers(0, 3, size=len(rows), dtype=np.uint8)
+
+
+def mutate(population, rng):
+    rates = population.mutation_rates[population.regions]
+    mutated = (rng.random(population.seqs.shape) < rates) & population.valid() & (population.seqs < N)
+    shifts = rng.integers(1, 4, size=np.count_nonzero(mutated), dtype=np.uint8)
+    # Adding 1-3 (mod 4) always lands on a different nucleotide
+    population.seqs[mutated] = (population.seqs[mutated] + shifts) % 4
+
+
+def gather_segments(sources, seg_rows, seg_starts, seg_ends):
+    """Builds new strains by concatenating segments [seg_starts, seg_ends) of the strains seg_rows of sources.
+    All three arrays are (new strains, segments), with empty segments for padding."""
+    seg_lengths = np.maximum(seg_ends - seg_starts, 0)
+    seg_cumulative = np.cumsum(seg_lengths, axis=1)
+    lengths = seg_cumulative[:, -1]
+    width = max(1, int(lengths.max()) if len(lengths) else 1)
+    positions = np.arange(width)
+    segment = (positions[None, :, None] >= seg_cumulative[:, None, :]).sum(axis=2)
+    segment = np.minimum(segment, seg_starts.shape[1] - 1)
+    row_index = np.arange(len(lengths))[:, None]
+    offsets = positions[None, :] - (seg_cumulative - seg_lengths)[row_index, segment]
+    source_positions = np.clip(seg_starts[row_index, segment] + offsets, 0, sources.seqs.shape[1] - 1)
+    source_rows = seg_rows[row_index, segment]
+    valid = positions[None, :] < lengths[:, None]
+    seqs = np.where(valid, sources.seqs[source_rows, source_positions], PAD).astype(np.uint8)
+    regions = np.where(valid, sources.regions[source_rows, source_positions], 0).astype(np.int8)
+    return seqs, regions, lengths
+
+
+def indel(population, rng, s):
+    """Insertions (tandem duplications of the bases just before) and deletions, kept within their region
+    and never overlapping another indel of the same strain."""
+    region_lengths = population.region_lengths()
+    region_starts = np.cumsum(region_lengths, axis=1) - region_lengths
+    rates = population.indel_rates[population.regions]
+    rows, positions = np.nonzero((rng.random(population.seqs.shape) < rates) & population.valid())
+    is_insertion = rng.random(len(rows)) < 0.5
+    indel_lengths = np.abs((rng.standard_normal(len(rows)) * s.INDEL_LENGTH_STD + s.INDEL_LENGTH_MEAN).astype(np.int64))
+    if s.INDELS_MULTIPLES_OF_3:
+        indel_lengths = np.round(indel_lengths / 3).astype(np.int64) * 3
+    event_regions = population.regions[rows, positions]
+    region_start = region_starts[rows, event_regions]
+    region_end = region_start + region_lengths[rows, event_regions]
+    indel_lengths = np.where(is_insertion, np.minimum(indel_lengths, positions - region_start),
+                             np.minimum(indel_lengths, region_end - positions))
+    # Deletions can't bring a region below MINIMUM_REGION_LENGTH
+    keep = (indel_lengths > 0) & (is_insertion | (region_lengths[rows, event_regions] - indel_lengths >= s.MINIMUM_REGION_LENGTH))
+    rows, positions, is_insertion, indel_lengths = rows[keep], positions[keep], is_insertion[keep], indel_lengths[keep]
+    # Events are in (row, position) order; drop any that start inside the previous kept deletion, until none do
+    while True:
+        event_ends = np.where(is_insertion, positions, positions + indel_lengths)
+        overlapping = np.zeros(len(rows), dtype=bool)
+        overlapping[1:] = (rows[1:] == rows[:-1]) & (positions[1:] < event_ends[:-1])
+        if not overlapping.any():
+            break
+        first = np.argmax(overlapping)
+        keep = np.ones(len(rows), dtype=bool)
+        keep[first] = False
+        rows, positions, is_insertion, indel_lengths = rows[keep], positions[keep], is_insertion[keep], indel_lengths[keep]
+
+    event_counts = np.bincount(rows, minlength=len(population))
+    segment_count = int(event_counts.max()) + 1 if len(rows) else 1
+    seg_starts = np.zeros((len(population), segment_count), dtype=np.int64)
+    seg_ends = np.zeros((len(population), segment_count), dtype=np.int64)
+    first_event = np.cumsum(event_counts) - event_counts
+    rank = np.arange(len(rows)) - first_event[rows]
+    seg_ends[rows, rank] = positions
+    seg_starts[rows, rank + 1] = np.where(is_insertion, positions - indel_lengths, positions + indel_lengths)
+    seg_ends[np.arange(len(population)), event_counts] = population.lengths
+    seg_rows = np.repeat(np.arange(len(population))[:, None], segment_count, axis=1)
+    population.seqs, population.regions, population.lengths = gather_segments(population, seg_rows, seg_starts, seg_ends)
+
+
+def recombine(population, first_parents, second_parents, rng, s):
+    """Offspring that start as first_parents and switch strain SWITCH_COUNT times, at positions chosen in proportion
+    to each region's length times its recombination rate, landing at the same relative place in the other strain's region."""
+    count = len(first_parents)
+    region_lengths = population.region_lengths()
+    region_starts = np.cumsum(region_lengths, axis=1) - region_lengths
+    weights = region_lengths[first_parents] * population.reco_rates[None, :]
+    totals = weights.sum(axis=1, keepdims=True)
+    weights = np.where(totals > 0, weights / np.where(totals > 0, totals, 1), 1.0 / weights.shape[1])
+    cumulative = np.cumsum(weights, axis=1)
+    switch_regions = (rng.random((count, s.SWITCH_COUNT, 1)) >= cumulative[:, None, :]).sum(axis=2)
+    switch_regions = np.minimum(switch_regions, weights.shape[1] - 1)
+    switch_fractions = rng.random((count, s.SWITCH_COUNT))
+    order = np.lexsort((switch_fractions, switch_regions))
+    switch_regions = np.take_along_axis(switch_regions, order, axis=1)
+    switch_fractions = np.take_along_axis(switch_fractions, order, axis=1)
+
+    parents = np.stack([first_parents, second_parents], axis=1)
+    seg_rows = np.empty((count, s.SWITCH_COUNT + 1), dtype=np.int64)
+    seg_starts = np.empty((count, s.SWITCH_COUNT + 1), dtype=np.int64)
+    seg_ends = np.empty((count, s.SWITCH_COUNT + 1), dtype=np.int64)
+    rows = np.arange(count)
+    seg_rows[:, 0] = first_parents
+    seg_starts[:, 0] = 0
+    for k in range(s.SWITCH_COUNT):
+        current = seg_rows[:, k]
+        following = parents[rows, (k + 1) % 2]
+        region = switch_regions[:, k]
+        switch_at = region_starts[current, region] + np.floor(switch_fractions[:, k] * region_lengths[current, region]).astype(np.int64)
+        seg_ends[:, k] = np.maximum(switch_at, seg_starts[:, k])
+        seg_rows[:, k + 1] = following
+        seg_starts[:, k + 1] = region_starts[following, region] + np.round(switch_fractions[:, k] * region_lengths[following, region]).astype(np.int64)
+    seg_ends[:, -1] = population.lengths[seg_rows[:, -1]]
+    seqs, regions, lengths = gather_segments(population, seg_rows, seg_starts, seg_ends)
+    ids = np.array(["-".join([a + b for a, b in zip(population.ids[i].split("-"), population.ids[j].split("-"))])
+                    for i, j in zip(first_parents, second_parents)], dtype=object)
+    return Population(seqs, regions, lengths, ids, population.mutation_rates, population.indel_rates, population.reco_rates)
+
+
+def concatenate(populations):
+    width = max(p.seqs.shape[1] for p in populations)
+    def pad(array, fill):
+        return np.pad(array, ((0, 0), (0, width - array.shape[1])), constant_values=fill)
+    first = populations[0]
+    return Population(np.concatenate([pad(p.seqs, PAD) for p in populations]),
+                      np.concatenate([pad(p.regions, 0) for p in populations]),
+                      np.concatenate([p.lengths for p in populations]),
+                      np.concatenate([p.ids for p in populations]),
+                      first.mutation_rates, first.indel_rates, first.reco_rates)
+
+
+def simulation(pool, rng, s):
     for g in range(s.NUMBER_OF_GENERATIONS):
-        print("Generation %d, population size %d"%(g, len(pool)) ,file=sys.stderr)
-        offsprings = []
-        for strain in pool:
-            if s.KEEP_PARENTS:
-                offsprings.append(strain)
-            if not s.ALLOW_STOP_CODON_MUTATION and strain.contains_stop_codons:
-                print("Strain %s has stop codons, no offspring for you." % (strain.id), file=sys.stderr)
-                continue
-            for i in range(s.NUMBER_OF_OFFSPRING_PER_GENERATION):
-                should_recombine = true_or_false(s.PERCENTAGE_OFFSPRING_THAT_ARE_RECOMBINATIONS)
-                if should_recombine:
-                    other_strain = np.random.choice(pool)
-                    offspring = Strain.recombine(strain, other_strain)
-                    offspring.id = "-".join([s + o for s, o in zip(strain.id.split("-"), other_strain.id.split("-"))])
-                else:
-                    offspring = strain.generate_offspring()
-                    offspring.id = strain.id + "-" + string.ascii_uppercase[i]
-                if not s.ACTIVELY_DELETE_SEQUENCES_WITH_STOPS or not offspring.contains_stop_codons:
-                    offsprings.append(offspring)
+        print("Generation %d, population size %d" % (g, len(pool)), file=sys.stderr)
+        parents = np.arange(len(pool))
+        if not s.ALLOW_STOP_CODON_MUTATION:
+            parents = parents[~stop_codons(pool).any(axis=1)]
+        offsprings = [pool] if s.KEEP_PARENTS else []
+        for i in range(s.NUMBER_OF_OFFSPRING_PER_GENERATION):
+            recombining = rng.random(len(parents)) < s.PERCENTAGE_OFFSPRING_THAT_ARE_RECOMBINATIONS
+            mutants = parents[~recombining]
+            if len(mutants):
+                offspring = pool.take(mutants, ids=np.array([pool.ids[m] + "-" + string.ascii_uppercase[i] for m in mutants], dtype=object))
+                mutate(offspring, rng)
+                indel(offspring, rng, s)
+                offsprings.append(offspring)
+            if recombining.any():
+                first_parents = parents[recombining]
+                offsprings.append(recombine(pool, first_parents, rng.integers(0, len(pool), size=len(first_parents)), rng, s))
+        offsprings = concatenate(offsprings)
+        if s.ACTIVELY_DELETE_SEQUENCES_WITH_STOPS:
+            offsprings = offsprings.take(np.nonzero(~stop_codons(offsprings).any(axis=1))[0])
         # Choosing the next population
         if s.MAX_POOL_SIZE is not None and len(offsprings) > s.MAX_POOL_SIZE:
-            indexes = list(np.random.choice(range(len(offsprings)), size=s.MAX_POOL_SIZE, replace=False))
+            indexes = rng.choice(len(offsprings), size=s.MAX_POOL_SIZE, replace=False)
             if not s.SHUFFLE_OUTPUT:
                 indexes.sort()
         elif s.SHUFFLE_OUTPUT:
-            indexes = list(range(len(offsprings)))
-            np.random.shuffle(indexes)
+            indexes = rng.permutation(len(offsprings))
         else:
-            indexes = range(len(offsprings))
-
-        pool = [offsprings[i] for i in indexes]
-    # Check offsprings for stop codons
+            indexes = np.arange(len(offsprings))
+        pool = offsprings.take(indexes)
     return pool
 
-def print_strain(strain, detailed_regions=False):
-    if detailed_regions:
-        print(" ".join(["%d -(%d)-> %d"%(r.start, r.length, r.end) for r in strain.regions]))
-    print(" ".join(["".join(strain.sequence[r.start:r.end]) for r in strain.regions]))
-
-def test_mutate():
-    print("Test Mutate")
-    starting_strain = random_strain(5, 40, 40, 0.05, 0.025, 6, 0.1, 0.1)
-    print_strain(starting_strain)
-    mutated_strain = starting_strain._mutate()
-    print_strain(mutated_strain)
-
-def test_indel():
-    print("Test Indel")
-    starting_strain = random_strain(5, 40, 40, 0.05, 0.025, 6, 0.1, 0.1, alphabet=list(string.ascii_letters + string.digits))
-    print_strain(starting_strain, detailed_regions=True)
-    mutated_strain = starting_strain._indel()
-    print_strain(mutated_strain, detailed_regions=True)
-
-def test_recombination():
-    print("Test Recombination")
-    strain1 = random_strain(5, 40, 40, 0.05, 0.025, 6, 0.1, 0.1)
-    strain2 = Strain([s.lower() for s in strain1.sequence], strain1.regions)
-    print_strain(strain1)
-    print_strain(strain2)
-    mutated_strain = Strain.recombine(strain1, strain2)
-    print_strain(mutated_strain)
-
-s = Settings()
-#np.random.seed(0)
-
-# Diverse initial seedling strains
-s.KEEP_PARENTS = False
-s.PERCENTAGE_OFFSPRING_THAT_ARE_RECOMBINATIONS = 0
-s.MAX_POOL_SIZE = 4
-s.NUMBER_OF_OFFSPRING_PER_GENERATION = 1
-s.ALLOW_STOP_CODON_MUTATION = True
-s.ACTIVELY_DELETE_SEQUENCES_WITH_STOPS = False
-s.NUMBER_OF_GENERATIONS = 8
-starting_strain = random_strain(s.NUMBER_OF_REGIONS, s.CONSERVED_REGION_SIZE, s.VARIABLE_REGION_SIZE, s.CONSERVED_MUTATE, s.VARIABLE_MUTATE, s.CONSERVED_INDEL, s.VARIABLE_INDEL, s.CONSERVED_RECO, s.VARIABLE_RECO, alphabet=list(Nucleotide.NUCLEOTIDES))
-starting_strain.fix_stop_codons()
-starting_strain_copies = [starting_strain.generate_offspring() for i in range(4)]
-for i, strain in enumerate(starting_strain_copies) :
-    strain.id = str(i)
-seeding_pool = simulation(starting_strain_copies)
-for i, strain in enumerate(seeding_pool):
-    strain.id = str(i)
-    strain.fix_stop_codons()
-    # INSERT "N"'s
-    for i in range(10, 16):
-        strain.sequence[i] = "N"
-    print("> Strain %s"%(strain.id), file=sys.stderr)
-    print("".join(strain.sequence), file=sys.stderr)
-
-# Running the real simulation given the initial strains
-s = Settings()
-s.NUMBER_OF_GENERATIONS = 2
-pool = simulation(seeding_pool)
-
-#Inserting primerids
-for i, strain in enumerate(pool):
-    primerid = np.random.choice(list(Nucleotide.NUCLEOTIDES), size=[6])
-    for i, j in enumerate(range(10,16)):
-        strain.sequence[j] = primerid[i]
-    strain_id = strain.id.split("-")
-    strain.id = "-".join([strain_id[0]] + ["".join(primerid)] + strain_id[1:])
-
-s.NUMBER_OF_GENERATIONS = 2
-final_pool = simulation(pool)
-
-for i, strain in enumerate(pool):
-    print("> Strain %d_%s"%(i, strain.id))
-    print("".join(strain.sequence))
+
+def reverse_complement(seqs, lengths):
+    positions = np.arange(seqs.shape[1])
+    source = np.clip(lengths[:, None] - 1 - positions[None, :], 0, seqs.shape[1] - 1)
+    valid = positions[None, :] < lengths[:, None]
+    reversed_seqs = seqs[np.arange(len(seqs))[:, None], source]
+    return np.where(valid, COMPLEMENT[np.minimum(reversed_seqs, N)], PAD).astype(np.uint8)
+
+
+def write_reads(out, pool, read_count, rng, s, chunk_size):
+    """Streams read_count reads of pool to out in chunks of about chunk_size reads.
+    Each molecule is a random strain with a random primer ID, read 1 + Poisson(MEAN_FAMILY_SIZE - 1) times."""
+    primer_id_positions = s.PRIMER_ID_START + np.arange(s.PRIMER_ID_LENGTH)
+    written = 0
+    molecule = 0
+    while written < read_count:
+        molecule_count = max(1, chunk_size // s.MEAN_FAMILY_SIZE)
+        family_sizes = 1 + rng.poisson(s.MEAN_FAMILY_SIZE - 1, size=molecule_count)
+        family_sizes = family_sizes[np.cumsum(family_sizes) - family_sizes < read_count - written]
+        family_sizes[-1] = min(family_sizes[-1], read_count - written - (family_sizes.sum() - family_sizes[-1]))
+        molecule_count = len(family_sizes)
+        strains = rng.integers(0, len(pool), size=molecule_count)
+        primer_ids = rng.integers(0, 4, size=(molecule_count, s.PRIMER_ID_LENGTH), dtype=np.uint8)
+        molecules = pool.seqs[strains]
+        molecules[:, primer_id_positions] = primer_ids
+
+        read_molecules = np.repeat(np.arange(molecule_count), family_sizes)
+        seqs = molecules[read_molecules]
+        lengths = pool.lengths[strains][read_molecules]
+        valid = np.arange(seqs.shape[1])[None, :] < lengths[:, None]
+        phreds = np.clip(np.round(rng.normal(s.MEAN_PHRED, s.PHRED_STD, size=seqs.shape)), s.MIN_PHRED, s.MAX_PHRED).astype(np.uint8)
+        errors = (rng.random(seqs.shape) < 10.0 ** (-phreds.astype(np.float64) / 10.0)) & valid & (seqs < N)
+        seqs[errors] = (seqs[errors] + rng.integers(1, 4, size=np.count_nonzero(errors), dtype=np.uint8)) % 4
+        reverse = rng.random(len(seqs)) < s.REVERSE_COMPLEMENT_FRACTION
+        seqs[reverse] = reverse_complement(seqs[reverse], lengths[reverse])
+
+        sequence_text = DECODE[seqs]
+        quality_text = phreds + 33
+        primer_id_text = [DECODE[p].tobytes() for p in primer_ids]
+        strain_ids = [pool.ids[strain].encode() for strain in strains]
+        lines = []
+        for k in range(len(seqs)):
+            m = read_molecules[k]
+            lines.append(b"@read%d molecule=%d strain=%s primer_id=%s%s\n%s\n+\n%s\n" % (
+                written + k, molecule + m, strain_ids[m], primer_id_text[m], b" reverse" if reverse[k] else b"",
+                sequence_text[k, :lengths[k]].tobytes(), quality_text[k, :lengths[k]].tobytes()))
+        out.write(b"".join(lines))
+        written += len(seqs)
+        molecule += molecule_count
+        print("Written %d reads" % (written), file=sys.stderr)
+
+
+def write_pool_fasta(out, pool):
+    for i in range(len(pool)):
+        out.write(("> Strain %d_%s\n%s\n" % (i, pool.ids[i], pool.sequence(i))).encode())
+
+
+def main(args):
+    rng = np.random.default_rng(args.seed)
+
+    # Diverse initial seedling strains
+    s = Settings()
+    s.KEEP_PARENTS = False
+    s.PERCENTAGE_OFFSPRING_THAT_ARE_RECOMBINATIONS = 0
+    s.MAX_POOL_SIZE = 4
+    s.NUMBER_OF_OFFSPRING_PER_GENERATION = 1
+    s.ALLOW_STOP_CODON_MUTATION = True
+    s.ACTIVELY_DELETE_SEQUENCES_WITH_STOPS = False
+    s.NUMBER_OF_GENERATIONS = 8
+    starting_strain = random_population(s, rng)
+    fix_stop_codons(starting_strain, rng)
+    starting_strain_copies = starting_strain.take(np.zeros(4, dtype=np.int64), ids=np.array([str(i) for i in range(4)], dtype=object))
+    mutate(starting_strain_copies, rng)
+    indel(starting_strain_copies, rng, s)
+    seeding_pool = simulation(starting_strain_copies, rng, s)
+    seeding_pool.ids = np.array([str(i) for i in range(len(seeding_pool))], dtype=object)
+    fix_stop_codons(seeding_pool, rng)
+    # The primer ID goes where the N's are
+    seeding_pool.seqs[:, s.PRIMER_ID_START:s.PRIMER_ID_START + s.PRIMER_ID_LENGTH] = N
+    for i in range(len(seeding_pool)):
+        print("> Strain %s" % (seeding_pool.ids[i]), file=sys.stderr)
+        print(seeding_pool.sequence(i), file=sys.stderr)
+
+    # Running the real simulation given the initial strains
+    s = Settings()
+    s.NUMBER_OF_GENERATIONS = args.generations
+    s.MEAN_FAMILY_SIZE = args.family_size
+    s.MEAN_PHRED = args.mean_phred
+    pool = simulation(seeding_pool, rng, s)
+
+    if args.pool_fasta is not None:
+        with open(args.pool_fasta, "wb") as out:
+            write_pool_fasta(out, pool)
+    if args.output == "-":
+        write_reads(sys.stdout.buffer, pool, args.reads, rng, s, args.chunk_size)
+    else:
+        with open(args.output, "wb") as out:
+            write_reads(out, pool, args.reads, rng, s, args.chunk_size)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--reads", type=int, default=10000, help="number of reads to write")
+    parser.add_argument("--seed", type=int, default=None, help="random seed, for reproducible output")
+    parser.add_argument("-o", "--output", default="-", help="FASTQ file to write (default: stdout)")
+    parser.add_argument("--pool-fasta", default=None, help="also write the simulated strains to this FASTA file")
+    parser.add_argument("--generations", type=int, default=2, help="generations of the main simulation")
+    parser.add_argument("--family-size", type=int, default=5, help="mean number of reads per primer ID")
+    parser.add_argument("--mean-phred", type=float, default=30, help="mean simulated phred score")
+    parser.add_argument("--chunk-size", type=int, default=100000, help="reads generated and written at a time")
+    main(parser.parse_args())